@@ -1,6 +1,19 @@
+from heapq import heappop, heappush
 import logging
+from math import ceil, log as math_log
+from sys import getrefcount
+import threading
 from time import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Only numpy >= 1.8 has partition(): sort the samples on older ones.
+if numpy is not None and not hasattr(numpy, 'partition'):
+    numpy = None
+
 log = logging.getLogger(__name__)
 
 # This is used to ensure that metrics with a timestamp older than
@@ -11,16 +24,165 @@ log = logging.getLogger(__name__)
 # submitted for the timestamp passed into the flush() function.
 RECENT_POINT_THRESHOLD_DEFAULT = 30
 
+# How far back in time a BucketedMetricsAggregator accepts points, in seconds.
+BUCKET_LOOKBACK_DEFAULT = 3600
+
+# Number of packet prefixes (name, type, sample rate and tags) whose metric is
+# remembered by the context cache of each generation. See ContextCache.
+CONTEXT_CACHE_SIZE_DEFAULT = 10000
+
+# Relative accuracy of the quantiles of a SketchHistogram, and the number of
+# buckets past which it starts collapsing its lowest buckets together.
+SKETCH_RELATIVE_ACCURACY_DEFAULT = 0.01
+SKETCH_MAX_BUCKETS_DEFAULT = 2048
+
+# What histograms report unless configured otherwise. The supported
+# aggregates are min, max, median, avg, sum and count.
+HISTOGRAM_AGGREGATES_DEFAULT = ['max', 'median', 'avg', 'count']
+HISTOGRAM_PERCENTILES_DEFAULT = [0.95]
+HISTOGRAM_AGGREGATES = ['min', 'max', 'median', 'avg', 'sum', 'count']
+
+# Below this many samples, sorting them is faster than handing them to numpy.
+NUMPY_MIN_SAMPLES = 1000
+
+# Below this many samples, rolling up a histogram is faster than handing it
+# to another process.
+PROCESS_POOL_MIN_SAMPLES = 10000
+
+# Precision of the HyperLogLog sets: each uses 2 ** precision bytes, and the
+# standard error of its count is about 1.04 / sqrt(2 ** precision), i.e. 1.6%
+# with the default.
+HLL_PRECISION_DEFAULT = 12
+
+# Tags of the context the metrics over their cardinality limit are folded
+# into, and the number of metric names creating the most contexts we track.
+CARDINALITY_OVERFLOW_TAGS = ('cardinality_overflow:true',)
+CARDINALITY_TOP_K = 10
+
+# Number of tag sets the tag pool may hold before it first looks for the ones
+# nothing uses anymore.
+TAG_POOL_SWEEP_SIZE = 1024
+
+class CoarseClock(object):
+    """
+    The time, as last set by an aggregator. The aggregators set it once per
+    batch of packets or submitted metric, and metrics use it to timestamp
+    their samples rather than each reading the clock.
+    """
+
+    __slots__ = ('now',)
+
+    def __init__(self):
+        self.now = time()
+
+
+# Shared by every aggregator in the process.
+clock = CoarseClock()
+
 class Infinity(Exception): pass
 class UnknownValue(Exception): pass
 
+class PacketError(Exception):
+    """ An invalid dogstatsd packet, `reason` says what's wrong with it. """
+
+    def __init__(self, message, reason):
+        Exception.__init__(self, message)
+        self.reason = reason
+
+
+def intern_string(value):
+    # Only byte strings can be interned.
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
+class TagPool(object):
+    """
+    Canonical tag sets: sorted, deduped tuples of interned strings shared by
+    every context, check sample and formatter using the same tags, so a tag
+    set is only stored and sorted once per process.
+
+    Tuples can't be weakly referenced, so the pool evicts them itself: once
+    it has doubled in size since the last sweep, it drops the tag sets
+    nothing but the pool refers to. A tag set handed out just as it gets
+    swept only costs us some sharing.
+    """
+
+    def __init__(self):
+        # Tags as they were given (any order, maybe duplicated) -> canonical
+        # tuple. Each canonical tuple is also its own key.
+        self.pool = {}
+        self.sweep_size = TAG_POOL_SWEEP_SIZE
+
+    def __len__(self):
+        return len(self.pool)
+
+    def get(self, tags):
+        if type(tags) is not tuple:
+            tags = tuple(tags)
+        canonical = self.pool.get(tags)
+        if canonical is None:
+            canonical = tuple(sorted(set(intern_string(t) for t in tags)))
+            canonical = self.pool.setdefault(canonical, canonical)
+            self.pool[tags] = canonical
+            if len(self.pool) > self.sweep_size:
+                self.sweep()
+        return canonical
+
+    def sweep(self):
+        """ Drop the tag sets only the pool refers to. """
+        pool = dict(self.pool)
+        aliases = {}
+        for tags_id in map(id, pool.itervalues()):
+            aliases[tags_id] = aliases.get(tags_id, 0) + 1
+
+        unused = set()
+        for tags in pool.iterkeys():
+            if pool[tags] is tags:
+                # Both dicts hold it once as a key and once per alias; the
+                # loop variable and the argument hold two more.
+                if getrefcount(tags) - 2 * (aliases[id(tags)] + 1) <= 2:
+                    unused.add(id(tags))
+
+        for tags, canonical in pool.iteritems():
+            if id(canonical) in unused:
+                self.pool.pop(tags, None)
+        self.sweep_size = max(2 * len(self.pool), TAG_POOL_SWEEP_SIZE)
+        log.debug("tag pool: %s tag sets swept, %s entries left" % (
+            len(unused), len(self.pool)))
+
+
+# Shared by everything in the process.
+tag_pool = TagPool()
+intern_tags = tag_pool.get
+
+
+def percentile_suffix(percentile):
+    """ 0.95 -> '95percentile', 0.999 -> '999percentile' """
+    return '%spercentile' % ('%g' % round(percentile * 100, 4)).replace('.', '')
+
+
+def bit_length(value):
+    """ Number of bits needed to write the non-negative `value`, as
+    int.bit_length(), which Python 2.6 doesn't have. """
+    if not value:
+        return 0
+    return len(bin(value)) - 2
+
 
 class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
+
+    There can be hundreds of thousands of live metrics, so they use
+    __slots__ rather than a __dict__ each.
     """
 
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name',
+        'last_sample_time')
+
     def sample(self, value, sample_rate):
         """ Add a point to the given metric. """
         raise NotImplementedError()
@@ -29,10 +191,17 @@ class Metric(object):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def merge(self, other):
+        """ Fold the samples of `other`, a metric of the same type and context,
+        into this one. """
+        raise NotImplementedError()
+
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
 
+    __slots__ = ('value',)
+
     def __init__(self, formatter, name, tags, hostname, device_name):
         self.formatter = formatter
         self.name = name
@@ -44,7 +213,12 @@ class Gauge(Metric):
 
     def sample(self, value, sample_rate):
         self.value = value
-        self.last_sample_time = time()
+        self.last_sample_time = clock.now
+
+    def merge(self, other):
+        if other.value is not None and other.last_sample_time >= self.last_sample_time:
+            self.value = other.value
+            self.last_sample_time = other.last_sample_time
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -65,6 +239,8 @@ class Gauge(Metric):
 class Counter(Metric):
     """ A metric that tracks a counter value. """
 
+    __slots__ = ('value',)
+
     def __init__(self, formatter, name, tags, hostname, device_name):
         self.formatter = formatter
         self.name = name
@@ -72,10 +248,15 @@ class Counter(Metric):
         self.tags = tags
         self.hostname = hostname
         self.device_name = device_name
+        self.last_sample_time = None
 
     def sample(self, value, sample_rate):
         self.value += value * int(1 / sample_rate)
-        self.last_sample_time = time()
+        self.last_sample_time = clock.now
+
+    def merge(self, other):
+        self.value += other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
 
     def flush(self, timestamp, interval):
         try:
@@ -95,38 +276,69 @@ class Counter(Metric):
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
 
-    def __init__(self, formatter, name, tags, hostname, device_name):
+    __slots__ = ('count', 'samples', 'aggregates', 'percentiles')
+
+    def __init__(self, formatter, name, tags, hostname, device_name,
+                 aggregates=None, percentiles=None):
         self.formatter = formatter
         self.name = name
         self.count = 0
         self.samples = []
-        self.percentiles = [0.95]
+        self.aggregates = aggregates or HISTOGRAM_AGGREGATES_DEFAULT
+        self.percentiles = percentiles or HISTOGRAM_PERCENTILES_DEFAULT
         self.tags = tags
         self.hostname = hostname
         self.device_name = device_name
+        self.last_sample_time = None
 
     def sample(self, value, sample_rate):
         self.count += int(1 / sample_rate)
         self.samples.append(value)
-        self.last_sample_time = time()
+        self.last_sample_time = clock.now
+
+    def merge(self, other):
+        self.count += other.count
+        self.samples.extend(other.samples)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def _select(self, ranks):
+        """
+        Return the samples of the given (0-based) ranks, along with the min,
+        max and sum of the samples. With numpy, the ranks are selected in
+        linear time; otherwise we sort the samples once, which beats
+        selecting them in pure Python.
+        """
+        samples = self.samples
+        if numpy is not None and len(samples) >= NUMPY_MIN_SAMPLES:
+            array = numpy.array(samples)
+            selected = numpy.partition(array, sorted(set(ranks)))
+            return ([selected[r].item() for r in ranks], array.min().item(),
+                array.max().item(), array.sum().item())
+
+        samples.sort()
+        return ([samples[r] for r in ranks], samples[0], samples[-1],
+            sum(samples))
 
     def flush(self, ts, interval):
         if not self.count:
             return []
 
-        self.samples.sort()
         length = len(self.samples)
-
-        max_ = self.samples[-1]
-        med = self.samples[int(round(length/2 - 1))]
-        avg = sum(self.samples) / float(length)
-
-        metric_aggrs = [
-            ('max', max_),
-            ('median', med),
-            ('avg', avg),
-            ('count', self.count/interval)
-        ]
+        ranks = [max(int(round(length/2 - 1)), 0)]
+        ranks += [max(int(round(p * length - 1)), 0) for p in self.percentiles]
+        selected, min_, max_, sum_ = self._select(ranks)
+
+        values = {
+            'min': min_,
+            'max': max_,
+            'median': selected[0],
+            'avg': sum_ / float(length),
+            'sum': sum_,
+            'count': self.count/interval,
+        }
+        metric_aggrs = [(a, values[a]) for a in self.aggregates]
+        metric_aggrs += [(percentile_suffix(p), v)
+            for p, v in zip(self.percentiles, selected[1:])]
 
         metrics = [self.formatter(
                 hostname=self.hostname,
@@ -138,20 +350,167 @@ class Histogram(Metric):
             ) for suffix, value in metric_aggrs
         ]
 
-        for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
-            name = '%s.%spercentile' % (self.name, int(p * 100))
-            metrics.append(self.formatter(
+        # Reset our state.
+        self.samples = []
+        self.count = 0
+
+        return metrics
+
+
+class SketchHistogram(Metric):
+    """
+    A metric to track the distribution of a set of values in a fixed amount
+    of memory, by counting them in logarithmically sized buckets (as in
+    DDSketch) instead of keeping every sample.
+
+    Error bound: every percentile (and the median) is within
+    `relative_accuracy` of the sample of that rank, i.e.
+    |estimate - exact| <= relative_accuracy * |exact|, as long as that rank
+    doesn't fall in the lowest buckets collapsed once there are more than
+    `max_buckets` of them. With the defaults (1% and 2048 buckets) that
+    only happens for values spanning more than 17 orders of magnitude.
+    max, avg and count are exact.
+    """
+
+    __slots__ = ('count', 'aggregates', 'percentiles', 'gamma', 'multiplier',
+        'offset', 'max_buckets', 'buckets', 'floor', 'sample_count', 'sum',
+        'min', 'max')
+
+    # Values closer to 0 than this are counted as 0.
+    MIN_VALUE = 1e-9
+
+    def __init__(self, formatter, name, tags, hostname, device_name,
+                 aggregates=None, percentiles=None,
+                 relative_accuracy=SKETCH_RELATIVE_ACCURACY_DEFAULT,
+                 max_buckets=SKETCH_MAX_BUCKETS_DEFAULT):
+        self.formatter = formatter
+        self.name = name
+        self.count = 0
+        self.aggregates = aggregates or HISTOGRAM_AGGREGATES_DEFAULT
+        self.percentiles = percentiles or HISTOGRAM_PERCENTILES_DEFAULT
+        self.tags = tags
+        self.hostname = hostname
+        self.device_name = device_name
+        self.last_sample_time = None
+
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.multiplier = 1 / math_log(self.gamma)
+        # Shifts the keys of positive values above 0, and those of negative
+        # values below, so that keys sort like the values they stand for.
+        self.offset = int(ceil(-math_log(self.MIN_VALUE) * self.multiplier)) + 1
+        self.max_buckets = max_buckets
+        self._reset()
+
+    def _reset(self):
+        self.buckets = {}
+        # Keys below the floor have been collapsed into it.
+        self.floor = None
+        self.count = 0
+        self.sample_count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _key(self, value):
+        if value > self.MIN_VALUE:
+            return int(ceil(math_log(value) * self.multiplier)) + self.offset
+        elif value < -self.MIN_VALUE:
+            return -int(ceil(math_log(-value) * self.multiplier)) - self.offset
+        return 0
+
+    def _value(self, key):
+        """ The value standing for the bucket `key`: it is within the
+        relative accuracy of any value counted in that bucket. """
+        if key == 0:
+            return 0
+        elif key > 0:
+            return 2 * self.gamma ** (key - self.offset) / (1 + self.gamma)
+        return -2 * self.gamma ** (-key - self.offset) / (1 + self.gamma)
+
+    def _add(self, key, count):
+        buckets = self.buckets
+        if self.floor is not None and key < self.floor:
+            key = self.floor
+        if key in buckets:
+            buckets[key] += count
+        else:
+            buckets[key] = count
+            if len(buckets) > self.max_buckets:
+                # Collapse the lowest bucket into the next one.
+                count = buckets.pop(min(buckets))
+                self.floor = min(buckets)
+                buckets[self.floor] += count
+
+    def sample(self, value, sample_rate):
+        self.count += int(1 / sample_rate)
+        self.sample_count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+        self._add(self._key(value), 1)
+        self.last_sample_time = clock.now
+
+    def merge(self, other):
+        if other.sample_count:
+            for key, count in other.buckets.iteritems():
+                self._add(key, count)
+            self.sample_count += other.sample_count
+            self.sum += other.sum
+            self.max = max(self.max, other.max)
+            if self.min is None or other.min < self.min:
+                self.min = other.min
+        self.count += other.count
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def _quantiles(self, ranks):
+        """ Return the estimated samples of the given (0-based) ranks. """
+        results = {}
+        pending = sorted(set(ranks))
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            while pending and pending[0] < seen:
+                # The bucket of the max or min may stand for a value past it.
+                value = min(max(self._value(key), self.min), self.max)
+                results[pending.pop(0)] = value
+            if not pending:
+                break
+        return [results[rank] for rank in ranks]
+
+    def flush(self, ts, interval):
+        if not self.count:
+            return []
+
+        length = self.sample_count
+        ranks = [int(round(length/2 - 1))]
+        ranks += [int(round(p * length - 1)) for p in self.percentiles]
+        quantiles = self._quantiles([max(rank, 0) for rank in ranks])
+
+        values = {
+            'min': self.min,
+            'max': self.max,
+            'median': quantiles[0],
+            'avg': self.sum / float(length),
+            'sum': self.sum,
+            'count': self.count/interval,
+        }
+        metric_aggrs = [(a, values[a]) for a in self.aggregates]
+        metric_aggrs += [(percentile_suffix(p), v)
+            for p, v in zip(self.percentiles, quantiles[1:])]
+
+        metrics = [self.formatter(
                 hostname=self.hostname,
+                device_name=self.device_name,
                 tags=self.tags,
-                metric=name,
-                value=val,
+                metric='%s.%s' % (self.name, suffix),
+                value=value,
                 timestamp=ts
-            ))
+            ) for suffix, value in metric_aggrs
+        ]
 
-        # Reset our state.
-        self.samples = []
-        self.count = 0
+        self._reset()
 
         return metrics
 
@@ -159,6 +518,8 @@ class Histogram(Metric):
 class Set(Metric):
     """ A metric to track the number of unique elements in a set. """
 
+    __slots__ = ('values',)
+
     def __init__(self, formatter, name, tags, hostname, device_name):
         self.formatter = formatter
         self.name = name
@@ -166,10 +527,15 @@ class Set(Metric):
         self.hostname = hostname
         self.device_name = device_name
         self.values = set()
+        self.last_sample_time = None
 
     def sample(self, value, sample_rate):
         self.values.add(value)
-        self.last_sample_time = time()
+        self.last_sample_time = clock.now
+
+    def merge(self, other):
+        self.values.update(other.values)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
 
     def flush(self, timestamp, interval):
         if not self.values:
@@ -187,9 +553,130 @@ class Set(Metric):
             self.values = set()
 
 
+class HyperLogLogSet(Metric):
+    """
+    A metric to track the approximate number of unique elements in a set
+    with a HyperLogLog, i.e. in 2 ** precision bytes however many elements
+    there are.
+    """
+
+    __slots__ = ('precision', 'registers')
+
+    MASK_64 = (1 << 64) - 1
+
+    def __init__(self, formatter, name, tags, hostname, device_name,
+                 precision=HLL_PRECISION_DEFAULT):
+        self.formatter = formatter
+        self.name = name
+        self.tags = tags
+        self.hostname = hostname
+        self.device_name = device_name
+        self.precision = precision
+        # Allocated on the first sample of each interval.
+        self.registers = None
+        self.last_sample_time = None
+
+    def _hash(self, value):
+        # Mix the bits of the builtin hash (the murmur3 finalizer): ints hash
+        # to themselves, which would leave most of them in the same register.
+        h = hash(value) & self.MASK_64
+        h ^= h >> 33
+        h = (h * 0xff51afd7ed558ccd) & self.MASK_64
+        h ^= h >> 33
+        h = (h * 0xc4ceb9fe1a85ec53) & self.MASK_64
+        h ^= h >> 33
+        return h
+
+    def sample(self, value, sample_rate):
+        if self.registers is None:
+            self.registers = bytearray(1 << self.precision)
+        h = self._hash(value)
+        # The first bits pick the register, which keeps the longest run of
+        # leading zeros (plus one) seen in the remaining bits.
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - bit_length(h & ((1 << bits) - 1)) + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+        self.last_sample_time = clock.now
+
+    def merge(self, other):
+        if other.registers is not None:
+            if self.registers is None:
+                self.registers = other.registers
+            else:
+                self.registers = bytearray(max(a, b) for a, b in
+                    zip(self.registers, other.registers))
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    @staticmethod
+    def _sigma(x):
+        if x == 1:
+            return float('inf')
+        y = 1.0
+        z = x
+        while True:
+            x *= x
+            previous = z
+            z += x * y
+            y += y
+            if z == previous:
+                return z
+
+    @staticmethod
+    def _tau(x):
+        if x == 0 or x == 1:
+            return 0.0
+        y = 1.0
+        z = 1 - x
+        while True:
+            x = x ** 0.5
+            previous = z
+            y *= 0.5
+            z -= (1 - x) ** 2 * y
+            if z == previous:
+                return z / 3
+
+    def count(self):
+        """
+        Estimate the number of unique elements with the improved estimator
+        of Ertl ("New cardinality estimation algorithms for HyperLogLog
+        sketches", 2017), which unlike the original one isn't biased for
+        small cardinalities and needs no empirical correction.
+        """
+        m = float(len(self.registers))
+        q = 64 - self.precision
+        histogram = [0] * (q + 2)
+        for r in self.registers:
+            histogram[r] += 1
+
+        z = m * self._tau(1 - histogram[q + 1] / m)
+        for k in xrange(q, 0, -1):
+            z = 0.5 * (z + histogram[k])
+        z += m * self._sigma(histogram[0] / m)
+        return int(round(m * m / (2 * math_log(2) * z)))
+
+    def flush(self, timestamp, interval):
+        if self.registers is None:
+            return []
+        try:
+            return [self.formatter(
+                hostname=self.hostname,
+                device_name=self.device_name,
+                tags=self.tags,
+                metric=self.name,
+                value=self.count(),
+                timestamp=timestamp
+            )]
+        finally:
+            self.registers = None
+
+
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
 
+    __slots__ = ('samples',)
+
     def __init__(self, formatter, name, tags, hostname, device_name):
         self.formatter = formatter
         self.name = name
@@ -197,12 +684,17 @@ class Rate(Metric):
         self.hostname = hostname
         self.device_name = device_name
         self.samples = []
+        self.last_sample_time = None
 
     def sample(self, value, sample_rate):
-        ts = time()
+        ts = clock.now
         self.samples.append((int(ts), value))
         self.last_sample_time = ts
 
+    def merge(self, other):
+        self.samples = sorted(self.samples + other.samples)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def _rate(self, sample1, sample2):
         interval = sample2[0] - sample1[0]
         if interval == 0:
@@ -237,6 +729,76 @@ class Rate(Metric):
             self.samples = self.samples[-1:]
 
 
+class SpaceSaving(object):
+    """
+    The approximate top-k of a stream of keys, in O(k) memory (the
+    space-saving algorithm). The count of a key is overestimated by at most
+    the count of the key it evicted, i.e. by at most n / k after n keys.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+
+    def add(self, key, count=1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+        elif len(counts) < self.k:
+            counts[key] = count
+        else:
+            # Take the place of the smallest key, and of its count.
+            smallest = min(counts, key=counts.get)
+            counts[key] = counts.pop(smallest) + count
+
+    def top(self):
+        return sorted(self.counts.iteritems(), key=lambda (k, c): c, reverse=True)
+
+
+class ContextCache(object):
+    """
+    A bounded cache mapping the raw prefix of a packet (everything but its
+    value) to the metric it feeds and its sample rate, so that repeated
+    packets skip the splitting, tag sorting and context building.
+
+    It approximates an LRU with two generations: entries are added to the
+    current generation, and entries found in the previous one are promoted.
+    Once the current generation holds `max_size` entries it becomes the
+    previous one, dropping whatever wasn't used since the last rotation.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.current = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.current.get(key)
+        if entry is None:
+            entry = self.previous.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.set(key, entry)
+        self.hits += 1
+        return entry
+
+    def set(self, key, entry):
+        if len(self.current) >= self.max_size:
+            self.previous = self.current
+            self.current = {}
+        self.current[key] = entry
+
+    def clear(self):
+        self.current = {}
+        self.previous = {}
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+
 class MetricsAggregator(object):
     """
     A metric aggregator class.
@@ -245,7 +807,15 @@ class MetricsAggregator(object):
     # Types of metrics that allow strings
     ALLOW_STRINGS = ['s', ]
 
-    def __init__(self, hostname, interval=1.0, expiry_seconds=300, formatter=None, recent_point_threshold=None):
+    HISTOGRAM_TYPES = ['h', 'ms']
+
+    def __init__(self, hostname, interval=1.0, expiry_seconds=300, formatter=None,
+                 recent_point_threshold=None, context_cache_size=CONTEXT_CACHE_SIZE_DEFAULT,
+                 histogram_sketch=False, sketch_relative_accuracy=None,
+                 histogram_aggregates=None, histogram_percentiles=None,
+                 histogram_prefix_options=None, hll_set_prefixes=None,
+                 hll_precision=None, max_contexts=None, max_contexts_per_name=None,
+                 cardinality_overflow='fold'):
         self.metrics = {}
         self.total_count = 0
         self.count = 0
@@ -257,6 +827,28 @@ class MetricsAggregator(object):
             's': Set,
             '_dd-r': Rate,
         }
+
+        # Extra arguments given to the histograms we create.
+        self.histogram_options = {}
+        if histogram_sketch:
+            for mtype in self.HISTOGRAM_TYPES:
+                self.metric_type_to_class[mtype] = SketchHistogram
+            if sketch_relative_accuracy:
+                self.histogram_options['relative_accuracy'] = float(sketch_relative_accuracy)
+        if histogram_aggregates:
+            self.histogram_options['aggregates'] = histogram_aggregates
+        if histogram_percentiles:
+            self.histogram_options['percentiles'] = histogram_percentiles
+
+        # A list of (metric name prefix, histogram options) overriding the
+        # above for the matching metrics, the longest prefix first.
+        self.histogram_prefix_options = sorted(histogram_prefix_options or [],
+            key=lambda (prefix, options): len(prefix), reverse=True)
+
+        # Sets whose name starts with one of these prefixes are approximated
+        # with a HyperLogLog.
+        self.hll_set_prefixes = tuple(hll_set_prefixes or ())
+        self.hll_precision = int(hll_precision or HLL_PRECISION_DEFAULT)
         self.hostname = hostname
         self.expiry_seconds = expiry_seconds
         self.formatter = formatter or api_formatter
@@ -266,75 +858,266 @@ class MetricsAggregator(object):
         self.recent_point_threshold = int(recent_point_threshold)
         self.num_discarded_old_points = 0
 
+        # Number of metrics submitted by type, and of packets we couldn't
+        # parse by reason, since the last call to flush_stats.
+        self.metric_type_counts = {}
+        self.parse_errors = {}
+
+        # Past these many contexts in all or for a metric name, new contexts
+        # are folded into an overflow context or dropped.
+        self.max_contexts = int(max_contexts or 0)
+        self.max_contexts_per_name = int(max_contexts_per_name or 0)
+        self.cardinality_overflow = cardinality_overflow
+        self.name_context_counts = {}
+        # Number of contexts refused by limit, and the metric names creating
+        # the most contexts, since the last call to flush_stats.
+        self.cardinality_trips = {}
+        self.new_contexts = SpaceSaving(CARDINALITY_TOP_K)
+
+        # Flushing only looks at the metrics sampled since the last flush and
+        # at the counters (which report 0 until they expire). Contexts are
+        # expired through a min-heap holding one (time it was last known to
+        # be sampled, context) entry per context.
+        # The aggregator may be flushed by a thread (e.g. the reporter) while
+        # another one submits to it (e.g. the server): flushing swaps the
+        # active set out, and `contexts_lock` guards the counters, the heap
+        # and the per-name counts, which only change with the contexts.
+        self.active = set()
+        self.counters = set()
+        self.expiry_heap = []
+        self.contexts_lock = threading.Lock()
+
+        # The cache holds references to metrics, so it must be cleared
+        # whenever contexts are dropped from `self.metrics`.
+        self.context_cache = None
+        if context_cache_size:
+            self.context_cache = ContextCache(int(context_cache_size))
+
     def packets_per_second(self, interval):
         return round(float(self.count)/interval, 2)
 
     def submit_packets(self, packets):
+        # A bad line shouldn't cost us the rest of the datagram (or of the
+        # batch of datagrams we were handed), so keep going and re-raise the
+        # first error once everything else has been submitted.
+        error = None
+        context_cache = self.context_cache
+        type_counts = self.metric_type_counts
+        clock.now = time()
 
         for packet in packets.split("\n"):
             self.count += 1
-            # We can have colons in tags, so split once.
-            name_and_metadata = packet.split(':', 1)
-
-            if not packet.strip():
-                continue
-
-            if len(name_and_metadata) != 2:
-                raise Exception('Unparseable packet: %s' % packet)
-
-            name = name_and_metadata[0]
-            metadata = name_and_metadata[1].split('|')
-
-            if len(metadata) < 2:
-                raise Exception('Unparseable packet: %s' % packet)
-
-            # Try to cast as an int first to avoid precision issues, then as a
-            # float.
             try:
-                value = int(metadata[0])
-            except ValueError:
+                # We can have colons in tags, so split once.
+                name_and_metadata = packet.split(':', 1)
+
+                if not packet.strip():
+                    continue
+
+                if len(name_and_metadata) != 2:
+                    raise PacketError('Unparseable packet: %s' % packet, 'unparseable')
+
+                name = name_and_metadata[0]
+
+                # Fast path: we've seen this exact packet prefix before, so
+                # all that's left to do is parse the value.
+                cache_key = None
+                if context_cache is not None:
+                    value_end = name_and_metadata[1].find('|')
+                    if value_end > 0:
+                        cache_key = name + name_and_metadata[1][value_end:]
+                        entry = context_cache.get(cache_key)
+                        if entry is not None:
+                            metric, mtype, sample_rate = entry
+                            raw_value = name_and_metadata[1][:value_end]
+                            try:
+                                value = int(raw_value)
+                            except ValueError:
+                                try:
+                                    value = float(raw_value)
+                                except ValueError:
+                                    if mtype in self.ALLOW_STRINGS:
+                                        value = raw_value
+                                    else:
+                                        raise PacketError('Metric value must be a number: %s, %s' % (name, raw_value), 'value')
+                            metric.sample(value, sample_rate)
+                            self.active.add(metric)
+                            type_counts[mtype] = type_counts.get(mtype, 0) + 1
+                            continue
+
+                metadata = name_and_metadata[1].split('|')
+
+                if len(metadata) < 2:
+                    raise PacketError('Unparseable packet: %s' % packet, 'unparseable')
+
+                # Try to cast as an int first to avoid precision issues, then as a
+                # float.
                 try:
-                    value = float(metadata[0])
+                    value = int(metadata[0])
                 except ValueError:
-
-                    # If the data type is Set, we will allow strings
-                    if metadata[1] in self.ALLOW_STRINGS:
-                        value = metadata[0]
-                    else:
-                        # Otherwise, raise an error saying it must be a number
-                        raise Exception('Metric value must be a number: %s, %s' % (name, metadata[0]))
-
-            # Parse the optional values - sample rate & tags.
-            sample_rate = 1
-            tags = None
-            for m in metadata[2:]:
-                # Parse the sample rate
-                if m[0] == '@':
-                    sample_rate = float(m[1:])
-                    assert 0 <= sample_rate <= 1
-                elif m[0] == '#':
-                    tags = tuple(sorted(m[1:].split(',')))
-
-            # Submit the metric
-            mtype = metadata[1]
-            self.submit_metric(name, value, mtype, tags=tags, sample_rate=sample_rate)
+                    try:
+                        value = float(metadata[0])
+                    except ValueError:
+
+                        # If the data type is Set, we will allow strings
+                        if metadata[1] in self.ALLOW_STRINGS:
+                            value = metadata[0]
+                        else:
+                            # Otherwise, raise an error saying it must be a number
+                            raise PacketError('Metric value must be a number: %s, %s' % (name, metadata[0]), 'value')
+
+                # Parse the optional values - sample rate & tags.
+                sample_rate = 1
+                tags = None
+                for m in metadata[2:]:
+                    # Parse the sample rate
+                    if m[0] == '@':
+                        try:
+                            sample_rate = float(m[1:])
+                        except ValueError:
+                            sample_rate = None
+                        if sample_rate is None or not 0 <= sample_rate <= 1:
+                            raise PacketError('Invalid sample rate: %s' % packet, 'sample_rate')
+                    elif m[0] == '#':
+                        tags = intern_tags(m[1:].split(','))
+
+                # Submit the metric
+                mtype = metadata[1]
+                if mtype not in self.metric_type_to_class:
+                    raise PacketError('Unknown metric type: %s' % packet, 'metric_type')
+                metric = self.submit_metric(name, value, mtype, tags=tags, sample_rate=sample_rate)
+                type_counts[mtype] = type_counts.get(mtype, 0) + 1
+                if cache_key is not None and metric is not None:
+                    context_cache.set(cache_key, (metric, mtype, sample_rate))
+            except Exception, e:
+                reason = getattr(e, 'reason', 'other')
+                self.parse_errors[reason] = self.parse_errors.get(reason, 0) + 1
+                if error is None:
+                    error = e
+
+        if error is not None:
+            raise error
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                                 device_name=None, timestamp=None, sample_rate=1):
+        clock.now = cur_time = time()
         # Avoid calling extra functions to dedupe tags if there are none
         if tags is None:
-            context = (name, tuple(), hostname, device_name)
+            context = (name, (), hostname, device_name)
         else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+            context = (name, intern_tags(tags), hostname, device_name)
         if context not in self.metrics:
-            metric_class = self.metric_type_to_class[mtype]
-            self.metrics[context] = metric_class(self.formatter, name, tags,
-                hostname or self.hostname, device_name)
-        cur_time = time()
+            context = self._limit_cardinality(context)
+            if context is None:
+                return None
+        if context not in self.metrics:
+            # New contexts share their names, tags and hosts with the
+            # existing ones rather than holding their own copies.
+            context = self._intern_context(context)
+            name, context_tags, hostname, device_name = context
+            if tags is not None or context_tags:
+                tags = context_tags
+            self._add_context(context, self._create_metric(mtype, name, tags,
+                hostname or self.hostname, device_name), cur_time)
+        metric = self.metrics[context]
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
             self.num_discarded_old_points += 1
         else:
-            self.metrics[context].sample(value, sample_rate)
+            metric.sample(value, sample_rate)
+            self.active.add(metric)
+        return metric
+
+    def _limit_cardinality(self, context):
+        """ The context a metric of this new context should go to: the same
+        one, the overflow context of its name if it's over its limit, or
+        None if it should be dropped. """
+        name = context[0]
+        self.new_contexts.add(name)
+        trips = self.cardinality_trips
+        if self.max_contexts and len(self.metrics) >= self.max_contexts:
+            # Folding would still take a context per metric name.
+            trips['global'] = trips.get('global', 0) + 1
+            return None
+        if self.max_contexts_per_name and context[1] != CARDINALITY_OVERFLOW_TAGS and \
+                self.name_context_counts.get(name, 0) >= self.max_contexts_per_name:
+            trips['per_name'] = trips.get('per_name', 0) + 1
+            if self.cardinality_overflow == 'drop':
+                return None
+            return (name, CARDINALITY_OVERFLOW_TAGS, context[2], context[3])
+        return context
+
+    def _add_context(self, context, metric, timestamp):
+        self.contexts_lock.acquire()
+        try:
+            self.metrics[context] = metric
+            if isinstance(metric, Counter):
+                self.counters.add(metric)
+            heappush(self.expiry_heap, (timestamp, context))
+            name = context[0]
+            self.name_context_counts[name] = self.name_context_counts.get(name, 0) + 1
+        finally:
+            self.contexts_lock.release()
+
+    def _expire(self, expiry_timestamp):
+        """ Drop the contexts without samples since `expiry_timestamp` and
+        return how many there were. """
+        self.contexts_lock.acquire()
+        try:
+            expired = self._expire_locked(expiry_timestamp)
+            # Don't let the submissions from now on find the dropped
+            # metrics in the cache.
+            if expired and self.context_cache is not None:
+                self.context_cache.clear()
+            return expired
+        finally:
+            self.contexts_lock.release()
+
+    def _expire_locked(self, expiry_timestamp):
+        expired = 0
+        heap = self.expiry_heap
+        while heap and heap[0][0] < expiry_timestamp:
+            _, context = heappop(heap)
+            metric = self.metrics.get(context)
+            if metric is None:
+                continue
+            if metric.last_sample_time >= expiry_timestamp:
+                # Sampled since we pushed it: check again later.
+                heappush(heap, (metric.last_sample_time, context))
+            else:
+                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                del self.metrics[context]
+                name = context[0]
+                if self.name_context_counts[name] > 1:
+                    self.name_context_counts[name] -= 1
+                else:
+                    del self.name_context_counts[name]
+                self.counters.discard(metric)
+                expired += 1
+        return expired
+
+    def _intern_context(self, context):
+        # The tags come from the tag pool already.
+        name, tags, hostname, device_name = context
+        return (intern_string(name), tags, intern_string(hostname),
+            intern_string(device_name))
+
+    def _create_metric(self, mtype, name, tags, hostname, device_name):
+        metric_class = self.metric_type_to_class[mtype]
+        if mtype in self.HISTOGRAM_TYPES:
+            return metric_class(self.formatter, name, tags, hostname,
+                device_name, **self._histogram_options(name))
+        if mtype == 's' and self.hll_set_prefixes and name.startswith(self.hll_set_prefixes):
+            return HyperLogLogSet(self.formatter, name, tags, hostname,
+                device_name, self.hll_precision)
+        return metric_class(self.formatter, name, tags, hostname, device_name)
+
+    def _histogram_options(self, name):
+        for prefix, options in self.histogram_prefix_options:
+            if name.startswith(prefix):
+                merged = self.histogram_options.copy()
+                merged.update(options)
+                return merged
+        return self.histogram_options
 
     def gauge(self, name, value, tags=None, hostname=None, device_name=None, timestamp=None):
         self.submit_metric(name, value, 'g', tags, hostname, device_name, timestamp)
@@ -355,18 +1138,52 @@ class MetricsAggregator(object):
         self.submit_metric(name, value, 's', tags, hostname, device_name)
 
     def flush(self):
+        metrics = []
+        self.flush_to(metrics.extend)
+        return metrics
+
+    def flush_to(self, write, pool=None):
+        """ Like `flush`, but hand the points of each metric to `write` as
+        they're rolled up rather than returning them all at once. The large
+        histograms are rolled up by `pool`, a multiprocessing pool, if
+        there's one. """
         timestamp = time()
         expiry_timestamp = timestamp - self.expiry_seconds
 
-        # Flush points and remove expired metrics. We mutate this dictionary
-        # while iterating so don't use an iterator.
-        metrics = []
-        for context, metric in self.metrics.items():
-            if metric.last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                del self.metrics[context]
+        # Remove expired metrics, then flush the ones that have something
+        # to report.
+        self._expire(expiry_timestamp)
+        self.contexts_lock.acquire()
+        try:
+            counters = list(self.counters)
+        finally:
+            self.contexts_lock.release()
+        # Start a new set for the metrics sampled from now on. A submission
+        # racing with the swap may still add to the old one: iterate a copy.
+        active, self.active = self.active, set()
+        offloaded = []
+        for metric in list(active):
+            if pool is not None and type(metric) is Histogram and \
+                    len(metric.samples) >= PROCESS_POOL_MIN_SAMPLES:
+                offloaded.append(metric)
             else:
-                metrics += metric.flush(timestamp, self.interval)
+                write(metric.flush(timestamp, self.interval))
+        for metric in counters:
+            if metric not in active:
+                write(metric.flush(timestamp, self.interval))
+
+        if offloaded:
+            for points in pool.map(_flush_metric,
+                    [(m, timestamp, self.interval) for m in offloaded]):
+                write(points)
+            # Reset what the pool flushed copies of.
+            for metric in offloaded:
+                metric.samples = []
+                metric.count = 0
+
+        if self.context_cache is not None:
+            log.debug("context cache: %s entries, %s hits, %s misses" % (
+                len(self.context_cache), self.context_cache.hits, self.context_cache.misses))
 
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
@@ -377,11 +1194,450 @@ class MetricsAggregator(object):
         log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
         self.count = 0
+
+    def send_packet_count(self, metric_name):
+        self.submit_metric(metric_name, self.count, 'g')
+
+    def context_count(self):
+        return len(self.metrics)
+
+    def flush_stats(self):
+        """ Return the counts accumulated since the last call, and reset
+        them: metrics submitted by type, parse errors by reason, contexts
+        refused by limit and the metric names creating the most contexts. """
+        stats = {
+            'metric_types': self.metric_type_counts,
+            'parse_errors': self.parse_errors,
+            'cardinality_trips': self.cardinality_trips,
+            'new_contexts': dict(self.new_contexts.counts),
+        }
+        self.metric_type_counts = {}
+        self.parse_errors = {}
+        self.cardinality_trips = {}
+        self.new_contexts = SpaceSaving(CARDINALITY_TOP_K)
+        return stats
+
+    def merge_stats(self, stats):
+        """ Add the stats returned by another aggregator's flush_stats. """
+        for counts, key in ((self.metric_type_counts, 'metric_types'),
+                            (self.parse_errors, 'parse_errors'),
+                            (self.cardinality_trips, 'cardinality_trips')):
+            for k, count in stats[key].iteritems():
+                counts[k] = counts.get(k, 0) + count
+        for name, count in stats['new_contexts'].iteritems():
+            self.new_contexts.add(name, count)
+
+    def flush_partials(self):
+        """
+        Return the packet count and the raw, not yet rolled-up metrics
+        received since the last call, and start over with an empty state.
+        They can be folded into another aggregator with `merge`.
+        """
+        count, metrics = self.count, self.metrics
+        self.total_count += self.count
+        self.count = 0
+        self.metrics = {}
+        self.active = set()
+        self.contexts_lock.acquire()
+        try:
+            self.counters = set()
+            self.expiry_heap = []
+            self.name_context_counts = {}
+        finally:
+            self.contexts_lock.release()
+        if self.context_cache is not None:
+            self.context_cache.clear()
+        return count, metrics
+
+    def merge(self, count, metrics):
+        """
+        Fold the partial aggregates returned by another aggregator's
+        `flush_partials` into this one.
+        """
+        self.count += count
+        for context, metric in metrics.iteritems():
+            existing = self.metrics.get(context)
+            if existing is None:
+                context = self._limit_cardinality(context)
+                if context is None:
+                    continue
+                existing = self.metrics.get(context)
+            if existing is None:
+                metric.formatter = self.formatter
+                if context[1] == CARDINALITY_OVERFLOW_TAGS:
+                    metric.tags = CARDINALITY_OVERFLOW_TAGS
+                self._add_context(context, metric, metric.last_sample_time or time())
+                existing = metric
+            elif type(existing) is type(metric):
+                existing.merge(metric)
+            self.active.add(existing)
+
+
+class DoubleBufferedAggregator(object):
+    """
+    A metrics aggregator that can be fed by one thread (e.g. the dogstatsd
+    server) while another one flushes it (e.g. the reporter).
+
+    Metrics are submitted to a front aggregator. Flushing swaps its contexts
+    out under a lock, which is O(1), then folds them into a back aggregator
+    and rolls them up there, so submitters never wait on serialization. The
+    back aggregator holds what has to outlive an interval: counters that
+    report 0 until they expire, the last sample of rates, expiry times.
+    """
+
+    def __init__(self, hostname, interval=1.0, expiry_seconds=300, formatter=None,
+                 **kwargs):
+        self.front = MetricsAggregator(hostname, interval, expiry_seconds,
+            formatter, **kwargs)
+        self.back = MetricsAggregator(hostname, interval, expiry_seconds,
+            formatter, **kwargs)
+        self.hostname = hostname
+        self.interval = self.back.interval
+        self.formatter = self.back.formatter
+        # Guards the front aggregator.
+        self.lock = threading.Lock()
+        # Serializes the flushes, which own the back aggregator.
+        self.flush_lock = threading.Lock()
+
+    @property
+    def count(self):
+        return self.front.count + self.back.count
+
+    @property
+    def total_count(self):
+        return self.back.total_count
+
+    def packets_per_second(self, interval):
+        return round(float(self.count)/interval, 2)
+
+    def submit_packets(self, packets):
+        self.lock.acquire()
+        try:
+            self.front.submit_packets(packets)
+        finally:
+            self.lock.release()
+
+    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
+                                device_name=None, timestamp=None, sample_rate=1):
+        self.lock.acquire()
+        try:
+            self.front.submit_metric(name, value, mtype, tags, hostname,
+                device_name, timestamp, sample_rate)
+        finally:
+            self.lock.release()
+
+    def gauge(self, name, value, tags=None, hostname=None, device_name=None, timestamp=None):
+        self.submit_metric(name, value, 'g', tags, hostname, device_name, timestamp)
+
+    def increment(self, name, value=1, tags=None, hostname=None, device_name=None):
+        self.submit_metric(name, value, 'c', tags, hostname, device_name)
+
+    def decrement(self, name, value=-1, tags=None, hostname=None, device_name=None):
+        self.submit_metric(name, value, 'c', tags, hostname, device_name)
+
+    def rate(self, name, value, tags=None, hostname=None, device_name=None):
+        self.submit_metric(name, value, '_dd-r', tags, hostname, device_name)
+
+    def histogram(self, name, value, tags=None, hostname=None, device_name=None):
+        self.submit_metric(name, value, 'h', tags, hostname, device_name)
+
+    def set(self, name, value, tags=None, hostname=None, device_name=None):
+        self.submit_metric(name, value, 's', tags, hostname, device_name)
+
+    def send_packet_count(self, metric_name):
+        self.flush_lock.acquire()
+        try:
+            self.back.submit_metric(metric_name, self.count, 'g')
+        finally:
+            self.flush_lock.release()
+
+    def merge(self, count, metrics):
+        self.flush_lock.acquire()
+        try:
+            self.back.merge(count, metrics)
+        finally:
+            self.flush_lock.release()
+
+    def context_count(self):
+        return self.back.context_count()
+
+    def flush_stats(self):
+        self.lock.acquire()
+        try:
+            stats = self.front.flush_stats()
+        finally:
+            self.lock.release()
+        # Every context is new to the front aggregator at each interval: the
+        # back one knows which really are.
+        stats['new_contexts'] = {}
+        self.back.merge_stats(stats)
+        return self.back.flush_stats()
+
+    def merge_stats(self, stats):
+        self.back.merge_stats(stats)
+
+    def swap(self):
+        """ Take the packet count and the contexts received by the front
+        aggregator since the last call. """
+        self.lock.acquire()
+        try:
+            return self.front.flush_partials()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        metrics = []
+        self.flush_to(metrics.extend)
         return metrics
 
+    def flush_to(self, write, pool=None):
+        self.flush_lock.acquire()
+        try:
+            count, metrics = self.swap()
+            self.back.merge(count, metrics)
+            self.back.flush_to(write, pool)
+        finally:
+            self.flush_lock.release()
+
+
+class ShardedAggregator(object):
+    """
+    A metrics aggregator spreading its contexts between several aggregators
+    (its shards) by the hash of their name and tags, so they're rolled up in
+    parallel at flush time.
+
+    Shards are flushed by a thread each, which only runs truly in parallel
+    when it spends its time out of the GIL (e.g. in numpy). With
+    `processes`, the large histograms are also rolled up by a pool of as
+    many processes, which is where most of the flush time goes with
+    histogram heavy traffic.
+    """
+
+    def __init__(self, hostname, interval=1.0, expiry_seconds=300, formatter=None,
+                 shards=2, processes=0, double_buffer=False, **kwargs):
+        shard_count = max(int(shards), 1)
+        # The limits apply to each shard: split them evenly.
+        for limit in ('max_contexts', 'max_contexts_per_name'):
+            if kwargs.get(limit):
+                kwargs[limit] = int(ceil(float(kwargs[limit]) / shard_count))
+
+        aggregator_class = MetricsAggregator
+        if double_buffer:
+            aggregator_class = DoubleBufferedAggregator
+        self.shards = [aggregator_class(hostname, interval, expiry_seconds,
+            formatter, **kwargs) for _ in xrange(shard_count)]
+        self.hostname = hostname
+        self.interval = self.shards[0].interval
+        self.formatter = self.shards[0].formatter
+
+        # Created at the first flush, as threads and processes started now
+        # wouldn't survive daemonizing.
+        self.processes = int(processes or 0)
+        self.thread_pool = None
+        self.process_pool = None
+
+    @property
+    def count(self):
+        return sum(shard.count for shard in self.shards)
+
+    @property
+    def total_count(self):
+        return sum(shard.total_count for shard in self.shards)
+
+    def packets_per_second(self, interval):
+        return round(float(self.count)/interval, 2)
+
+    def _shard(self, name, tags):
+        return self.shards[hash((name, tags)) % len(self.shards)]
+
+    def submit_packets(self, packets):
+        # Group the packets by shard, which only needs their name and tags.
+        shards = self.shards
+        lines = [[] for _ in shards]
+        for packet in packets.split("\n"):
+            name, _, metadata = packet.partition(':')
+            tags = ()
+            start = metadata.rfind('|#')
+            if start >= 0:
+                end = metadata.find('|', start + 2)
+                if end < 0:
+                    end = len(metadata)
+                tags = intern_tags(metadata[start + 2:end].split(','))
+            lines[hash((name, tags)) % len(shards)].append(packet)
+
+        # Like MetricsAggregator, re-raise the first error once everything
+        # else has been submitted.
+        error = None
+        for shard, shard_lines in zip(shards, lines):
+            if not shard_lines:
+                continue
+            try:
+                shard.submit_packets("\n".join(shard_lines))
+            except Exception, e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+
+    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
+                                device_name=None, timestamp=None, sample_rate=1):
+        if tags is None:
+            shard = self._shard(name, ())
+        else:
+            tags = intern_tags(tags)
+            shard = self._shard(name, tags)
+        return shard.submit_metric(name, value, mtype, tags, hostname,
+            device_name, timestamp, sample_rate)
+
+    def gauge(self, name, value, tags=None, hostname=None, device_name=None, timestamp=None):
+        self.submit_metric(name, value, 'g', tags, hostname, device_name, timestamp)
+
+    def increment(self, name, value=1, tags=None, hostname=None, device_name=None):
+        self.submit_metric(name, value, 'c', tags, hostname, device_name)
+
+    def decrement(self, name, value=-1, tags=None, hostname=None, device_name=None):
+        self.submit_metric(name, value, 'c', tags, hostname, device_name)
+
+    def rate(self, name, value, tags=None, hostname=None, device_name=None):
+        self.submit_metric(name, value, '_dd-r', tags, hostname, device_name)
+
+    def histogram(self, name, value, tags=None, hostname=None, device_name=None):
+        self.submit_metric(name, value, 'h', tags, hostname, device_name)
+
+    def set(self, name, value, tags=None, hostname=None, device_name=None):
+        self.submit_metric(name, value, 's', tags, hostname, device_name)
+
     def send_packet_count(self, metric_name):
         self.submit_metric(metric_name, self.count, 'g')
 
+    def merge(self, count, metrics):
+        parts = [{} for _ in self.shards]
+        for context, metric in metrics.iteritems():
+            parts[hash(context[:2]) % len(self.shards)][context] = metric
+        for i, shard in enumerate(self.shards):
+            shard.merge(count if i == 0 else 0, parts[i])
+
+    def context_count(self):
+        return sum(shard.context_count() for shard in self.shards)
+
+    def flush_stats(self):
+        stats = {'metric_types': {}, 'parse_errors': {}, 'cardinality_trips': {}}
+        new_contexts = SpaceSaving(CARDINALITY_TOP_K)
+        for shard in self.shards:
+            shard_stats = shard.flush_stats()
+            for key, counts in stats.iteritems():
+                for k, count in shard_stats[key].iteritems():
+                    counts[k] = counts.get(k, 0) + count
+            for name, count in shard_stats['new_contexts'].iteritems():
+                new_contexts.add(name, count)
+        stats['new_contexts'] = dict(new_contexts.counts)
+        return stats
+
+    def merge_stats(self, stats):
+        self.shards[0].merge_stats(stats)
+
+    def flush(self):
+        metrics = []
+        self.flush_to(metrics.extend)
+        return metrics
+
+    def flush_to(self, write):
+        if self.thread_pool is None:
+            from multiprocessing.pool import ThreadPool
+            self.thread_pool = ThreadPool(len(self.shards))
+            if self.processes:
+                from multiprocessing import Pool
+                self.process_pool = Pool(self.processes)
+
+        def flush_shard(shard):
+            metrics = []
+            shard.flush_to(metrics.extend, self.process_pool)
+            return metrics
+
+        for metrics in self.thread_pool.map(flush_shard, self.shards):
+            write(metrics)
+
+    def close(self):
+        """ Stop the threads and processes flushing the shards. """
+        for pool in (self.thread_pool, self.process_pool):
+            if pool is not None:
+                pool.terminate()
+        self.thread_pool = self.process_pool = None
+
+
+def _flush_metric(args):
+    """ Flush a metric in a multiprocessing pool. """
+    metric, timestamp, interval = args
+    return metric.flush(timestamp, interval)
+
+
+class BucketedMetricsAggregator(MetricsAggregator):
+    """
+    A metrics aggregator that keeps the timestamps of the points submitted
+    with one, such as the historical points read from RRD files.
+
+    Those go into interval-aligned buckets, each with its own contexts, and
+    are flushed with the timestamp of their bucket once it's complete.
+    Points without a timestamp are aggregated and flushed as usual. Points
+    older than `lookback` seconds are discarded, which bounds the number of
+    buckets held at once.
+    """
+
+    def __init__(self, hostname, interval=1.0, expiry_seconds=300, formatter=None,
+                 bucket_interval=None, lookback=None, **kwargs):
+        MetricsAggregator.__init__(self, hostname, interval, expiry_seconds,
+            formatter, **kwargs)
+        self.bucket_interval = int(bucket_interval or max(self.interval, 1))
+        self.lookback = int(lookback or BUCKET_LOOKBACK_DEFAULT)
+        # Bucket start time -> {context: metric}
+        self.buckets = {}
+
+    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
+                                device_name=None, timestamp=None, sample_rate=1):
+        # Rates are computed from the time their samples are received, so
+        # they can't be bucketed.
+        if timestamp is None or mtype == '_dd-r':
+            return MetricsAggregator.submit_metric(self, name, value, mtype,
+                tags, hostname, device_name, None, sample_rate)
+
+        clock.now = cur_time = time()
+        timestamp = min(int(timestamp), int(cur_time))
+        if timestamp < cur_time - self.lookback:
+            self.num_discarded_old_points += 1
+            return None
+
+        start = timestamp - timestamp % self.bucket_interval
+        bucket = self.buckets.get(start)
+        if bucket is None:
+            bucket = self.buckets[start] = {}
+
+        if tags is None:
+            context = (name, (), hostname, device_name)
+        else:
+            context = (name, intern_tags(tags), hostname, device_name)
+        metric = bucket.get(context)
+        if metric is None:
+            context = self._intern_context(context)
+            name, context_tags, hostname, device_name = context
+            if tags is not None:
+                tags = context_tags
+            metric = bucket[context] = self._create_metric(mtype, name, tags,
+                hostname or self.hostname, device_name)
+        metric.sample(value, sample_rate)
+        return metric
+
+    def flush_to(self, write, pool=None):
+        MetricsAggregator.flush_to(self, write, pool)
+
+        # Flush the complete buckets, oldest first.
+        cur_time = time()
+        for start in sorted(self.buckets):
+            if start + self.bucket_interval > cur_time:
+                break
+            # Normalized by the width of the bucket they were counted over
+            for metric in self.buckets.pop(start).itervalues():
+                write(metric.flush(start, float(self.bucket_interval)))
+
 
 def api_formatter(metric, value, timestamp, tags, hostname, device_name=None):
 
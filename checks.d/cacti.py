@@ -1,4 +1,5 @@
-from checks import AgentCheck
+from aggregator import BucketedMetricsAggregator
+from checks import AgentCheck, agent_formatter
 
 from fnmatch import fnmatch
 import os
@@ -30,6 +31,13 @@ class Cacti(AgentCheck):
         AgentCheck.__init__(self, name, init_config, agentConfig)
         self.last_ts = {}
 
+        # The RRD points are in the past: keep their timestamps rather than
+        # dropping them as too old.
+        self.aggregator = BucketedMetricsAggregator(self.hostname,
+            formatter=agent_formatter,
+            recent_point_threshold=agentConfig.get('recent_point_threshold', None),
+            lookback=(init_config or {}).get('lookback'))
+
     def check(self, instance):
         
         # Load the instance config
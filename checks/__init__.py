@@ -15,6 +15,7 @@ import traceback
 from pprint import pprint
 
 from util import LaconicFilter, get_os, get_hostname
+from aggregator import intern_tags
 from config import get_confd_path
 from checks import check_status
 
@@ -136,7 +137,7 @@ class Check(object):
             if type(tags) not in [type([]), type(())]:
                 raise CheckException("Tags must be a list or tuple of strings")
             else:
-                tags = tuple(sorted(tags))
+                tags = intern_tags(tags)
 
         # Data eviction rules
         key = (tags, device_name)
@@ -180,9 +181,8 @@ class Check(object):
         "Get (timestamp-epoch-style, value)"
 
         # Get the proper tags
-        if tags is not None and type(tags) == type([]):
-            tags.sort()
-            tags = tuple(tags)
+        if tags is not None:
+            tags = intern_tags(tags)
         key = (tags, device_name)
 
         # Never seen this metric
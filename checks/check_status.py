@@ -461,12 +461,18 @@ class DogstatsdStatus(AgentStatus):
     NAME = 'Dogstatsd'
 
     def __init__(self, flush_count=0, packet_count=0, packets_per_second=0,
-        metric_count=0):
+        metric_count=0, parse_error_count=0, kernel_drops=None, context_count=0,
+        flush_duration=0, memory=None):
         AgentStatus.__init__(self)
         self.flush_count = flush_count
         self.packet_count = packet_count
         self.packets_per_second = packets_per_second
         self.metric_count = metric_count
+        self.parse_error_count = parse_error_count
+        self.kernel_drops = kernel_drops
+        self.context_count = context_count
+        self.flush_duration = flush_duration
+        self.memory = memory
 
     def has_error(self):
         return self.flush_count == 0 and self.packet_count == 0 and self.metric_count == 0
@@ -477,7 +483,14 @@ class DogstatsdStatus(AgentStatus):
             "Packet Count: %s" % self.packet_count,
             "Packets per second: %s" % self.packets_per_second,
             "Metric count: %s" % self.metric_count,
+            "Parse errors: %s" % self.parse_error_count,
+            "Context count: %s" % self.context_count,
+            "Last flush duration: %sms" % self.flush_duration,
         ]
+        if self.kernel_drops is not None:
+            lines.append("Packets dropped by the kernel: %s" % self.kernel_drops)
+        if self.memory is not None:
+            lines.append("Memory (RSS): %.1fMB" % (self.memory / 1024.0 / 1024))
         return lines
 
     def to_dict(self):
@@ -487,6 +500,11 @@ class DogstatsdStatus(AgentStatus):
             'packet_count': self.packet_count,
             'packets_per_second': self.packets_per_second,
             'metric_count': self.metric_count,
+            'parse_error_count': self.parse_error_count,
+            'kernel_drops': self.kernel_drops,
+            'context_count': self.context_count,
+            'flush_duration': self.flush_duration,
+            'memory': self.memory,
         })
         return status_info
 
@@ -495,17 +513,22 @@ class ForwarderStatus(AgentStatus):
 
     NAME = 'Forwarder'
 
-    def __init__(self, queue_length=0, queue_size=0, flush_count=0):
+    def __init__(self, queue_length=0, queue_size=0, flush_count=0,
+        evicted_count=0, evicted_size=0):
         AgentStatus.__init__(self)
         self.queue_length = queue_length
         self.queue_size = queue_size
         self.flush_count = flush_count
+        self.evicted_count = evicted_count
+        self.evicted_size = evicted_size
 
     def body_lines(self):
         lines = [
             "Queue Size: %s" % self.queue_size,
             "Queue Length: %s" % self.queue_length,
             "Flush Count: %s" % self.flush_count,
+            "Evicted Transactions: %s (%s bytes)" % (self.evicted_count,
+                self.evicted_size),
         ]
         return lines
 
@@ -518,5 +541,7 @@ class ForwarderStatus(AgentStatus):
             'flush_count': self.flush_count,
             'queue_length': self.queue_length,
             'queue_size': self.queue_size,
+            'evicted_count': self.evicted_count,
+            'evicted_size': self.evicted_size,
         })
         return status_info
@@ -21,6 +21,7 @@ import logging
 import os
 import sys
 import threading
+import time
 import zlib
 from Queue import Queue, Full
 from subprocess import Popen
@@ -41,6 +42,7 @@ from emitter import http_emitter, format_body
 from config import get_config
 from checks.check_status import ForwarderStatus
 from transaction import Transaction, TransactionManager
+from diskqueue import Journal
 import modules
 
 log = logging.getLogger('forwarder')
@@ -55,8 +57,25 @@ MAX_WAIT_FOR_REPLAY = timedelta(seconds=90)
 # Maximum queue size in bytes (when this is reached, old messages are dropped)
 MAX_QUEUE_SIZE = 30 * 1024 * 1024 # 30MB
 
+# Maximum queue size in bytes when the payloads are kept in a journal on disk
+MAX_JOURNAL_SIZE = 1024 * 1024 * 1024 # 1GB
+
 THROTTLING_DELAY = timedelta(microseconds=1000000/2) # 2 msg/second
 
+# Number of transactions waiting for a response at the same time (one window
+# for all the endpoints, freed by the response of dd_url)
+MAX_IN_FLIGHT = 4
+
+# Throttle on the bytes sent (0 falls back to THROTTLING_DELAY)
+MAX_BYTES_PER_SECOND = 1024 * 1024 # 1MB/second
+
+# Seconds series posted to the forwarder wait for the ones posted right after,
+# to be sent in the same request
+BATCH_WINDOW = 1
+
+# Maximum bytes of series sent in one request
+MAX_BATCH_SIZE = 1024 * 1024 # 1MB
+
 class EmitterThread(threading.Thread):
 
     def __init__(self, *args, **kwargs):
@@ -122,6 +141,8 @@ class MetricTransaction(Transaction):
     _trManager = None
     _endpoints = []
     _emitter_manager = None
+    # Seconds to wait for other transactions to send along with this one
+    _batch_window = None
 
     @classmethod
     def set_application(cls, app):
@@ -156,24 +177,54 @@ class MetricTransaction(Transaction):
         except:
             log.info("Not a Datadog user")
 
-    def __init__(self, data, headers):
+    def __init__(self, data, headers, record=None):
         self._data = data
         self._headers = headers
+        replayed = record is not None
 
-        # Call after data has been set (size is computed in Transaction's init)
         Transaction.__init__(self)
+        self._size = len(data) # Bytes of payload
 
-        # Emitters operate outside the regular transaction framework
-        if self._emitter_manager is not None:
+        # Emitters operate outside the regular transaction framework, and
+        # have seen replayed transactions already
+        if self._emitter_manager is not None and not replayed:
             self._emitter_manager.send(data, headers)
 
+        journal = self._trManager.get_journal()
+        if journal is not None:
+            if not replayed:
+                record = journal.append(self.dump(data, headers))
+            # Only keep the payload on disk
+            self._record = record
+            self._data = self._headers = None
+
         # Insert the transaction in the Manager
         self._trManager.append(self)
         log.debug("Created transaction %d" % self.get_id())
-        self._trManager.flush()
+        # Replayed transactions wait for the first flush
+        if not replayed:
+            if self._batch_window:
+                self._application.flush_later(self._batch_window)
+            else:
+                self._trManager.flush()
 
-    def __sizeof__(self):
-        return sys.getsizeof(self._data)
+    @classmethod
+    def dump(cls, data, headers):
+        """ The journal record of a transaction. """
+        return '%s\n%s\n%s' % (cls.__name__, json.dumps(dict(headers)), data)
+
+    @staticmethod
+    def load(record):
+        """ The class, data and headers of a transaction journal record. """
+        name, headers, data = record.split('\n', 2)
+        return TRANSACTION_CLASSES[name], data, json.loads(headers)
+
+    def get_payload(self):
+        """ The data and headers to send, read from the journal if needed. """
+        if self._record is None:
+            return self._data, self._headers
+        _, data, headers = self.load(self._trManager.get_journal().read(self._record))
+        return data, headers
 
     def get_url(self, endpoint):
         api_key = self._application._agentConfig.get('api_key')
@@ -182,7 +233,16 @@ class MetricTransaction(Transaction):
         return self._application._agentConfig[endpoint] + '/intake'
 
     def flush(self):
-        for endpoint in self._endpoints:
+        data, headers = self.get_payload()
+        self.send(data, headers, self.on_response)
+
+    def send(self, data, headers, callback, endpoints=None):
+        """ Post `data` to `endpoints` (all of them by default), calling
+        `callback` with the response of the one that matters. """
+        on_response = callback
+        if endpoints is None:
+            endpoints = self._endpoints
+        for endpoint in endpoints:
             url = self.get_url(endpoint)
             log.debug("Sending metrics to endpoint %s at %s" % (endpoint, url))
 
@@ -191,8 +251,8 @@ class MetricTransaction(Transaction):
             ssl_certificate = self._application._agentConfig.get('ssl_certificate', None)
 
             req = tornado.httpclient.HTTPRequest(url, method="POST",
-                body=self._data, 
-                headers=self._headers, 
+                body=data, 
+                headers=headers, 
                 # The settings below will just be used if we use the CurlAsyncHttpClient of tornado
                 # i.e. in case of connection using a proxy
                 proxy_host=proxy_settings['host'], 
@@ -216,7 +276,7 @@ class MetricTransaction(Transaction):
             # getting sent to pup, it's not a big deal.
             callback = lambda(x): None
             if len(self._endpoints) <= 1 or endpoint == 'dd_url':
-                callback = self.on_response
+                callback = on_response
 
             http.fetch(req, callback=callback)
 
@@ -229,9 +289,61 @@ class MetricTransaction(Transaction):
 
         self._trManager.flush_next()
 
+    def on_batch_response(self, response, batch):
+        if response.error:
+            log.error("Response: %s" % response)
+        for tr in [self] + batch:
+            if response.error:
+                self._trManager.tr_error(tr)
+            else:
+                self._trManager.tr_success(tr)
+
+        self._trManager.flush_next()
+
 
 class APIMetricTransaction(MetricTransaction):
 
+    # Dropped before the agent's own payloads when the queue is full, with
+    # the 'priority' eviction policy
+    _priority = -1
+
+    _batchable = True
+
+    @classmethod
+    def set_batch_window(cls, window):
+        cls._batch_window = window
+
+    def can_coalesce(self, tr):
+        return isinstance(tr, APIMetricTransaction)
+
+    def flush_batch(self, batch):
+        """ Send the series of this transaction and of `batch` as one
+        compressed payload. """
+        series = []
+        try:
+            for tr in [self] + batch:
+                data, headers = tr.get_payload()
+                if headers.get('Content-Encoding') == 'deflate':
+                    data = zlib.decompress(data)
+                series.extend(json_decode(data)['series'])
+        except (ValueError, TypeError, KeyError, zlib.error), e:
+            log.warn("Can't merge the series of transactions %s, sending them one by one: %s" % (
+                ', '.join(str(tr.get_id()) for tr in [self] + batch), e))
+            for tr in [self] + batch:
+                tr.flush()
+            return
+
+        data = json.dumps({'series': series})
+        on_response = lambda response: self.on_batch_response(response, batch)
+        # Pup gets plain json, the others a deflated copy
+        pup = [e for e in self._endpoints if e == 'pup_url']
+        others = [e for e in self._endpoints if e != 'pup_url']
+        if pup:
+            self.send(data, {'Content-Type': 'application/json'}, on_response, pup)
+        if others:
+            self.send(zlib.compress(data), {'Content-Type': 'application/json',
+                'Content-Encoding': 'deflate'}, on_response, others)
+
     def get_url(self, endpoint):
         config = self._application._agentConfig
         api_key = config['api_key']
@@ -241,7 +353,10 @@ class APIMetricTransaction(MetricTransaction):
         return url
 
     def get_data(self):
-        return self._data
+        return self.get_payload()[0]
+
+TRANSACTION_CLASSES = dict((cls.__name__, cls)
+    for cls in (MetricTransaction, APIMetricTransaction))
 
 
 class StatusHandler(tornado.web.RequestHandler):
@@ -303,9 +418,31 @@ class Application(tornado.web.Application):
         self._metrics = {}
         MetricTransaction.set_application(self)
         MetricTransaction.set_endpoints()
+
+        # Keep the payloads on disk, so that they survive restarts
+        self._journal = None
+        max_queue_size = MAX_QUEUE_SIZE
+        journal_dir = agentConfig.get('forwarder_journal_dir')
+        if journal_dir:
+            self._journal = Journal(journal_dir,
+                sync_interval=agentConfig.get('forwarder_journal_sync_interval'))
+            max_queue_size = int(agentConfig.get('forwarder_journal_max_size')
+                or MAX_JOURNAL_SIZE)
+
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
-            MAX_QUEUE_SIZE, THROTTLING_DELAY)
+            max_queue_size, THROTTLING_DELAY,
+            max_in_flight=agentConfig.get('forwarder_max_in_flight', MAX_IN_FLIGHT),
+            max_bytes_per_second=agentConfig.get('forwarder_max_bytes_per_second',
+                MAX_BYTES_PER_SECOND),
+            journal=self._journal,
+            eviction_policy=agentConfig.get('forwarder_eviction_policy'),
+            max_batch_size=agentConfig.get('forwarder_batch_max_size', MAX_BATCH_SIZE))
         MetricTransaction.set_tr_manager(self._tr_manager)
+        APIMetricTransaction.set_batch_window(
+            float(agentConfig.get('forwarder_batch_window', BATCH_WINDOW) or 0))
+        self._flush_scheduled = False
+        if self._journal is not None:
+            self.replay_journal()
 
         self._watchdog = None
         if watchdog:
@@ -313,6 +450,33 @@ class Application(tornado.web.Application):
             self._watchdog = Watchdog(watchdog_timeout,
                 max_mem_mb=agentConfig.get('limit_memory_consumption', None))
 
+    def replay_journal(self):
+        """ Queue again the transactions that weren't sent before the last
+        stop. """
+        records = self._journal.pending()
+        if records:
+            log.info("Replaying %s transaction%s from the journal" % (
+                len(records), len(records) > 1 and "s" or ""))
+        for record in records:
+            try:
+                cls, data, headers = MetricTransaction.load(self._journal.read(record))
+            except (ValueError, KeyError, IOError), e:
+                log.warn("Dropping unreadable transaction %s from the journal: %s" % (record, e))
+                self._journal.ack(record)
+                continue
+            cls(data, headers, record=record)
+
+    def flush_later(self, delay):
+        """ Flush the transactions in `delay` seconds, unless a flush is
+        scheduled already. """
+        if self._flush_scheduled:
+            return
+        self._flush_scheduled = True
+        def flush():
+            self._flush_scheduled = False
+            self._tr_manager.flush()
+        tornado.ioloop.IOLoop.instance().add_timeout(time.time() + delay, flush)
+
     def log_request(self, handler):
         """ Override the tornado logging method.
         If everything goes well, log level is DEBUG.
@@ -392,6 +556,8 @@ class Application(tornado.web.Application):
                 self._watchdog.reset()
             self._postMetrics()
             self._tr_manager.flush()
+            if self._journal is not None:
+                self._journal.sync()
 
         tr_sched = tornado.ioloop.PeriodicCallback(flush_trs,TRANSACTION_FLUSH_INTERVAL,
             io_loop = self.mloop)
@@ -413,6 +579,8 @@ class Application(tornado.web.Application):
         tr_sched.start()
 
         self.mloop.start()
+        if self._journal is not None:
+            self._journal.close()
         log.info("Stopped")
 
     def stop(self):
@@ -0,0 +1,412 @@
+"""
+A bounded first-in first-out queue of payloads, kept on disk so it survives
+restarts.
+
+The payloads are appended to segment files, each holding length-prefixed
+records. Every segment has an index file with the offset, length and
+timestamp of its records, which is all we need to read at startup (through
+mmap) to know what's queued. A head file records the position of the oldest
+record not consumed yet. Segments are deleted as soon as they've been
+consumed, or to stay under the size cap; records older than the age cap are
+skipped.
+
+A Journal keeps its records in the same segments, but they're consumed in any
+order: each segment has an acks file listing the records that have been
+acknowledged, and is deleted once they all are.
+"""
+
+# stdlib
+import logging
+import mmap
+import os
+import struct
+from time import time
+
+log = logging.getLogger(__name__)
+
+# Size past which we start a new segment, in bytes.
+SEGMENT_SIZE_DEFAULT = 4 * 1024 * 1024
+# Size of the whole queue past which the oldest segments are dropped.
+MAX_SIZE_DEFAULT = 64 * 1024 * 1024
+# Age past which records are dropped, in seconds.
+MAX_AGE_DEFAULT = 3600
+# Seconds between two fsyncs of a journal.
+SYNC_INTERVAL_DEFAULT = 1
+
+RECORD_HEADER = struct.Struct('>I')
+# offset, length, timestamp
+INDEX_ENTRY = struct.Struct('>QId')
+# index of an acknowledged record
+ACK_ENTRY = struct.Struct('>I')
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+ACKS_SUFFIX = '.ack'
+HEAD_FILE = 'head'
+
+
+class Segment(object):
+    """ A segment file and its index. """
+
+    def __init__(self, directory, segment_id):
+        self.id = segment_id
+        base = os.path.join(directory, '%020d' % segment_id)
+        self.path = base + SEGMENT_SUFFIX
+        self.index_path = base + INDEX_SUFFIX
+        self.count = 0
+        self.size = 0
+        self.last_timestamp = None
+        self.data_file = None
+        self.index_file = None
+
+    def load(self):
+        """ Read the number of records and the time of the last one from the
+        index, cutting whatever a crash may have left after the last complete
+        record and index entry. """
+        data_size = os.path.getsize(self.path)
+        index_size = os.path.getsize(self.index_path)
+        count = index_size / INDEX_ENTRY.size
+        size = 0
+        while count:
+            offset, length, timestamp = self.entry(count - 1)
+            end = offset + RECORD_HEADER.size + length
+            if end <= data_size:
+                self.last_timestamp = timestamp
+                size = end
+                break
+            count -= 1
+        self.count = count
+        self.size = size
+
+        if index_size != count * INDEX_ENTRY.size or data_size != size:
+            log.warn("Truncating segment %s after its last complete record" % self.path)
+            for path, length in ((self.path, size),
+                    (self.index_path, count * INDEX_ENTRY.size)):
+                f = open(path, 'r+b')
+                try:
+                    f.truncate(length)
+                finally:
+                    f.close()
+
+    def entry(self, i):
+        """ The (offset, length, timestamp) of the i-th record. """
+        f = open(self.index_path, 'rb')
+        try:
+            index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size)
+            finally:
+                index.close()
+        finally:
+            f.close()
+
+    def read(self, i):
+        offset, length, _ = self.entry(i)
+        f = open(self.path, 'rb')
+        try:
+            f.seek(offset + RECORD_HEADER.size)
+            return f.read(length)
+        finally:
+            f.close()
+
+    def append(self, payload, timestamp):
+        if self.data_file is None:
+            self.data_file = open(self.path, 'ab')
+            self.index_file = open(self.index_path, 'ab')
+
+        self.data_file.write(RECORD_HEADER.pack(len(payload)) + payload)
+        self.data_file.flush()
+        self.index_file.write(INDEX_ENTRY.pack(self.size, len(payload), timestamp))
+        self.index_file.flush()
+        self.size += RECORD_HEADER.size + len(payload)
+        self.count += 1
+        self.last_timestamp = timestamp
+
+    def sync(self):
+        if self.data_file is not None:
+            os.fsync(self.data_file.fileno())
+            os.fsync(self.index_file.fileno())
+
+    def close(self):
+        if self.data_file is not None:
+            self.data_file.close()
+            self.index_file.close()
+            self.data_file = self.index_file = None
+
+    def delete(self):
+        self.close()
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class SegmentQueue(object):
+
+    def __init__(self, directory, max_size=None, max_age=None, segment_size=None):
+        self.directory = directory
+        self.max_size = int(max_size or MAX_SIZE_DEFAULT)
+        self.max_age = int(max_age or MAX_AGE_DEFAULT)
+        self.segment_size = min(int(segment_size or SEGMENT_SIZE_DEFAULT), self.max_size)
+        self.dropped = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.segments = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            segment = Segment(directory, int(name[:-len(SEGMENT_SUFFIX)]))
+            try:
+                segment.load()
+            except (OSError, IOError), e:
+                log.warn("Dropping unreadable segment %s: %s" % (segment.path, e))
+                segment.delete()
+                continue
+            self.segments.append(segment)
+        self.next_id = 0
+        if self.segments:
+            self.next_id = self.segments[-1].id + 1
+
+        # Index, in the first segment, of the oldest record not consumed yet.
+        self.head = 0
+        try:
+            f = open(os.path.join(directory, HEAD_FILE))
+            try:
+                segment_id, head = [int(v) for v in f.read().split()]
+            finally:
+                f.close()
+            if self.segments and self.segments[0].id == segment_id:
+                self.head = head
+        except (IOError, ValueError):
+            pass
+        self._cleanup()
+
+    def __len__(self):
+        return sum(s.count for s in self.segments) - self.head
+
+    def size(self):
+        return sum(s.size for s in self.segments)
+
+    def push(self, payload):
+        if not self.segments or self.segments[-1].size >= self.segment_size:
+            if self.segments:
+                self.segments[-1].close()
+            segment = Segment(self.directory, self.next_id)
+            self.next_id += 1
+            open(segment.path, 'wb').close()
+            open(segment.index_path, 'wb').close()
+            self.segments.append(segment)
+        self.segments[-1].append(payload, time())
+
+        # Make room by dropping the oldest segments.
+        while len(self.segments) > 1 and self.size() > self.max_size:
+            self.dropped += self.segments[0].count - self.head
+            self._drop_first()
+
+    def peek(self):
+        """ The oldest payload, or None if the queue is empty. """
+        self._cleanup()
+        if not self.segments:
+            return None
+        return self.segments[0].read(self.head)
+
+    def pop(self):
+        """ Remove the oldest payload, once it's been taken care of. """
+        if len(self):
+            self.head += 1
+            self._cleanup()
+            self._save_head()
+
+    def _cleanup(self):
+        """ Skip the records past their age and drop the consumed segments. """
+        expiry = time() - self.max_age
+        while self.segments:
+            first = self.segments[0]
+            if first.count and first.last_timestamp < expiry:
+                # Everything in this segment is too old.
+                self.dropped += first.count - self.head
+                self.head = first.count
+            while self.head < first.count and first.entry(self.head)[2] < expiry:
+                self.dropped += 1
+                self.head += 1
+            if self.head < first.count or first is self.segments[-1]:
+                break
+            self._drop_first()
+
+        if self.segments and self.head >= self.segments[0].count:
+            # Everything has been consumed: start over.
+            self._drop_first()
+
+    def _drop_first(self):
+        self.segments.pop(0).delete()
+        self.head = 0
+        self._save_head()
+
+    def _save_head(self):
+        segment_id = -1
+        if self.segments:
+            segment_id = self.segments[0].id
+        path = os.path.join(self.directory, HEAD_FILE)
+        f = open(path + '.tmp', 'w')
+        try:
+            f.write('%s %s' % (segment_id, self.head))
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+class Journal(object):
+    """ Records kept on disk until they're acknowledged, so that the ones
+    that weren't can be replayed after a restart. Records are identified by
+    the (segment id, index) returned by append. Writes are flushed to the
+    system right away but only synced to disk every `sync_interval`
+    seconds, or on `sync()`. """
+
+    def __init__(self, directory, segment_size=None, sync_interval=None):
+        self.directory = directory
+        self.segment_size = int(segment_size or SEGMENT_SIZE_DEFAULT)
+        if sync_interval is None:
+            sync_interval = SYNC_INTERVAL_DEFAULT
+        self.sync_interval = float(sync_interval)
+        self.last_sync = time()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.segments = {}
+        self.acked = {} # segment id -> indexes of its acknowledged records
+        self.ack_files = {}
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            segment = Segment(directory, int(name[:-len(SEGMENT_SUFFIX)]))
+            try:
+                segment.load()
+                self.acked[segment.id] = set(i for i in self._load_acks(segment)
+                    if i < segment.count)
+            except (OSError, IOError), e:
+                log.warn("Dropping unreadable segment %s: %s" % (segment.path, e))
+                self._delete(segment)
+                continue
+            self.segments[segment.id] = segment
+        self.next_id = 0
+        if self.segments:
+            self.next_id = max(self.segments) + 1
+        self.current = None # Segment we append to
+
+        for segment in self.segments.values():
+            self._cleanup(segment)
+
+    def _acks_path(self, segment):
+        return segment.path[:-len(SEGMENT_SUFFIX)] + ACKS_SUFFIX
+
+    def _load_acks(self, segment):
+        acked = set()
+        try:
+            f = open(self._acks_path(segment), 'rb')
+        except IOError:
+            return acked
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        for offset in xrange(0, len(data) - ACK_ENTRY.size + 1, ACK_ENTRY.size):
+            acked.add(ACK_ENTRY.unpack_from(data, offset)[0])
+        return acked
+
+    def __len__(self):
+        return sum(s.count - len(self.acked[s.id]) for s in self.segments.itervalues())
+
+    def size(self):
+        return sum(s.size for s in self.segments.itervalues())
+
+    def pending(self):
+        """ The ids of the records not acknowledged yet, oldest first. """
+        records = []
+        for segment_id in sorted(self.segments):
+            acked = self.acked[segment_id]
+            records.extend((segment_id, i)
+                for i in xrange(self.segments[segment_id].count) if i not in acked)
+        return records
+
+    def append(self, payload):
+        if self.current is None or self.current.size >= self.segment_size:
+            if self.current is not None:
+                self.current.sync()
+                self.current.close()
+                previous, self.current = self.current, None
+                self._cleanup(previous)
+            segment = Segment(self.directory, self.next_id)
+            self.next_id += 1
+            open(segment.path, 'wb').close()
+            open(segment.index_path, 'wb').close()
+            self.segments[segment.id] = segment
+            self.acked[segment.id] = set()
+            self.current = segment
+        self.current.append(payload, time())
+        self._maybe_sync()
+        return (self.current.id, self.current.count - 1)
+
+    def read(self, record):
+        segment_id, i = record
+        return self.segments[segment_id].read(i)
+
+    def ack(self, record):
+        """ Forget about a record, once it's been taken care of. """
+        segment_id, i = record
+        segment = self.segments.get(segment_id)
+        if segment is None or i in self.acked[segment_id]:
+            return
+        self.acked[segment_id].add(i)
+        f = self.ack_files.get(segment_id)
+        if f is None:
+            f = self.ack_files[segment_id] = open(self._acks_path(segment), 'ab')
+        f.write(ACK_ENTRY.pack(i))
+        f.flush()
+        self._cleanup(segment)
+        self._maybe_sync()
+
+    def _cleanup(self, segment):
+        """ Delete `segment` if all its records were acknowledged. """
+        if segment is self.current or len(self.acked[segment.id]) < segment.count:
+            return
+        del self.segments[segment.id]
+        del self.acked[segment.id]
+        self._delete(segment)
+
+    def _delete(self, segment):
+        f = self.ack_files.pop(segment.id, None)
+        if f is not None:
+            f.close()
+        segment.delete()
+        try:
+            os.remove(self._acks_path(segment))
+        except OSError:
+            pass
+
+    def _maybe_sync(self):
+        if time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.current is not None:
+            self.current.sync()
+        for f in self.ack_files.itervalues():
+            os.fsync(f.fileno())
+        self.last_sync = time()
+
+    def close(self):
+        self.sync()
+        for segment in self.segments.itervalues():
+            segment.close()
+        for f in self.ack_files.itervalues():
+            f.close()
+        self.ack_files = {}
+        self.current = None
@@ -9,8 +9,10 @@ from config import initialize_logging; initialize_logging('dogstatsd')
 import os; os.umask(022)
 
 # stdlib
+import errno
 import httplib as http_client
 import logging
+import multiprocessing
 import optparse
 from random import randrange
 import re
@@ -21,11 +23,13 @@ import sys
 from time import time
 import threading
 from urllib import urlencode
+import zlib
 
 # project
-from aggregator import MetricsAggregator
+from aggregator import DoubleBufferedAggregator, MetricsAggregator, ShardedAggregator, CONTEXT_CACHE_SIZE_DEFAULT, HISTOGRAM_AGGREGATES
 from checks.check_status import DogstatsdStatus
-from config import get_config
+from diskqueue import SegmentQueue
+from config import get_config, _is_affirmative
 from daemon import Daemon
 from util import json, PidFile, get_hostname
 
@@ -34,24 +38,177 @@ log = logging.getLogger('dogstatsd')
 
 WATCHDOG_TIMEOUT = 120
 UDP_SOCKET_TIMEOUT = 5
+UDP_BUFFER_SIZE = 1024
 LOGGING_INTERVAL = 10
 
+# Maximum number of datagrams read in one go when draining the socket, so a
+# constant stream of packets can't keep us from ever checking `running`.
+MAX_DRAIN_BATCH_SIZE = 1000
+
+# How long the reporter waits for a worker process to hand over its partial
+# aggregates before giving up on it for this flush.
+WORKER_COLLECT_TIMEOUT = 5
+
+# Python 2 doesn't expose SO_REUSEPORT; this is its value on Linux (>= 3.9).
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# Permissions of the unix socket: clients only need to write to it.
+SOCKET_MODE = 0622
+
+# Uncompressed size past which a flush is split into several payloads.
+MAX_PAYLOAD_SIZE = 2 * 1024 * 1024
+
+# Number of series serialized at once when flushing.
+SERIALIZE_BATCH_SIZE = 1000
+
+# Timeouts of the submission to the API, in seconds.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 20
+
+# Number of spilled payloads resent at most after each flush, and the longest
+# we wait before trying again when that fails, in seconds.
+REPLAY_BATCH_SIZE = 10
+REPLAY_BACKOFF_MAX = 300
+
 def serialize(metrics):
     return json.dumps({"series" : metrics})
 
+def udp_drops(port):
+    """ Number of datagrams the kernel dropped for lack of room in the
+    receive buffer of the udp sockets bound to `port` (None if we can't
+    tell, i.e. not on Linux). """
+    try:
+        f = open('/proc/net/udp')
+    except IOError:
+        return None
+    try:
+        lines = f.readlines()[1:]
+    finally:
+        f.close()
+    drops = 0
+    for line in lines:
+        fields = line.split()
+        # local_address is ADDRESS:PORT in hex, drops is the last field.
+        if int(fields[1].split(':')[1], 16) == port:
+            drops += int(fields[-1])
+    return drops
+
+def process_rss():
+    """ Resident memory of this process in bytes (None if not on Linux). """
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    finally:
+        f.close()
+
+class SeriesWriter(object):
+    """
+    Serializes series into payloads of at most `max_size` bytes (before
+    compression) as they're written, deflating them along the way if asked
+    to. A flush written through it never holds more than a batch of series
+    and the payloads, rather than every series and their serialization.
+    """
+
+    PREFIX = '{"series": ['
+    SEPARATOR = ', '
+    SUFFIX = ']}'
+
+    def __init__(self, max_size, compress=False, batch_size=None):
+        self.max_size = max_size
+        self.compress = compress
+        self.batch_size = int(batch_size or SERIALIZE_BATCH_SIZE)
+        self.batch = []
+        self.payloads = []
+        # Number of series written, and seconds spent serializing them.
+        self.count = 0
+        self.duration = 0
+
+        # The payload being built.
+        self.parts = []
+        self.size = 0
+        self.compressor = None
+
+    def write(self, series):
+        self.batch.extend(series)
+        if len(self.batch) >= self.batch_size:
+            self._serialize_batch()
+
+    def close(self):
+        """ Return the payloads. """
+        self._serialize_batch()
+        self._end_payload()
+        return self.payloads
+
+    def _serialize_batch(self):
+        if not self.batch:
+            return
+        start_time = time()
+        batch, self.batch = self.batch, []
+        self.count += len(batch)
+        self._add(batch)
+        self.duration += time() - start_time
+
+    def _add(self, batch):
+        # The series of the batch, without the brackets around them.
+        fragment = json.dumps(batch)[1:-1]
+        if self.size and \
+                self.size + len(self.SEPARATOR) + len(fragment) + len(self.SUFFIX) > self.max_size:
+            self._end_payload()
+        if not self.size and len(batch) > 1 and \
+                len(self.PREFIX) + len(fragment) + len(self.SUFFIX) > self.max_size:
+            # Too big for a payload (a single series bigger than that gets a
+            # payload of its own).
+            half = len(batch) / 2
+            self._add(batch[:half])
+            self._add(batch[half:])
+            return
+
+        if self.size:
+            part = self.SEPARATOR + fragment
+        else:
+            part = self.PREFIX + fragment
+            if self.compress:
+                self.compressor = zlib.compressobj()
+        self.size += len(part)
+        if self.compress:
+            part = self.compressor.compress(part)
+        self.parts.append(part)
+
+    def _end_payload(self):
+        if not self.size:
+            return
+        if self.compress:
+            self.parts.append(self.compressor.compress(self.SUFFIX) + self.compressor.flush())
+        else:
+            self.parts.append(self.SUFFIX)
+        self.payloads.append(''.join(self.parts))
+        self.parts = []
+        self.size = 0
+        self.compressor = None
+
 class Reporter(threading.Thread):
     """
     The reporter periodically sends the aggregated metrics to the
     server.
     """
 
-    def __init__(self, interval, metrics_aggregator, api_host, api_key=None, use_watchdog=False):
+    def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
+                 use_watchdog=False, collector=None, compress=True,
+                 max_payload_size=None, connect_timeout=None, read_timeout=None,
+                 spool=None, server=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
         self.metrics_aggregator = metrics_aggregator
         self.flush_count = 0
 
+        # Called before each flush to gather metrics aggregated elsewhere
+        # (e.g. in worker processes) into `metrics_aggregator`.
+        self.collector = collector
+
         self.watchdog = None
         if use_watchdog:
             from util import Watchdog
@@ -69,6 +226,26 @@ class Reporter(threading.Thread):
             if match.group(1) == 'http':
                 self.http_conn_cls = http_client.HTTPConnection
 
+        self.compress = compress
+        self.max_payload_size = int(max_payload_size or MAX_PAYLOAD_SIZE)
+        self.connect_timeout = float(connect_timeout or CONNECT_TIMEOUT)
+        self.read_timeout = float(read_timeout or READ_TIMEOUT)
+
+        # Kept alive from one flush to the next.
+        self.conn = None
+
+        # A SegmentQueue the payloads we failed to submit are spilled to, to
+        # be resent once the endpoint is back.
+        self.spool = spool
+        self.replay_backoff = 0
+        self.next_replay = 0
+
+        # For our own metrics and status.
+        self.server = server
+        self.kernel_drops = None
+        self.parse_error_count = 0
+        self.flush_duration = 0
+
     def stop(self):
         log.info("Stopping reporter")
         self.finished.set()
@@ -83,23 +260,67 @@ class Reporter(threading.Thread):
 
         while not self.finished.isSet(): # Use camel case isSet for 2.4 support.
             self.finished.wait(self.interval)
+            if self.collector is not None:
+                self.collector()
             self.metrics_aggregator.send_packet_count('datadog.dogstatsd.packet.count')
+            self.send_telemetry()
             self.flush()
             if self.watchdog:
                 self.watchdog.reset()
 
+        self._close()
+
         # Clean up the status messages.
         log.debug("Stopped reporter")
         DogstatsdStatus.remove_latest_status()
 
+    def send_telemetry(self):
+        """ Submit dogstatsd's own metrics, to be flushed with the others. """
+        aggregator = self.metrics_aggregator
+        stats = aggregator.flush_stats()
+        for mtype, count in stats['metric_types'].iteritems():
+            aggregator.gauge('datadog.dogstatsd.metric.count', count,
+                tags=['metric_type:%s' % mtype])
+        for reason, count in stats['parse_errors'].iteritems():
+            aggregator.gauge('datadog.dogstatsd.parse_errors', count,
+                tags=['reason:%s' % reason])
+            self.parse_error_count += count
+        for reason, count in stats['cardinality_trips'].iteritems():
+            aggregator.gauge('datadog.dogstatsd.cardinality.trips', count,
+                tags=['reason:%s' % reason])
+        # The metric names that created the most contexts.
+        for name, count in stats['new_contexts'].iteritems():
+            aggregator.gauge('datadog.dogstatsd.cardinality.new_contexts', count,
+                tags=['metric_name:%s' % name])
+
+        aggregator.gauge('datadog.dogstatsd.contexts', aggregator.context_count())
+        rss = process_rss()
+        if rss is not None:
+            aggregator.gauge('datadog.dogstatsd.memory.rss', rss)
+
+        if self.server is not None:
+            drops = self.server.kernel_drops()
+            if drops is not None:
+                if self.kernel_drops is not None:
+                    aggregator.gauge('datadog.dogstatsd.udp.drops',
+                        max(drops - self.kernel_drops, 0))
+                self.kernel_drops = drops
+
     def flush(self):
         try:
             self.flush_count += 1
             packets_per_second = self.metrics_aggregator.packets_per_second(self.interval)
             packet_count = self.metrics_aggregator.total_count
 
-            metrics = self.metrics_aggregator.flush()
-            count = len(metrics)
+            # Serialize the metrics as they're rolled up.
+            start_time = time()
+            writer = SeriesWriter(self.max_payload_size, self.compress)
+            self.metrics_aggregator.flush_to(writer.write)
+            writer.close()
+            self.flush_duration = round((time() - start_time - writer.duration) * 1000.0, 4)
+            self.metrics_aggregator.histogram('datadog.dogstatsd.flush.latency',
+                self.flush_duration)
+            count = writer.count
             should_log = self.flush_count < LOGGING_INTERVAL or self.flush_count % LOGGING_INTERVAL == 0
             if not count:
                 if should_log:
@@ -107,7 +328,8 @@ class Reporter(threading.Thread):
             else:
                 if should_log:
                     log.info("Flush #%s: flushing %s metrics" % (self.flush_count, count))
-                self.submit(metrics)
+                self.submit_series(writer)
+            self.replay()
 
             # Persist a status message.
             packet_count = self.metrics_aggregator.total_count
@@ -115,59 +337,193 @@ class Reporter(threading.Thread):
                 flush_count=self.flush_count,
                 packet_count=packet_count,
                 packets_per_second=packets_per_second,
-                metric_count=count).persist()
+                metric_count=count,
+                parse_error_count=self.parse_error_count,
+                kernel_drops=self.kernel_drops,
+                context_count=self.metrics_aggregator.context_count(),
+                flush_duration=self.flush_duration,
+                memory=process_rss()).persist()
 
         except:
             log.exception("Error flushing metrics")
 
     def submit(self, metrics):
+        writer = SeriesWriter(self.max_payload_size, self.compress)
+        writer.write(metrics)
+        return self.submit_series(writer)
+
+    def submit_series(self, writer):
+        """ Post the payloads of a SeriesWriter. """
         # HACK - Copy and pasted from dogapi, because it's a bit of a pain to distribute python
         # dependencies with the agent.
-        body = serialize(metrics)
         headers = {'Content-Type':'application/json'}
+        if self.compress:
+            headers['Content-Encoding'] = 'deflate'
         method = 'POST'
+        url = self._series_url()
+
+        # Send every chunk even if one fails, then raise the first error.
+        error = None
+        total_duration = 0
+        payloads = writer.close()
+        self.metrics_aggregator.histogram('datadog.dogstatsd.serialize.latency',
+            round(writer.duration * 1000.0, 4))
+        for body in payloads:
+            start_time = time()
+            status = None
+            try:
+                status = self._post(url, body, headers)
+                if status >= 500:
+                    raise Exception("%s %s %s%s" % (status, method, self.api_host, url))
+            except Exception, e:
+                self.metrics_aggregator.increment('datadog.dogstatsd.submit.errors')
+                if error is None:
+                    error = e
+                if self.spool is not None:
+                    self._spill(body)
+            duration = round((time() - start_time) * 1000.0, 4)
+            total_duration += duration
+            log.debug("%s %s %s%s (%s bytes, %sms)" % (
+                            status, method, self.api_host, url, len(body), duration))
+            self.metrics_aggregator.histogram('datadog.dogstatsd.submit.latency', duration)
+            self.metrics_aggregator.increment('datadog.dogstatsd.submit.bytes', len(body))
+            self.metrics_aggregator.increment('datadog.dogstatsd.submit.payloads')
+
+        if error is not None:
+            raise error
+        return total_duration
+
+    def replay(self):
+        """ Resend the oldest spilled payloads, backing off exponentially
+        while the endpoint keeps failing. """
+        if self.spool is None or not len(self.spool) or time() < self.next_replay:
+            return
+
+        headers = {'Content-Type':'application/json', 'Content-Encoding': 'deflate'}
+        url = self._series_url()
+        replayed = 0
+        for _ in xrange(REPLAY_BATCH_SIZE):
+            body = self.spool.peek()
+            if body is None:
+                break
+            try:
+                status = self._post(url, body, headers)
+                if status >= 500:
+                    raise Exception("%s POST %s%s" % (status, self.api_host, url))
+            except Exception, e:
+                self.replay_backoff = min(max(self.replay_backoff * 2, self.interval),
+                    REPLAY_BACKOFF_MAX)
+                self.next_replay = time() + self.replay_backoff
+                log.warn("Could not resend spilled metrics (%s), retrying in %ss" % (
+                    e, self.replay_backoff))
+                break
+            # Other errors won't go away by retrying: drop the payload.
+            self.spool.pop()
+            self.replay_backoff = 0
+            replayed += 1
+
+        if replayed:
+            log.info("Resent %s spilled payloads, %s left" % (replayed, len(self.spool)))
+        self.metrics_aggregator.increment('datadog.dogstatsd.spool.replayed', replayed)
+        self.metrics_aggregator.gauge('datadog.dogstatsd.spool.payloads', len(self.spool))
+
+    def _spill(self, body):
+        if not self.compress:
+            body = zlib.compress(body)
+        try:
+            self.spool.push(body)
+        except (IOError, OSError):
+            log.exception("Could not spill metrics to %s" % self.spool.directory)
+        self.metrics_aggregator.increment('datadog.dogstatsd.spool.spilled')
 
+    def _series_url(self):
         params = {}
         if self.api_key:
             params['api_key'] = self.api_key
-        url = '/api/v1/series?%s' % urlencode(params)
-
-        start_time = time()
-        status = None
-        conn = self.http_conn_cls(self.api_host)
+        return '/api/v1/series?%s' % urlencode(params)
+
+    def _connect(self):
+        conn = self.http_conn_cls(self.api_host, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _post(self, url, body, headers):
+        """ POST `body` on the kept-alive connection and return the response
+        status. Reconnects once if the connection was closed on the other
+        end while it was idle. """
+        reused = self.conn is not None
+        if not reused:
+            self.conn = self._connect()
         try:
-            conn.request(method, url, body, headers)
-
-            #FIXME: add timeout handling code here
-
-            response = conn.getresponse()
-            status = response.status
-            response.close()
-        finally:
-            conn.close()
-        duration = round((time() - start_time) * 1000.0, 4)
-        log.debug("%s %s %s%s (%sms)" % (
-                        status, method, self.api_host, url, duration))
-        return duration
+            self.conn.request('POST', url, body, headers)
+            response = self.conn.getresponse()
+            # The response must be read entirely to reuse the connection.
+            response.read()
+        except socket.timeout:
+            self._close()
+            raise
+        except (socket.error, http_client.HTTPException):
+            self._close()
+            if not reused:
+                raise
+            return self._post(url, body, headers)
+
+        if response.will_close:
+            self._close()
+        return response.status
 
 class Server(object):
     """
-    A statsd udp server.
+    A statsd udp server, optionally also listening on a unix datagram socket.
     """
 
-    def __init__(self, metrics_aggregator, host, port):
+    def __init__(self, metrics_aggregator, host, port, buffer_size=None,
+                 so_rcvbuf=None, drain_socket=False, reuse_port=False,
+                 socket_path=None, socket_mode=None):
         self.host = host
         self.port = int(port)
         self.address = (self.host, self.port)
         self.metrics_aggregator = metrics_aggregator
-        self.buffer_size = 1024
+        self.buffer_size = int(buffer_size or UDP_BUFFER_SIZE)
+        self.drain_socket = drain_socket
 
         # IPv4 only
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setblocking(0)
+        if so_rcvbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(so_rcvbuf))
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+        # Local clients can send to a unix socket instead, which skips the
+        # IP stack and blocks them rather than dropping packets when we
+        # can't keep up.
+        self.socket_path = socket_path
+        self.socket_mode = SOCKET_MODE if socket_mode is None else socket_mode
+        self.unix_socket = None
+        if socket_path:
+            self.unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.unix_socket.setblocking(0)
+            if so_rcvbuf:
+                self.unix_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(so_rcvbuf))
+
+        # Other file-like objects watched by the select loop, with the
+        # callback to run when they are readable.
+        self.readers = {}
 
         self.running = False
 
+    def add_reader(self, reader, callback):
+        """ Call `callback` whenever `reader` (anything with a fileno()) is
+        readable. """
+        self.readers[reader] = callback
+
     def start(self):
         """ Run the server. """
         # Bind to the UDP socket.
@@ -175,11 +531,30 @@ class Server(object):
 
         log.info('Listening on host & port: %s' % str(self.address))
 
+        unix_socket = self.unix_socket
+        unix_recv = None
+        if unix_socket is not None:
+            # Replace the socket file left behind by a previous run.
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            unix_socket.bind(self.socket_path)
+            os.chmod(self.socket_path, self.socket_mode)
+            log.info('Listening on unix socket: %s' % self.socket_path)
+            unix_recv = unix_socket.recv
+            if self.drain_socket:
+                unix_recv = lambda buffer_size: self.drain(buffer_size, unix_socket)
+
         # Inline variables for quick look-up.
         buffer_size = self.buffer_size
         aggregator_submit = self.metrics_aggregator.submit_packets
-        sock = [self.socket]
+        server_socket = self.socket
+        sock = [server_socket] + self.readers.keys()
+        if unix_socket is not None:
+            sock.append(unix_socket)
+        readers = self.readers
         socket_recv = self.socket.recv
+        if self.drain_socket:
+            socket_recv = self.drain
         select_select = select.select
         select_error = select.error
         timeout = UDP_SOCKET_TIMEOUT
@@ -189,8 +564,13 @@ class Server(object):
         while self.running:
             try:
                 ready = select_select(sock, [], [], timeout)
-                if ready[0]:
-                    aggregator_submit(socket_recv(buffer_size))
+                for reader in ready[0]:
+                    if reader is server_socket:
+                        aggregator_submit(socket_recv(buffer_size))
+                    elif reader is unix_socket:
+                        aggregator_submit(unix_recv(buffer_size))
+                    else:
+                        readers[reader]()
             except select_error, se:
                 # Ignore interrupted system calls from sigterm.
                 errno = se[0]
@@ -201,6 +581,208 @@ class Server(object):
             except Exception, e:
                 log.exception('Error receiving datagram')
 
+        if unix_socket is not None:
+            unix_socket.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def drain(self, buffer_size, sock=None):
+        """
+        Read datagrams from `sock` (the udp socket by default) until it would
+        block (or until we have MAX_DRAIN_BATCH_SIZE of them) and return them
+        as a single batch, one datagram per line.
+        """
+        datagrams = []
+        append = datagrams.append
+        socket_recv = (sock or self.socket).recv
+        try:
+            for _ in xrange(MAX_DRAIN_BATCH_SIZE):
+                append(socket_recv(buffer_size))
+        except socket.error, e:
+            if e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK) or not datagrams:
+                raise
+        return "\n".join(datagrams)
+
+    def kernel_drops(self):
+        return udp_drops(self.socket.getsockname()[1])
+
+    def stop(self):
+        self.running = False
+
+
+class ServerWorker(multiprocessing.Process):
+    """
+    A dogstatsd server running in its own process, with its own aggregator.
+    Several workers share the same port thanks to SO_REUSEPORT, and the
+    kernel spreads the datagrams between them. The parent process asks each
+    of them for its partial aggregates over a pipe before every flush.
+    """
+
+    def __init__(self, hostname, interval, host, port, aggregator_kwargs=None,
+                 server_kwargs=None):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+        self.hostname = hostname
+        self.interval = interval
+        self.host = host
+        self.port = port
+        self.aggregator_kwargs = aggregator_kwargs or {}
+        self.server_kwargs = server_kwargs or {}
+        self.conn, self.worker_conn = multiprocessing.Pipe()
+
+    def run(self):
+        # The parent handles ctrl-c and sigterm, and stops us through the pipe.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # Close our copy of the parent's end, so that we see it go away.
+        self.conn.close()
+
+        aggregator = MetricsAggregator(self.hostname, self.interval,
+            **self.aggregator_kwargs)
+        server = Server(aggregator, self.host, self.port, reuse_port=True,
+            **self.server_kwargs)
+        conn = self.worker_conn
+
+        def handle_command():
+            try:
+                command, seq = conn.recv()
+                if command == 'collect':
+                    count, metrics = aggregator.flush_partials()
+                    conn.send((seq, count, metrics, aggregator.flush_stats()))
+                elif command == 'stop':
+                    server.stop()
+            except (EOFError, IOError):
+                # The parent is gone: don't outlive it.
+                server.stop()
+
+        server.add_reader(conn, handle_command)
+        server.start()
+
+
+class MultiProcessServer(object):
+    """
+    A statsd udp server that spreads the parsing and aggregation of the
+    packets over several worker processes. `collect` merges what they
+    received into `metrics_aggregator`, which is then flushed as usual.
+    """
+
+    def __init__(self, metrics_aggregator, host, port, workers,
+                 aggregator_kwargs=None, socket_path=None, **server_kwargs):
+        self.host = host
+        self.port = int(port)
+        self.metrics_aggregator = metrics_aggregator
+        self.worker_count = int(workers)
+        self.aggregator_kwargs = aggregator_kwargs
+        self.server_kwargs = server_kwargs
+        # Only one process can listen on the unix socket: the first worker.
+        self.socket_path = socket_path
+        self.workers = []
+        # The pipes are used by both the reporter (collect) and the main
+        # thread (stop).
+        self.lock = threading.Lock()
+        self.running = False
+        # Number of the last collect request, which the workers send back
+        # with their reply.
+        self.collect_seq = 0
+
+    def _spawn_worker(self, index):
+        server_kwargs = self.server_kwargs
+        if index == 0 and self.socket_path:
+            server_kwargs = dict(server_kwargs, socket_path=self.socket_path)
+        worker = ServerWorker(self.metrics_aggregator.hostname,
+            self.metrics_aggregator.interval, self.host, self.port,
+            self.aggregator_kwargs, server_kwargs)
+        worker.start()
+        return worker
+
+    def spawn_workers(self):
+        """ Start the workers, if they aren't already. Call it before
+        starting any thread, so that the workers don't inherit them. """
+        self.lock.acquire()
+        try:
+            if not self.workers:
+                self.workers = [self._spawn_worker(i) for i in xrange(self.worker_count)]
+        finally:
+            self.lock.release()
+
+    def start(self):
+        """ Run the server. """
+        log.info('Listening on host & port: %s with %s worker processes' % (
+            str((self.host, self.port)), self.worker_count))
+        self.spawn_workers()
+
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    select.select([], [], [], UDP_SOCKET_TIMEOUT)
+                except select.error:
+                    # Interrupted by sigterm.
+                    continue
+                except (KeyboardInterrupt, SystemExit):
+                    break
+
+                # Respawn the workers that died.
+                self.lock.acquire()
+                try:
+                    for i, worker in enumerate(self.workers):
+                        if self.running and not worker.is_alive():
+                            log.error('Worker %s exited with code %s, restarting it' % (
+                                worker.pid, worker.exitcode))
+                            self.workers[i] = self._spawn_worker(i)
+                finally:
+                    self.lock.release()
+        finally:
+            self._stop_workers()
+
+    def _stop_workers(self):
+        self.lock.acquire()
+        try:
+            for worker in self.workers:
+                try:
+                    worker.conn.send(('stop', None))
+                except Exception:
+                    pass
+            for worker in self.workers:
+                worker.join(UDP_SOCKET_TIMEOUT)
+                if worker.is_alive():
+                    worker.terminate()
+            self.workers = []
+        finally:
+            self.lock.release()
+
+    def collect(self):
+        """ Merge the partial aggregates of every worker into our
+        aggregator. """
+        self.lock.acquire()
+        try:
+            self.collect_seq += 1
+            seq = self.collect_seq
+            workers = [w for w in self.workers if w.is_alive()]
+            for worker in workers:
+                worker.conn.send(('collect', seq))
+            for worker in workers:
+                # A worker that missed a previous collect has its late reply
+                # queued before this one. It holds what the worker received
+                # before then and nothing since, so merge it too (late rather
+                # than lost) and keep reading until the reply to this request.
+                while True:
+                    if not worker.conn.poll(WORKER_COLLECT_TIMEOUT):
+                        log.warn('Worker %s did not send its metrics in time' % worker.pid)
+                        break
+                    reply_seq, count, metrics, stats = worker.conn.recv()
+                    self.metrics_aggregator.merge(count, metrics)
+                    self.metrics_aggregator.merge_stats(stats)
+                    if reply_seq == seq:
+                        break
+        finally:
+            self.lock.release()
+
+    def kernel_drops(self):
+        return udp_drops(self.port)
+
     def stop(self):
         self.running = False
 
@@ -218,6 +800,10 @@ class Dogstatsd(Daemon):
         log.info("Adding sig handler")
         signal.signal(signal.SIGTERM, self._handle_sigterm)
         signal.signal(signal.SIGINT, self._handle_sigterm)
+        # Fork the workers before the reporter thread exists, so that they
+        # don't inherit its state or locks.
+        if isinstance(self.server, MultiProcessServer):
+            self.server.spawn_workers()
         self.reporter.start()
         try:
             try:
@@ -241,6 +827,52 @@ class Dogstatsd(Daemon):
         return DogstatsdStatus.print_latest_status()
 
 
+def parse_histogram_aggregates(value):
+    """ 'max, median' -> ['max', 'median'] """
+    aggregates = []
+    for aggregate in value.split(','):
+        aggregate = aggregate.strip()
+        if aggregate in HISTOGRAM_AGGREGATES:
+            aggregates.append(aggregate)
+        elif aggregate:
+            log.warn("Ignoring unknown histogram aggregate: %s" % aggregate)
+    return aggregates
+
+def parse_histogram_percentiles(value):
+    """ '0.95, 0.99' -> [0.95, 0.99] """
+    percentiles = []
+    for raw in value.split(','):
+        try:
+            percentile = float(raw)
+            assert 0 < percentile < 1
+        except (ValueError, AssertionError):
+            if raw.strip():
+                log.warn("Ignoring invalid histogram percentile: %s" % raw)
+        else:
+            percentiles.append(percentile)
+    return percentiles
+
+def parse_prefixes(value, parse):
+    """ 'api.=x,y; db.=z' -> [('api.', parse('x,y')), ('db.', parse('z'))] """
+    prefixes = []
+    for entry in value.split(';'):
+        if '=' not in entry:
+            if entry.strip():
+                log.warn("Ignoring invalid prefix setting: %s" % entry)
+            continue
+        prefix, setting = entry.split('=', 1)
+        prefixes.append((prefix.strip(), parse(setting)))
+    return prefixes
+
+def get_histogram_prefix_options(c):
+    options = {}
+    for key, name, parse in [
+            ('dogstatsd_histogram_aggregates_by_prefix', 'aggregates', parse_histogram_aggregates),
+            ('dogstatsd_histogram_percentiles_by_prefix', 'percentiles', parse_histogram_percentiles)]:
+        for prefix, setting in parse_prefixes(c.get(key, ''), parse):
+            options.setdefault(prefix, {})[name] = setting
+    return options.items()
+
 def init(config_path=None, use_watchdog=False, use_forwarder=False):
     c = get_config(parse_args=False, cfg_path=config_path)
     log.debug("Configuration dogstatsd")
@@ -261,10 +893,30 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False):
     # server and reporting threads.
     assert 0 < interval
 
-    aggregator = MetricsAggregator(hostname, interval, recent_point_threshold=c.get('recent_point_threshold', None))
-
-    # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog)
+    aggregator_kwargs = {
+        'recent_point_threshold': c.get('recent_point_threshold', None),
+        'context_cache_size': c.get('dogstatsd_context_cache_size', CONTEXT_CACHE_SIZE_DEFAULT),
+        'histogram_sketch': _is_affirmative(c.get('dogstatsd_histogram_sketch', 'no')),
+        'sketch_relative_accuracy': c.get('dogstatsd_sketch_relative_accuracy'),
+        'histogram_aggregates': parse_histogram_aggregates(c.get('dogstatsd_histogram_aggregates', '')),
+        'histogram_percentiles': parse_histogram_percentiles(c.get('dogstatsd_histogram_percentiles', '')),
+        'histogram_prefix_options': get_histogram_prefix_options(c),
+        'hll_set_prefixes': [p.strip() for p in c.get('dogstatsd_hll_set_prefixes', '').split(',') if p.strip()],
+        'hll_precision': c.get('dogstatsd_hll_precision'),
+        'max_contexts': c.get('dogstatsd_max_contexts'),
+        'max_contexts_per_name': c.get('dogstatsd_max_contexts_per_metric'),
+        'cardinality_overflow': c.get('dogstatsd_cardinality_overflow', 'fold'),
+    }
+    double_buffer = _is_affirmative(c.get('dogstatsd_double_buffer', 'yes'))
+    shards = int(c.get('dogstatsd_shards', 1))
+    if shards > 1:
+        aggregator = ShardedAggregator(hostname, interval, shards=shards,
+            processes=c.get('dogstatsd_shard_processes'),
+            double_buffer=double_buffer, **aggregator_kwargs)
+    elif double_buffer:
+        aggregator = DoubleBufferedAggregator(hostname, interval, **aggregator_kwargs)
+    else:
+        aggregator = MetricsAggregator(hostname, interval, **aggregator_kwargs)
 
     # Start the server on an IPv4 stack
     # Default to loopback
@@ -273,7 +925,37 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False):
     if non_local_traffic:
         server_host = ''
 
-    server = Server(aggregator, server_host, port)
+    server_kwargs = {
+        'buffer_size': c.get('dogstatsd_buffer_size'),
+        'so_rcvbuf': c.get('dogstatsd_so_rcvbuf'),
+        'drain_socket': _is_affirmative(c.get('dogstatsd_drain_socket', 'no')),
+        'socket_path': c.get('dogstatsd_socket') or None,
+    }
+    if c.get('dogstatsd_socket_mode'):
+        server_kwargs['socket_mode'] = int(str(c['dogstatsd_socket_mode']), 8)
+
+    workers = int(c.get('dogstatsd_workers', 1))
+    collector = None
+    if workers > 1:
+        server = MultiProcessServer(aggregator, server_host, port, workers,
+            aggregator_kwargs, **server_kwargs)
+        collector = server.collect
+    else:
+        server = Server(aggregator, server_host, port, **server_kwargs)
+
+    spool = None
+    spool_dir = c.get('dogstatsd_spool_dir')
+    if spool_dir:
+        spool = SegmentQueue(spool_dir, c.get('dogstatsd_spool_max_size'),
+            c.get('dogstatsd_spool_max_age'))
+
+    # Start the reporting thread.
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, collector,
+        compress=_is_affirmative(c.get('dogstatsd_compress', 'yes')),
+        max_payload_size=c.get('dogstatsd_max_payload_size'),
+        connect_timeout=c.get('dogstatsd_connect_timeout'),
+        read_timeout=c.get('dogstatsd_read_timeout'),
+        spool=spool, server=server)
 
     return reporter, server
 
@@ -214,7 +214,12 @@ class StatusHandler(tornado.web.RequestHandler):
 class PostHandler(tornado.web.RequestHandler):
     def post(self):
         try:
-            body = json.loads(self.request.body)
+            body = self.request.body
+            # Dogstatsd deflates its payloads, which the forwarder relays
+            # as they are.
+            if self.request.headers.get('Content-Encoding') == 'deflate':
+                body = zlib.decompress(body)
+            body = json.loads(body)
             series = body['series']
         except:
             #log.exception("Error parsing the POST request body")
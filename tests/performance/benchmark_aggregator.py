@@ -2,8 +2,10 @@
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
 
+import random
+import time
 
-from aggregator import MetricsAggregator
+from aggregator import MetricsAggregator, ShardedAggregator, CONTEXT_CACHE_SIZE_DEFAULT
 
 
 
@@ -41,6 +43,80 @@ class TestAggregatorPerf(object):
 
             ma.flush()
 
+    def test_dogstatsd_context_cache_perf(self):
+        packets = []
+        for j in xrange(self.METRIC_COUNT):
+            packets.append('counter.%s:%%s|c|#tag1,tag2' % j)
+            packets.append('gauge.%s:%%s|g|#tag2,tag1,tag3' % j)
+            packets.append('histogram.%s:%%s|h|@0.5|#tag1' % j)
+            packets.append('set.%s:%%s|s' % j)
+
+        for cache_size in (0, CONTEXT_CACHE_SIZE_DEFAULT):
+            ma = MetricsAggregator('my.host', context_cache_size=cache_size)
+            start = time.time()
+            for _ in xrange(self.FLUSH_COUNT):
+                for i in xrange(self.LOOPS_PER_FLUSH):
+                    for packet in packets:
+                        ma.submit_packets(packet % i)
+                ma.flush()
+            duration = time.time() - start
+
+            stats = ''
+            if ma.context_cache is not None:
+                stats = ' (%s hits, %s misses)' % (ma.context_cache.hits,
+                    ma.context_cache.misses)
+            print "context cache size %s: %s packets in %.2fs, %.2fus/packet%s" % (
+                cache_size, ma.total_count, duration,
+                duration * 1e6 / ma.total_count, stats)
+
+    def test_dogstatsd_idle_contexts_flush_perf(self):
+        """ Flush time when most of the contexts are idle: only the sampled
+        ones (and the counters) should be visited. """
+        for idle_count in (10000, 100000):
+            ma = MetricsAggregator('my.host')
+            for i in xrange(idle_count):
+                ma.submit_packets('idle.gauge.%s:1|g' % i)
+            ma.flush()
+
+            start = time.time()
+            for _ in xrange(self.FLUSH_COUNT):
+                for j in xrange(self.METRIC_COUNT):
+                    ma.submit_packets('gauge.%s:1|g' % j)
+                ma.flush()
+            duration = time.time() - start
+            print "%s idle contexts: %.2fms/flush" % (idle_count,
+                duration * 1e3 / self.FLUSH_COUNT)
+
+    def test_sharded_flush_perf(self):
+        """ Flush time of histogram heavy traffic with a single aggregator
+        vs shards flushed by threads, with and without a process pool. """
+        random.seed(1)
+        values = [random.random() for _ in xrange(50000)]
+        setups = [
+            ('1 aggregator', lambda: MetricsAggregator('my.host')),
+            ('4 shards', lambda: ShardedAggregator('my.host', shards=4)),
+            ('4 shards, 4 processes', lambda: ShardedAggregator('my.host',
+                shards=4, processes=4)),
+        ]
+        for name, make_aggregator in setups:
+            ma = make_aggregator()
+            try:
+                # Create the pools, if any.
+                ma.flush()
+                duration = 0
+                for _ in xrange(self.FLUSH_COUNT):
+                    for j in xrange(20):
+                        for v in values:
+                            ma.histogram('histogram.%s' % j, v)
+                    start = time.time()
+                    ma.flush()
+                    duration += time.time() - start
+            finally:
+                if hasattr(ma, 'close'):
+                    ma.close()
+            print "%s: 20 histograms of %s samples, %.2fms/flush" % (name,
+                len(values), duration * 1e3 / self.FLUSH_COUNT)
+
     def test_checksd_aggregation_perf(self):
         ma = MetricsAggregator('my.host')
 
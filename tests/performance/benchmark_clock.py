@@ -0,0 +1,56 @@
+"""
+Cost of reading the clock in the aggregator hot path: per sample, with one
+and many metrics per batch of packets (a multi-metric datagram, or the
+datagrams read in one go when draining the socket).
+"""
+
+import time
+import timeit
+
+from aggregator import MetricsAggregator
+
+
+class TestClockPerf(object):
+
+    SAMPLE_COUNT = 500000
+    METRICS_PER_DATAGRAM = [1, 20, 1000]
+
+    def test_clock_read(self):
+        count = 1000000
+        for name, stmt, setup in (
+                ('time()', 'time()', 'from time import time'),
+                ('clock.now', 'clock.now', 'from aggregator import clock')):
+            duration = timeit.timeit(stmt, setup, number=count)
+            print "%s: %.0fns" % (name, duration * 1e9 / count)
+
+    def test_sample_perf(self):
+        for per_datagram in self.METRICS_PER_DATAGRAM:
+            datagram = '\n'.join('metric.%s:1|c|#env:prod' % i
+                for i in xrange(per_datagram))
+            for mtype in ('c', 'g', 'h'):
+                ma = MetricsAggregator('my.host')
+                packets = datagram.replace('|c|', '|%s|' % mtype)
+                # Warm up the context cache: the packets take its fast path.
+                ma.submit_packets(packets)
+                start = time.time()
+                for _ in xrange(self.SAMPLE_COUNT / per_datagram):
+                    ma.submit_packets(packets)
+                duration = time.time() - start
+                print "%s metrics per datagram, %s: %.3fus/sample" % (
+                    per_datagram, mtype, duration * 1e6 / self.SAMPLE_COUNT)
+
+    def test_submit_metric_perf(self):
+        # Samples submitted one by one, as checks do.
+        ma = MetricsAggregator('my.host')
+        start = time.time()
+        for i in xrange(self.SAMPLE_COUNT):
+            ma.gauge('metric', i, tags=['env:prod'])
+        duration = time.time() - start
+        print "submit_metric: %.3fus/sample" % (duration * 1e6 / self.SAMPLE_COUNT)
+
+
+if __name__ == '__main__':
+    t = TestClockPerf()
+    t.test_clock_read()
+    t.test_sample_perf()
+    t.test_submit_metric_perf()
@@ -0,0 +1,104 @@
+"""
+Performance tests for the dogstatsd server receive loop.
+"""
+
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from aggregator import MetricsAggregator
+from dogstatsd import Server
+
+
+class TestServerPerf(object):
+
+    PACKET_COUNT = 200000
+    PACKETS = [
+        'counter.%s:1|c',
+        'gauge.%s:1|g|#tag1,tag2',
+        'histogram.%s:1|h|@0.5',
+        'set.%s:1|s',
+    ]
+
+    def _run(self, unix_socket=False, **server_kwargs):
+        aggregator = MetricsAggregator('my.host')
+        # Listen on an ephemeral port.
+        socket_path = None
+        if unix_socket:
+            socket_path = os.path.join(tempfile.mkdtemp(), 'dogstatsd.sock')
+        server = Server(aggregator, '127.0.0.1', 0, socket_path=socket_path,
+            **server_kwargs)
+
+        thread = threading.Thread(target=server.start)
+        thread.daemon = True
+        thread.start()
+        while not server.running:
+            time.sleep(0.01)
+        address = server.socket.getsockname()
+
+        packets = [p % (i % 10) for i in xrange(10) for p in self.PACKETS]
+        if unix_socket:
+            # The client blocks when the socket's queue is full.
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sendto = lambda packet, _: client.sendto(packet, socket_path)
+        else:
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sendto = client.sendto
+
+        start = time.time()
+        for i in xrange(self.PACKET_COUNT):
+            sendto(packets[i % len(packets)], address)
+
+        # Give the server a chance to catch up with what's left in the
+        # socket buffer.
+        received = -1
+        while received != aggregator.count:
+            received = aggregator.count
+            time.sleep(0.2)
+        duration = time.time() - start - 0.2
+
+        server.stop()
+        client.close()
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.sendto('', address)
+        thread.join()
+        client.close()
+        server.socket.close()
+        if socket_path:
+            os.rmdir(os.path.dirname(socket_path))
+
+        return received, duration
+
+    def _report(self, name, received, duration):
+        print "%s: received %s/%s packets (%.2f%% dropped) in %.2fs, %.0f packets/s" % (
+            name, received, self.PACKET_COUNT,
+            100.0 * (self.PACKET_COUNT - received) / self.PACKET_COUNT,
+            duration, received / duration)
+
+    def test_select_loop_perf(self):
+        received, duration = self._run()
+        self._report('select/recv per datagram', received, duration)
+
+    def test_drain_socket_perf(self):
+        received, duration = self._run(drain_socket=True,
+            so_rcvbuf=4 * 1024 * 1024)
+        self._report('drain socket', received, duration)
+
+    def test_unix_socket_perf(self):
+        received, duration = self._run(unix_socket=True)
+        self._report('unix socket, select/recv per datagram', received, duration)
+
+    def test_unix_socket_drain_perf(self):
+        received, duration = self._run(unix_socket=True, drain_socket=True,
+            so_rcvbuf=4 * 1024 * 1024)
+        self._report('unix socket, drain socket', received, duration)
+
+
+if __name__ == '__main__':
+    t = TestServerPerf()
+    t.test_select_loop_perf()
+    t.test_drain_socket_perf()
+    t.test_unix_socket_perf()
+    t.test_unix_socket_drain_perf()
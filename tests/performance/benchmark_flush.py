@@ -0,0 +1,61 @@
+"""
+Peak memory and time of a dogstatsd flush, serializing every series at the
+end vs streaming them into payloads as they're rolled up.
+"""
+
+import gc
+import time
+import zlib
+
+from aggregator import MetricsAggregator
+from benchmark_memory import rss_bytes
+from dogstatsd import MAX_PAYLOAD_SIZE, SeriesWriter, serialize
+
+
+class TestFlushPerf(object):
+
+    SERIES_COUNTS = [20000, 200000]
+
+    def _measure(self, count, mode):
+        ma = MetricsAggregator('my.host')
+        for i in xrange(count):
+            ma.submit_packets('metric.%s:1|g|#env:prod,role:%s,shard:%s' % (
+                i / 1000, i % 10, (i % 1000) / 10))
+        gc.collect()
+        before = rss_bytes()
+        start = time.time()
+        if mode == 'materialized':
+            metrics = ma.flush()
+            body = serialize(metrics)
+            # Cut like serialize_chunks used to, minus splitting the series.
+            payloads = [zlib.compress(body[i:i + MAX_PAYLOAD_SIZE])
+                for i in xrange(0, len(body), MAX_PAYLOAD_SIZE)]
+        else:
+            writer = SeriesWriter(MAX_PAYLOAD_SIZE, compress=True)
+            ma.flush_to(writer.write)
+            payloads = writer.close()
+        duration = time.time() - start
+        return rss_bytes() - before, duration, len(payloads)
+
+    def test_flush_peak_memory(self):
+        # Run each in a fresh process so that the peak RSS of one doesn't
+        # hide the next.
+        import multiprocessing
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            for count in self.SERIES_COUNTS:
+                for mode in ('materialized', 'streaming'):
+                    peak, duration, payloads = pool.apply(_measure, (self, count, mode))
+                    print "%s series, %s: peak +%.1f MB, %.0fms, %s payloads" % (
+                        count, mode, peak / 1048576.0, duration * 1000, payloads)
+        finally:
+            pool.terminate()
+
+
+def _measure(test, count, mode):
+    return test._measure(count, mode)
+
+
+if __name__ == '__main__':
+    t = TestFlushPerf()
+    t.test_flush_peak_memory()
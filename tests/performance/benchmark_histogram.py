@@ -0,0 +1,95 @@
+"""
+Performance tests for the exact and sketch-backed histograms: accuracy of
+the percentiles versus memory used and time spent.
+"""
+
+import random
+import sys
+import time
+
+import aggregator
+from aggregator import Histogram, SketchHistogram, api_formatter
+
+
+def histogram_size(h):
+    """ Approximate number of bytes held by the samples of a histogram. """
+    if isinstance(h, SketchHistogram):
+        return sys.getsizeof(h.buckets) + sum(sys.getsizeof(k) + sys.getsizeof(v)
+            for k, v in h.buckets.iteritems())
+    return sys.getsizeof(h.samples) + sum(sys.getsizeof(v) for v in h.samples)
+
+
+class TestHistogramPerf(object):
+
+    SAMPLE_COUNTS = [1000, 50000, 500000]
+    RELATIVE_ACCURACIES = [0.05, 0.01, 0.001]
+    PERCENTILES = [0.5, 0.95, 0.99]
+
+    def _run(self, h, values):
+        h.percentiles = self.PERCENTILES
+        start = time.time()
+        for v in values:
+            h.sample(v, 1)
+        sample_duration = time.time() - start
+        size = histogram_size(h)
+
+        start = time.time()
+        metrics = h.flush(1, 1)
+        flush_duration = time.time() - start
+
+        results = dict((m['metric'], m['points'][0][1]) for m in metrics)
+        return results, size, sample_duration, flush_duration
+
+    def test_accuracy_vs_memory(self):
+        random.seed(1)
+        for count in self.SAMPLE_COUNTS:
+            values = [random.lognormvariate(3, 1.5) for _ in xrange(count)]
+
+            exact, size, sample_duration, flush_duration = self._run(
+                Histogram(api_formatter, 'h', None, 'my.host', None), values)
+            print "%s samples, exact: %s KB, %.2fus/sample, flush in %.2fms" % (
+                count, size / 1024, sample_duration * 1e6 / count, flush_duration * 1e3)
+
+            for accuracy in self.RELATIVE_ACCURACIES:
+                sketch, size, sample_duration, flush_duration = self._run(
+                    SketchHistogram(api_formatter, 'h', None, 'my.host', None,
+                        relative_accuracy=accuracy), values)
+                errors = []
+                for p in self.PERCENTILES:
+                    name = 'h.%spercentile' % int(p * 100)
+                    errors.append(abs(sketch[name] - exact[name]) / exact[name])
+                print "    sketch %s: %s KB, %.2fus/sample, flush in %.2fms, max relative error %.4f%%" % (
+                    accuracy, size / 1024, sample_duration * 1e6 / count,
+                    flush_duration * 1e3, max(errors) * 100)
+
+    def test_flush_selection(self):
+        """ Flush time of large histograms with every aggregate and several
+        percentiles, sorting the samples vs selecting them with numpy. """
+        random.seed(1)
+        numpy = aggregator.numpy
+        modes = [('sort', None)]
+        if numpy is not None:
+            modes.append(('numpy partition', numpy))
+
+        for count in self.SAMPLE_COUNTS:
+            values = [random.random() for _ in xrange(count)]
+            for mode, module in modes:
+                aggregator.numpy = module
+                try:
+                    h = Histogram(api_formatter, 'h', None, 'my.host', None,
+                        aggregates=aggregator.HISTOGRAM_AGGREGATES,
+                        percentiles=[0.5, 0.75, 0.95, 0.99, 0.999])
+                    h.samples = list(values)
+                    h.count = count
+                    start = time.time()
+                    h.flush(1, 1)
+                    print "%s samples, %s: flush in %.2fms" % (count, mode,
+                        (time.time() - start) * 1e3)
+                finally:
+                    aggregator.numpy = numpy
+
+
+if __name__ == '__main__':
+    t = TestHistogramPerf()
+    t.test_accuracy_vs_memory()
+    t.test_flush_selection()
@@ -0,0 +1,325 @@
+"""
+End-to-end load test of dogstatsd: fire udp (or unix socket) traffic at a
+running server whose reporter flushes to a local stub intake, and report the
+sustained packet rate, the drop rate, the p99 flush latency and the memory
+used.
+
+The traffic is either generated (metric types, tag cardinality, sample rates
+and metrics per datagram are configurable) or replayed from a capture file
+holding one datagram per line, with the metrics of multi-metric datagrams
+separated by an escaped newline (\\n). `--record` writes generated traffic in
+that format.
+
+Run it with `python benchmark_load.py --help` for the options.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import optparse
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from aggregator import DoubleBufferedAggregator
+from dogstatsd import Reporter, Server, process_rss
+
+
+METRIC_TYPES = ['c', 'g', 'h', 'ms', 's']
+
+
+def generate_datagrams(count, metric_types=None, metric_names=100,
+                       tag_cardinality=10, sample_rates=None,
+                       metrics_per_datagram=1, seed=1):
+    """ `count` datagrams of random metrics. Each metric has an env tag and
+    a host tag taking `tag_cardinality` values, so there are about
+    metric_names * tag_cardinality contexts. """
+    metric_types = metric_types or METRIC_TYPES
+    sample_rates = sample_rates or [1]
+    rand = random.Random(seed)
+    datagrams = []
+    for _ in xrange(count):
+        lines = []
+        for _ in xrange(metrics_per_datagram):
+            mtype = rand.choice(metric_types)
+            line = 'load.%s.%s:%s|%s' % (mtype, rand.randrange(metric_names),
+                rand.randrange(1000), mtype)
+            sample_rate = rand.choice(sample_rates)
+            if sample_rate != 1:
+                line += '|@%s' % sample_rate
+            line += '|#env:load,host:host%s' % rand.randrange(tag_cardinality)
+            lines.append(line)
+        datagrams.append('\n'.join(lines))
+    return datagrams
+
+
+def read_capture(path):
+    f = open(path)
+    try:
+        return [line.rstrip('\n').decode('string_escape') for line in f if line.strip()]
+    finally:
+        f.close()
+
+
+def write_capture(path, datagrams):
+    f = open(path, 'w')
+    try:
+        for datagram in datagrams:
+            f.write(datagram.encode('string_escape') + '\n')
+    finally:
+        f.close()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(round(p * len(values) - 0.5)), len(values) - 1)]
+
+
+class StubIntake(object):
+    """ An http server accepting the series the reporter posts. """
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        intake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                intake.requests += 1
+                intake.bytes += len(body)
+                self.send_response(202)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TimedReporter(Reporter):
+    """ A reporter keeping the duration of each of its flushes, in ms. """
+
+    def __init__(self, *args, **kwargs):
+        Reporter.__init__(self, *args, **kwargs)
+        self.flush_latencies = []
+
+    def flush(self):
+        start = time.time()
+        Reporter.flush(self)
+        self.flush_latencies.append((time.time() - start) * 1000)
+
+
+def run_load(datagrams, duration=10, rate=None, unix_socket=False,
+             flush_interval=1, **server_kwargs):
+    """ Send `datagrams` over and over for `duration` seconds, at `rate`
+    datagrams per second or as fast as we can, and return the results. """
+    intake = StubIntake()
+    intake.start()
+
+    tmp_dir = tempfile.mkdtemp()
+    socket_path = None
+    if unix_socket:
+        socket_path = os.path.join(tmp_dir, 'dogstatsd.sock')
+
+    aggregator = DoubleBufferedAggregator('my.host', interval=flush_interval)
+    server = Server(aggregator, '127.0.0.1', 0, socket_path=socket_path,
+        **server_kwargs)
+    reporter = TimedReporter(flush_interval, aggregator, intake.url,
+        api_key='apikey', server=server)
+
+    server_thread = threading.Thread(target=server.start)
+    server_thread.daemon = True
+    server_thread.start()
+    while not server.running:
+        time.sleep(0.01)
+    reporter.start()
+    address = server.socket.getsockname()
+    rss_before = process_rss()
+
+    if unix_socket:
+        # The client blocks when the socket's queue is full.
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        address = socket_path
+    else:
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    lines = [d.count('\n') + 1 for d in datagrams]
+
+    sent = sent_lines = 0
+    start = time.time()
+    end = start + duration
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+        if rate and sent > (now - start) * rate:
+            time.sleep(min(0.001, end - now))
+            continue
+        # Check the time every so often only.
+        for _ in xrange(100):
+            i = sent % len(datagrams)
+            client.sendto(datagrams[i], address)
+            sent += 1
+            sent_lines += lines[i]
+    send_duration = time.time() - start
+
+    # Give the server a chance to catch up with what's left in the socket
+    # buffer.
+    received = -1
+    while received != aggregator.total_count + aggregator.count:
+        received = aggregator.total_count + aggregator.count
+        time.sleep(0.2)
+    rss = process_rss()
+
+    reporter.stop()
+    reporter.join()
+    server.stop()
+    client.close()
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.sendto('', server.socket.getsockname())
+    server_thread.join()
+    client.close()
+    server.socket.close()
+    intake.stop()
+    shutil.rmtree(tmp_dir)
+
+    results = {
+        'sent': sent_lines,
+        'received': received,
+        'packets_per_second': received / send_duration,
+        'drop_rate': max(sent_lines - received, 0) / float(sent_lines or 1),
+        'flushes': len(reporter.flush_latencies),
+        'p99_flush_latency': percentile(reporter.flush_latencies, 0.99),
+        'intake_requests': intake.requests,
+        'intake_bytes': intake.bytes,
+        'rss': rss,
+        'rss_growth': None,
+    }
+    if rss is not None and rss_before is not None:
+        results['rss_growth'] = rss - rss_before
+    return results
+
+
+def report(name, results):
+    print "%s: %s/%s packets received (%.2f%% dropped), %.0f packets/s" % (
+        name, results['received'], results['sent'], results['drop_rate'] * 100,
+        results['packets_per_second'])
+    if results['p99_flush_latency'] is not None:
+        print "    %s flushes, p99 flush latency %.2fms, %s payloads (%s KB) posted" % (
+            results['flushes'], results['p99_flush_latency'],
+            results['intake_requests'], results['intake_bytes'] / 1024)
+    if results['rss'] is not None:
+        print "    RSS %.1f MB (+%.1f MB)" % (results['rss'] / 1048576.0,
+            results['rss_growth'] / 1048576.0)
+
+
+class TestDogstatsdLoad(object):
+
+    DURATION = 5
+    DATAGRAM_COUNT = 10000
+
+    def test_mixed_load(self):
+        datagrams = generate_datagrams(self.DATAGRAM_COUNT,
+            sample_rates=[1, 1, 0.5, 0.1])
+        report('mixed types', run_load(datagrams, self.DURATION))
+
+    def test_high_cardinality_load(self):
+        datagrams = generate_datagrams(self.DATAGRAM_COUNT, metric_names=1000,
+            tag_cardinality=100)
+        report('100k contexts', run_load(datagrams, self.DURATION))
+
+    def test_multi_metric_datagrams_load(self):
+        datagrams = generate_datagrams(self.DATAGRAM_COUNT / 10,
+            metrics_per_datagram=10)
+        report('10 metrics per datagram', run_load(datagrams, self.DURATION))
+
+    def test_fixed_rate_load(self):
+        datagrams = generate_datagrams(self.DATAGRAM_COUNT)
+        report('20k packets/s', run_load(datagrams, self.DURATION, rate=20000))
+
+    def test_unix_socket_load(self):
+        datagrams = generate_datagrams(self.DATAGRAM_COUNT)
+        report('unix socket', run_load(datagrams, self.DURATION,
+            unix_socket=True, drain_socket=True))
+
+    def test_replay_capture(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'capture')
+            datagrams = generate_datagrams(self.DATAGRAM_COUNT,
+                metrics_per_datagram=3)
+            write_capture(path, datagrams)
+            replayed = read_capture(path)
+            assert replayed == datagrams
+            report('replayed capture', run_load(replayed, self.DURATION))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--duration', type='float', default=10,
+        help="seconds to send packets for")
+    parser.add_option('--rate', type='int',
+        help="datagrams per second to send (as many as we can by default)")
+    parser.add_option('--types', default=','.join(METRIC_TYPES),
+        help="comma-separated metric types to send")
+    parser.add_option('--names', type='int', default=100,
+        help="number of metric names")
+    parser.add_option('--tag-cardinality', type='int', default=10,
+        help="number of values of the host tag")
+    parser.add_option('--sample-rates', default='1',
+        help="comma-separated sample rates to pick from")
+    parser.add_option('--per-datagram', type='int', default=1,
+        help="metrics per datagram")
+    parser.add_option('--datagrams', type='int', default=10000,
+        help="number of distinct datagrams to cycle through")
+    parser.add_option('--replay', metavar='FILE',
+        help="send the datagrams of a capture file instead")
+    parser.add_option('--record', metavar='FILE',
+        help="write the generated datagrams to a capture file")
+    parser.add_option('--unix-socket', action='store_true',
+        help="send to a unix socket rather than over udp")
+    parser.add_option('--drain', action='store_true',
+        help="have the server drain its socket")
+    parser.add_option('--rcvbuf', type='int',
+        help="receive buffer size of the server's socket")
+    options, _ = parser.parse_args()
+
+    if options.replay:
+        datagrams = read_capture(options.replay)
+    else:
+        datagrams = generate_datagrams(options.datagrams,
+            metric_types=options.types.split(','),
+            metric_names=options.names,
+            tag_cardinality=options.tag_cardinality,
+            sample_rates=[float(r) for r in options.sample_rates.split(',')],
+            metrics_per_datagram=options.per_datagram)
+        if options.record:
+            write_capture(options.record, datagrams)
+
+    results = run_load(datagrams, options.duration, rate=options.rate,
+        unix_socket=options.unix_socket, drain_socket=options.drain,
+        so_rcvbuf=options.rcvbuf)
+    report(options.replay or 'generated', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Memory used by the contexts of the metrics aggregator.
+"""
+
+import gc
+import resource
+
+from aggregator import MetricsAggregator
+
+
+def rss_bytes():
+    """ Peak resident memory of this process, in bytes (Linux). """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class TestAggregatorMemory(object):
+
+    CONTEXT_COUNT = 200000
+    TAG_SETS = 1000
+    METRIC_TYPES = ['c', 'g', 'h', 's']
+
+    def _measure(self, mtype):
+        """ Bytes per context of the given type: contexts share their
+        names, hosts and tags as they would with real traffic. """
+        ma = MetricsAggregator('my.host')
+        gc.collect()
+        before = rss_bytes()
+        for i in xrange(self.CONTEXT_COUNT):
+            ma.submit_packets('metric.%s:1|%s|#env:prod,role:%s,shard:%s' % (
+                i / self.TAG_SETS, mtype, i % 10, (i % self.TAG_SETS) / 10))
+        gc.collect()
+        used = rss_bytes() - before
+        assert len(ma.metrics) == self.CONTEXT_COUNT
+        return used / self.CONTEXT_COUNT
+
+    def test_bytes_per_context(self):
+        # Run each type in a fresh process so that the peak RSS of one
+        # doesn't hide the next.
+        import multiprocessing
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            for mtype in self.METRIC_TYPES:
+                size = pool.apply(_measure, (self, mtype))
+                print "%s: %s contexts, %s bytes/context" % (mtype,
+                    self.CONTEXT_COUNT, size)
+        finally:
+            pool.terminate()
+
+
+def _measure(test, mtype):
+    return test._measure(mtype)
+
+
+if __name__ == '__main__':
+    t = TestAggregatorMemory()
+    t.test_bytes_per_context()
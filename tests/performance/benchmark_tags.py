@@ -0,0 +1,83 @@
+"""
+Memory and CPU spent on tags, with and without the shared tag pool.
+"""
+
+import gc
+import time
+
+import aggregator
+from aggregator import MetricsAggregator, TagPool
+from benchmark_memory import rss_bytes
+
+
+class NoTagPool(object):
+    """ What we did before the tag pool: sort every tag list we get. """
+
+    def get(self, tags):
+        return tuple(sorted(set(tags)))
+
+
+class TestTagPool(object):
+
+    CONTEXT_COUNT = 200000
+    TAG_SETS = 1000
+    SAMPLE_COUNT = 500000
+
+    def _tags(self, i):
+        return ['env:prod', 'role:%s' % (i % 10), 'shard:%s' % ((i % self.TAG_SETS) / 10),
+            'az:us-east-1%s' % 'abc'[i % 3]]
+
+    def _run(self, pool, measure):
+        intern_tags = aggregator.intern_tags
+        aggregator.intern_tags = pool.get
+        try:
+            return measure()
+        finally:
+            aggregator.intern_tags = intern_tags
+
+    def _memory(self):
+        ma = MetricsAggregator('my.host')
+        gc.collect()
+        before = rss_bytes()
+        for i in xrange(self.CONTEXT_COUNT):
+            ma.gauge('metric.%s' % (i / self.TAG_SETS), 1, tags=self._tags(i))
+        gc.collect()
+        return (rss_bytes() - before) / self.CONTEXT_COUNT
+
+    def _cpu(self):
+        ma = MetricsAggregator('my.host')
+        tag_lists = [self._tags(i) for i in xrange(self.TAG_SETS)]
+        start = time.time()
+        for i in xrange(self.SAMPLE_COUNT):
+            ma.gauge('metric', i, tags=tag_lists[i % self.TAG_SETS])
+        return (time.time() - start) * 1e6 / self.SAMPLE_COUNT
+
+    def test_bytes_per_context(self):
+        # Run each in a fresh process so that the peak RSS of one doesn't
+        # hide the other.
+        import multiprocessing
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            for name in ('no pool', 'tag pool'):
+                size = pool.apply(_memory, (self, name))
+                print "%s: %s contexts, %s bytes/context" % (name,
+                    self.CONTEXT_COUNT, size)
+        finally:
+            pool.terminate()
+
+    def test_cpu_per_sample(self):
+        for name, pool in (('no pool', NoTagPool()), ('tag pool', TagPool())):
+            print "%s: %.2fus/sample" % (name, self._run(pool, self._cpu))
+
+
+def _memory(test, name):
+    pool = TagPool()
+    if name == 'no pool':
+        pool = NoTagPool()
+    return test._run(pool, test._memory)
+
+
+if __name__ == '__main__':
+    t = TestTagPool()
+    t.test_bytes_per_context()
+    t.test_cpu_per_sample()
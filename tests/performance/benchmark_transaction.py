@@ -0,0 +1,251 @@
+"""
+Performance tests for the forwarder's transaction manager with a large
+backlog of queued transactions, as during an outage of the intake.
+"""
+
+from datetime import timedelta
+import gc
+import shutil
+import tempfile
+import time
+
+import tornado.httpclient
+import tornado.ioloop
+
+from benchmark_load import StubIntake
+from benchmark_memory import rss_bytes
+from diskqueue import Journal
+from transaction import Transaction, TransactionManager
+
+
+class BenchTransaction(Transaction):
+
+    def __init__(self, size, manager):
+        Transaction.__init__(self)
+        self._trManager = manager
+        self._size = size
+        self.is_flushable = False
+
+    def flush(self):
+        if self.is_flushable:
+            self._trManager.tr_success(self)
+        else:
+            self._trManager.tr_error(self)
+
+
+class LatentTransaction(Transaction):
+    """ A transaction getting its response `latency` seconds after being
+    sent, on the ioloop. """
+
+    def __init__(self, size, manager, latency):
+        Transaction.__init__(self)
+        self._trManager = manager
+        self._size = size
+        self._latency = latency
+
+    def flush(self):
+        tornado.ioloop.IOLoop.instance().add_timeout(time.time() + self._latency,
+            self.on_response)
+
+    def on_response(self):
+        self._trManager.tr_success(self)
+        self._trManager.flush_next()
+
+
+class PayloadTransaction(BenchTransaction):
+    """ A transaction holding its payload, or only its id in the journal. """
+
+    def __init__(self, data, manager):
+        BenchTransaction.__init__(self, len(data), manager)
+        self._data = data
+        journal = manager.get_journal()
+        if journal is not None:
+            self._record = journal.append(data)
+            self._data = None
+
+
+class TestTransactionManagerPerf(object):
+
+    TRANSACTION_COUNT = 50000
+    EVICTION_COUNT = 5000
+    SIZE = 1000
+    PAYLOAD_COUNT = 20000
+
+    def _flush(self, manager):
+        manager.flush()
+        while manager._trs_to_flush is not None:
+            manager.flush_next()
+
+    def _timed(self, name, f, count):
+        start = time.time()
+        f()
+        duration = time.time() - start
+        print "%s: %.3fs, %.1fus/transaction" % (name, duration,
+            duration * 1e6 / count)
+
+    def _manager(self, max_wait_for_replay):
+        # No throttling, room for every transaction.
+        return TransactionManager(timedelta(seconds=max_wait_for_replay),
+            self.TRANSACTION_COUNT * self.SIZE, timedelta(seconds=0))
+
+    def _append(self, manager, count, is_flushable=False):
+        transactions = [BenchTransaction(self.SIZE, manager) for _ in xrange(count)]
+        def append():
+            for tr in transactions:
+                tr.is_flushable = is_flushable
+                manager.append(tr)
+        return append
+
+    def test_failing_queue(self):
+        count = self.TRANSACTION_COUNT
+        manager = self._manager(90)
+        self._timed('append %s' % count, self._append(manager, count), count)
+
+        # Let them all be due, fail, and not be due again for a while.
+        time.sleep(1)
+        self._timed('flush %s, all failing' % count, lambda: self._flush(manager), count)
+        self._timed('flush %s, none due' % count, manager.flush, count)
+
+        # The queue is full: each new transaction evicts an old one.
+        self._timed('append %s evicting' % self.EVICTION_COUNT,
+            self._append(manager, self.EVICTION_COUNT), self.EVICTION_COUNT)
+        assert len(manager.get_transactions()) == count
+
+    def test_succeeding_queue(self):
+        count = self.TRANSACTION_COUNT
+        manager = self._manager(0)
+        self._append(manager, count, is_flushable=True)()
+        time.sleep(1)
+        self._timed('flush %s, all succeeding' % count, lambda: self._flush(manager), count)
+        assert not manager.get_transactions()
+
+    def _drain(self, count, latency, **kwargs):
+        """ Seconds to send `count` transactions of 10KB to an intake taking
+        `latency` seconds to answer. """
+        manager = TransactionManager(timedelta(seconds=0), count * 10000,
+            timedelta(seconds=0.5), **kwargs)
+        for _ in xrange(count):
+            manager.append(LatentTransaction(10000, manager, latency))
+        time.sleep(0.01)
+
+        ioloop = tornado.ioloop.IOLoop.instance()
+        def check():
+            if manager._trs_to_flush is None:
+                ioloop.stop()
+            else:
+                ioloop.add_timeout(time.time() + 0.01, check)
+        ioloop.add_callback(manager.flush)
+        ioloop.add_callback(check)
+        start = time.time()
+        ioloop.start()
+        assert not manager.get_transactions()
+        return time.time() - start
+
+    def test_backlog_drain(self):
+        count, latency = 40, 0.1
+        print "drain %s, 2 transactions/s: %.2fs" % (count,
+            self._drain(count, latency))
+        for window in (1, 4, 16):
+            print "drain %s, %s in flight, 1MB/s: %.2fs" % (count, window,
+                self._drain(count, latency, max_in_flight=window,
+                    max_bytes_per_second=1024 * 1024))
+
+    def _queue_payloads(self, journal_dir=None):
+        """ Seconds and RSS growth to queue PAYLOAD_COUNT transactions of
+        10KB, with or without a journal. """
+        journal = None
+        if journal_dir is not None:
+            journal = Journal(journal_dir)
+        manager = TransactionManager(timedelta(seconds=90),
+            2 * self.PAYLOAD_COUNT * 10000, timedelta(seconds=0), journal=journal)
+        gc.collect()
+        before = rss_bytes()
+        start = time.time()
+        for i in xrange(self.PAYLOAD_COUNT):
+            manager.append(PayloadTransaction('%010d' % i * 1000, manager))
+        if journal is not None:
+            journal.sync()
+        duration = time.time() - start
+        gc.collect()
+        return duration, rss_bytes() - before
+
+    def test_journal(self):
+        import multiprocessing
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        journal_dir = tempfile.mkdtemp()
+        try:
+            for name, args in (('in memory', ()), ('journal', (journal_dir,))):
+                duration, growth = pool.apply(_queue_payloads, (self,) + args)
+                print "queue %s transactions of 10KB, %s: %.2fs, +%.1fMB RSS" % (
+                    self.PAYLOAD_COUNT, name, duration, growth / 1048576.0)
+        finally:
+            pool.terminate()
+            shutil.rmtree(journal_dir)
+
+    SERIES_POSTS = 1000
+
+    def _post_series(self, batch_window, max_batch_size):
+        """ Seconds to forward SERIES_POSTS small series payloads to a stub
+        intake, posted 1ms apart, and the number of requests it got. """
+        from ddagent import Application, APIMetricTransaction, MetricTransaction
+        intake = StubIntake()
+        intake.start()
+        config = {
+            'api_key': 'apikey', 'use_dd': True, 'dd_url': intake.url,
+            'proxy_settings': {'host': None, 'port': None, 'user': None, 'password': None},
+            'forwarder_batch_window': batch_window,
+            'forwarder_batch_max_size': max_batch_size,
+            'forwarder_max_bytes_per_second': 100 * 1024 * 1024,
+        }
+        app = Application(17123, config, watchdog=False)
+        body = '{"series": [{"metric": "my.metric", "points": [[1, 1]], "tags": ["a:b"]}]}'
+
+        ioloop = tornado.ioloop.IOLoop.instance()
+        posted = [0]
+        def post():
+            APIMetricTransaction(body, {'Content-Type': 'application/json'})
+            posted[0] += 1
+            if posted[0] < self.SERIES_POSTS:
+                ioloop.add_timeout(time.time() + 0.001, post)
+        def check():
+            if posted[0] == self.SERIES_POSTS and not app._tr_manager.get_transactions():
+                ioloop.stop()
+            else:
+                # What the forwarder's periodic flush would do
+                app._tr_manager.flush()
+                ioloop.add_timeout(time.time() + 0.05, check)
+        ioloop.add_callback(post)
+        ioloop.add_callback(check)
+        start = time.time()
+        ioloop.start()
+        duration = time.time() - start
+        intake.stop()
+        return duration, intake.requests
+
+    def test_series_batching(self):
+        import multiprocessing
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            for name, args in (('one by one', (0, 0)), ('batched', (0.1, 1024 * 1024))):
+                duration, requests = pool.apply(_post_series, (self,) + args)
+                print "forward %s series payloads, %s: %.2fs, %s requests" % (
+                    self.SERIES_POSTS, name, duration, requests)
+        finally:
+            pool.terminate()
+
+
+def _post_series(test, *args):
+    return test._post_series(*args)
+
+
+def _queue_payloads(test, *args):
+    return test._queue_payloads(*args)
+
+
+if __name__ == '__main__':
+    t = TestTransactionManagerPerf()
+    t.test_failing_queue()
+    t.test_succeeding_queue()
+    t.test_backlog_drain()
+    t.test_journal()
+    t.test_series_batching()
@@ -61,3 +61,28 @@ def test_persistence_fail():
 
     status = CollectorStatus.load_latest_status()
     assert not status
+
+def test_dogstatsd_status():
+    from checks.check_status import DogstatsdStatus
+    s1 = DogstatsdStatus(flush_count=3, packet_count=10, parse_error_count=2,
+        kernel_drops=5, context_count=7, flush_duration=1.5, memory=10 * 1024 * 1024)
+    s1.persist()
+
+    s2 = DogstatsdStatus.load_latest_status()
+    nt.assert_equal(s2.to_dict()['parse_error_count'], 2)
+    lines = s2.body_lines()
+    assert "Parse errors: 2" in lines
+    assert "Packets dropped by the kernel: 5" in lines
+    assert "Context count: 7" in lines
+    assert "Memory (RSS): 10.0MB" in lines
+    DogstatsdStatus.remove_latest_status()
+
+def test_forwarder_status():
+    from checks.check_status import ForwarderStatus
+    ForwarderStatus(queue_length=3, queue_size=1024, flush_count=5,
+        evicted_count=2, evicted_size=512).persist()
+
+    s = ForwarderStatus.load_latest_status()
+    nt.assert_equal(s.to_dict()['evicted_size'], 512)
+    assert "Evicted Transactions: 2 (512 bytes)" in s.body_lines()
+    ForwarderStatus.remove_latest_status()
@@ -0,0 +1,178 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import nose.tools as nt
+
+from diskqueue import Journal, SegmentQueue, INDEX_ENTRY
+
+
+class TestSegmentQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def drain(self, queue):
+        payloads = []
+        while True:
+            payload = queue.peek()
+            if payload is None:
+                return payloads
+            payloads.append(payload)
+            queue.pop()
+
+    def test_fifo(self):
+        queue = SegmentQueue(self.dir, segment_size=100)
+        payloads = ['payload %s' % i * 5 for i in xrange(20)]
+        for p in payloads:
+            queue.push(p)
+        nt.assert_equal(len(queue), 20)
+        assert len(queue.segments) > 1
+
+        nt.assert_equal(queue.peek(), payloads[0])
+        nt.assert_equal(queue.peek(), payloads[0])
+        nt.assert_equal(self.drain(queue), payloads)
+        nt.assert_equal(len(queue), 0)
+
+        # Consumed segments are gone.
+        nt.assert_equal([f for f in os.listdir(self.dir) if f != 'head'], [])
+
+    def test_restart(self):
+        queue = SegmentQueue(self.dir, segment_size=100)
+        payloads = ['payload %s' % i * 5 for i in xrange(20)]
+        for p in payloads:
+            queue.push(p)
+        for _ in xrange(7):
+            queue.pop()
+        queue.close()
+
+        # The new queue picks up where the last one stopped.
+        queue = SegmentQueue(self.dir, segment_size=100)
+        nt.assert_equal(len(queue), 13)
+        queue.push('new payload')
+        nt.assert_equal(self.drain(queue), payloads[7:] + ['new payload'])
+
+    def test_partial_write(self):
+        queue = SegmentQueue(self.dir)
+        queue.push('first')
+        queue.push('second')
+        queue.close()
+
+        # Lose the end of the last record, as if we crashed while writing it.
+        segment = queue.segments[0]
+        f = open(segment.path, 'ab')
+        f.truncate(segment.size - 2)
+        f.close()
+
+        queue = SegmentQueue(self.dir)
+        nt.assert_equal(len(queue), 1)
+        queue.push('third')
+        nt.assert_equal(os.path.getsize(queue.segments[0].index_path), 2 * INDEX_ENTRY.size)
+        nt.assert_equal(self.drain(queue), ['first', 'third'])
+
+    def test_partial_index_entry(self):
+        queue = SegmentQueue(self.dir)
+        queue.push('first')
+        queue.push('second')
+        queue.close()
+
+        # Write part of an index entry, as if we crashed while writing it.
+        segment = queue.segments[0]
+        f = open(segment.index_path, 'ab')
+        f.write('\0' * 7)
+        f.close()
+
+        queue = SegmentQueue(self.dir)
+        nt.assert_equal(len(queue), 2)
+        queue.push('third')
+        queue.close()
+        queue = SegmentQueue(self.dir)
+        nt.assert_equal(os.path.getsize(queue.segments[0].index_path), 3 * INDEX_ENTRY.size)
+        nt.assert_equal(self.drain(queue), ['first', 'second', 'third'])
+
+    def test_max_size(self):
+        queue = SegmentQueue(self.dir, max_size=1000, segment_size=100)
+        for i in xrange(100):
+            queue.push('%050d' % i)
+        assert queue.size() <= 1000 + 100
+        assert queue.dropped > 0
+        payloads = self.drain(queue)
+        nt.assert_equal(len(payloads) + queue.dropped, 100)
+        nt.assert_equal(payloads[-1], '%050d' % 99)
+
+    def test_max_age(self):
+        queue = SegmentQueue(self.dir, max_age=1)
+        queue.push('old')
+        time.sleep(1.1)
+        queue.push('new')
+        nt.assert_equal(self.drain(queue), ['new'])
+        nt.assert_equal(queue.dropped, 1)
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_ack(self):
+        journal = Journal(self.dir, segment_size=100)
+        records = [journal.append('payload %s' % i * 5) for i in xrange(20)]
+        nt.assert_equal(len(journal), 20)
+        nt.assert_equal(journal.read(records[3]), 'payload 3' * 5)
+        assert len(journal.segments) > 1
+
+        # Acknowledged in any order
+        for record in reversed(records):
+            journal.ack(record)
+        journal.ack(records[0])
+        nt.assert_equal(len(journal), 0)
+        nt.assert_equal(journal.pending(), [])
+
+        # Only the segment we're appending to is left
+        nt.assert_equal(len(journal.segments), 1)
+        nt.assert_equal(len(os.listdir(self.dir)), 3)
+
+    def test_replay(self):
+        journal = Journal(self.dir, segment_size=100)
+        records = [journal.append('payload %s' % i * 5) for i in xrange(20)]
+        for record in records[::2]:
+            journal.ack(record)
+        journal.close()
+
+        # The records that weren't acknowledged are still there
+        journal = Journal(self.dir, segment_size=100)
+        nt.assert_equal(journal.pending(), records[1::2])
+        nt.assert_equal([journal.read(r) for r in journal.pending()],
+            ['payload %s' % i * 5 for i in xrange(1, 20, 2)])
+        record = journal.append('new payload')
+        assert record not in records
+        for record in journal.pending():
+            journal.ack(record)
+        journal.close()
+
+        journal = Journal(self.dir, segment_size=100)
+        nt.assert_equal(journal.pending(), [])
+
+    def test_partial_write(self):
+        journal = Journal(self.dir)
+        first = journal.append('first')
+        journal.append('second')
+        journal.close()
+
+        # Lose the end of the last record, as if we crashed while writing it.
+        segment = journal.segments[first[0]]
+        f = open(segment.path, 'ab')
+        f.truncate(segment.size - 2)
+        f.close()
+
+        journal = Journal(self.dir)
+        nt.assert_equal(journal.pending(), [first])
+        nt.assert_equal(journal.read(first), 'first')
@@ -1,10 +1,13 @@
 
 import random
+import socket
+import threading
 import time
 
 import unittest
 import nose.tools as nt
 
+from aggregator import BucketedMetricsAggregator, DoubleBufferedAggregator
 from dogstatsd import MetricsAggregator
 
 
@@ -83,6 +86,26 @@ class TestUnitDogStatsd(unittest.TestCase):
         nt.assert_equal(third['points'][0][1], 16)
         nt.assert_equal(third['host'], 'myhost')
 
+    def test_interned_contexts(self):
+        stats = MetricsAggregator('myhost')
+        stats.submit_packets('first:1|c|#tag2,tag1,tag1')
+        stats.submit_packets('second:1|g|#tag1,tag2')
+        stats.gauge('third', 1, tags=['tag2', 'tag1'], hostname='other' + 'host')
+        stats.gauge('third', 1, hostname='otherhost', device_name='sda')
+
+        metrics = stats.metrics.values()
+        tags = [m.tags for m in metrics if m.tags]
+        nt.assert_equal(len(tags), 3)
+        assert all(t is tags[0] for t in tags)
+        nt.assert_equal(tags[0], ('tag1', 'tag2'))
+
+        hosts = [m.hostname for m in metrics if m.hostname != 'myhost']
+        nt.assert_equal(len(hosts), 2)
+        assert hosts[0] is hosts[1]
+
+        # Metrics have no __dict__.
+        assert not any(hasattr(m, '__dict__') for m in metrics)
+
     def test_tags_gh442(self):
         import util
         import dogstatsd
@@ -93,6 +116,175 @@ class TestUnitDogStatsd(unittest.TestCase):
         serialized = dogstatsd.serialize([api_formatter("foo", 12, 1, ('tag',), 'host')])
         assert '"tags": ["tag"]' in serialized
 
+    def test_series_writer(self):
+        import json
+        import zlib
+        from aggregator import api_formatter
+        from dogstatsd import SeriesWriter
+
+        metrics = [api_formatter("metric.%s" % i, i, 1, ('tag',), 'host')
+            for i in xrange(100)]
+        for compress in (False, True):
+            writer = SeriesWriter(1000, compress, batch_size=30)
+            for i in xrange(0, 100, 7):
+                writer.write(metrics[i:i + 7])
+            payloads = writer.close()
+            if compress:
+                payloads = [zlib.decompress(p) for p in payloads]
+            assert len(payloads) > 1
+            assert all(len(p) <= 1000 for p in payloads)
+            received = sum((json.loads(p)['series'] for p in payloads), [])
+            nt.assert_equal([m['metric'] for m in received],
+                [m['metric'] for m in metrics])
+            nt.assert_equal(writer.count, 100)
+
+        writer = SeriesWriter(10 ** 6)
+        writer.write(metrics)
+        payloads = writer.close()
+        nt.assert_equal(len(payloads), 1)
+        nt.assert_equal(json.loads(payloads[0]), json.loads(json.dumps({'series': metrics})))
+
+        # A series bigger than a payload gets one of its own.
+        writer = SeriesWriter(100)
+        writer.write(metrics[:3])
+        nt.assert_equal(len(writer.close()), 3)
+
+    def test_reporter_submit(self):
+        import json
+        import zlib
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from aggregator import api_formatter
+        from dogstatsd import Reporter
+
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                requests.append((self.client_address, self.headers, body))
+                self.send_response(202)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                # Drop the connection after a few requests, as a server
+                # timing out idle connections would.
+                if len(requests) == 3:
+                    self.close_connection = 1
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            stats = MetricsAggregator('myhost')
+            reporter = Reporter(10, stats, 'http://127.0.0.1:%s' % server.server_port,
+                api_key='apikey', max_payload_size=2000)
+            metrics = [api_formatter("metric.%s" % i, i, 1, ('tag',), 'host')
+                for i in xrange(30)]
+            reporter.submit(metrics)
+            reporter.submit(metrics)
+        finally:
+            # The server only stops once the connection is closed.
+            reporter._close()
+            server.shutdown()
+            server.server_close()
+
+        # Both flushes are split in chunks, sent deflated, and nothing is
+        # lost when the server closes the connection.
+        assert len(requests) > 2
+        received = []
+        for _, headers, body in requests:
+            nt.assert_equal(headers['Content-Encoding'], 'deflate')
+            received += json.loads(zlib.decompress(body))['series']
+        nt.assert_equal(sorted(m['metric'] for m in received),
+            sorted(m['metric'] for m in metrics + metrics))
+
+        # One connection up to the server closing it, then a new one.
+        clients = [address for address, _, _ in requests]
+        nt.assert_equal(len(set(clients[:3])), 1)
+        nt.assert_equal(len(set(clients[3:])), 1)
+        assert clients[3] != clients[0]
+
+        # Submission stats are reported with the other metrics.
+        submit_stats = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(submit_stats['datadog.dogstatsd.submit.payloads'], len(requests))
+        nt.assert_equal(submit_stats['datadog.dogstatsd.submit.bytes'],
+            sum(len(body) for _, _, body in requests))
+        assert 'datadog.dogstatsd.submit.errors' not in submit_stats
+        assert 'datadog.dogstatsd.submit.latency.max' in submit_stats
+
+    def test_reporter_spool(self):
+        import json
+        import shutil
+        import tempfile
+        import zlib
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from aggregator import api_formatter
+        from diskqueue import SegmentQueue
+        from dogstatsd import Reporter
+
+        received = []
+        state = {'up': False}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if state['up']:
+                    received.append(json.loads(zlib.decompress(body))['series'])
+                    self.send_response(202)
+                else:
+                    self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        spool_dir = tempfile.mkdtemp()
+
+        try:
+            stats = MetricsAggregator('myhost')
+            reporter = Reporter(1, stats, 'http://127.0.0.1:%s' % server.server_port,
+                compress=False, spool=SegmentQueue(spool_dir))
+            metrics = [[api_formatter("metric.%s.%s" % (i, j), j, 1, None, 'host')
+                for j in xrange(3)] for i in xrange(3)]
+
+            # The endpoint is down: flushes are spilled, replaying backs off.
+            for m in metrics:
+                self.assertRaises(Exception, reporter.submit, m)
+            nt.assert_equal(len(reporter.spool), 3)
+            reporter.replay()
+            nt.assert_equal(reporter.replay_backoff, 1)
+            assert reporter.next_replay > time.time()
+            reporter.replay()
+            nt.assert_equal(reporter.replay_backoff, 1)
+
+            # It's back: everything is resent, oldest first.
+            state['up'] = True
+            reporter.next_replay = 0
+            reporter.replay()
+            nt.assert_equal([[m['metric'] for m in r] for r in received],
+                [[m['metric'] for m in r] for r in metrics])
+            nt.assert_equal(len(reporter.spool), 0)
+            nt.assert_equal(reporter.replay_backoff, 0)
+        finally:
+            # The server only stops once the connection is closed.
+            reporter._close()
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(spool_dir)
+
     def test_counter(self):
         stats = MetricsAggregator('myhost')
 
@@ -212,6 +404,50 @@ class TestUnitDogStatsd(unittest.TestCase):
         # Assert there are no more sets
         assert not stats.flush()
 
+    def test_hll_sets(self):
+        stats = MetricsAggregator('myhost', hll_set_prefixes=['my.hll.'])
+
+        # Small sets are (almost always) counted exactly.
+        for i in xrange(3):
+            for v in ['a', 'b', 10, 10.0, 20]:
+                stats.submit_packets('my.hll.small:%s|s' % v)
+                stats.submit_packets('my.set:%s|s' % v)
+
+        # Bigger ones have a bounded error: 1.6% standard error with the
+        # default precision.
+        for count in [1000, 100000]:
+            for i in xrange(count):
+                stats.submit_packets('my.hll.big%s:user%s|s' % (count, i))
+                stats.submit_packets('my.hll.big%s:%s|s' % (count, i))
+
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics['my.set'], 4)
+        nt.assert_equal(metrics['my.hll.small'], 4)
+        for count in [1000, 100000]:
+            estimate = metrics['my.hll.big%s' % count]
+            assert abs(estimate - 2 * count) <= 0.05 * 2 * count, \
+                "%s %s" % (estimate, 2 * count)
+
+        # Same shape as regular sets: reset after each flush.
+        assert not stats.flush()
+
+    def test_bit_length(self):
+        from aggregator import bit_length
+        for value, length in [(0, 0), (1, 1), (2, 2), (255, 8), (256, 9),
+                (2 ** 63, 64), (2 ** 64 - 1, 64)]:
+            nt.assert_equal(bit_length(value), length)
+
+    def test_hll_sets_merge(self):
+        stats = MetricsAggregator('myhost', hll_set_prefixes=['my.'])
+        workers = [MetricsAggregator('myhost', hll_set_prefixes=['my.']) for _ in range(2)]
+        for i in xrange(20000):
+            workers[i % 2].submit_packets('my.hll:%s|s' % (i % 15000))
+        for worker in workers:
+            stats.merge(*worker.flush_partials())
+
+        estimate = stats.flush()[0]['points'][0][1]
+        assert abs(estimate - 15000) <= 0.05 * 15000, estimate
+
     def test_rate(self):
         stats = MetricsAggregator('myhost')
         stats.submit_packets('my.rate:10|_dd-r')
@@ -276,6 +512,104 @@ class TestUnitDogStatsd(unittest.TestCase):
         assert not metrics
 
 
+    def test_histogram_without_numpy(self):
+        # Large histograms are selected with numpy.partition when it's
+        # available: sorting them must give the same values.
+        import aggregator
+        samples = range(2000)
+        random.shuffle(samples)
+        packets = '\n'.join('my.p:%s|h' % v for v in samples)
+
+        numpy = aggregator.numpy
+        results = []
+        try:
+            for module in (numpy, None):
+                aggregator.numpy = module
+                stats = MetricsAggregator('myhost')
+                stats.submit_packets(packets)
+                results.append([(m['metric'], m['points'][0][1])
+                    for m in self.sort_metrics(stats.flush())])
+        finally:
+            aggregator.numpy = numpy
+
+        nt.assert_equal(results[0], results[1])
+        nt.assert_equal(dict(results[1])['my.p.95percentile'], 1899)
+
+    def test_histogram_aggregates(self):
+        stats = MetricsAggregator('myhost',
+            histogram_aggregates=['min', 'max', 'sum', 'count'],
+            histogram_percentiles=[0.5, 0.99, 0.999],
+            histogram_prefix_options=[
+                ('my.', {'aggregates': ['avg']}),
+                ('my.other.', {'percentiles': [0.75]}),
+            ])
+
+        values = range(1, 2001)
+        random.shuffle(values)
+        for i in values:
+            stats.submit_packets('p:%s|h' % i)
+            stats.submit_packets('my.p:%s|h' % i)
+            stats.submit_packets('my.other.p:%s|h' % i)
+
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(sorted(metrics.keys()), sorted([
+            'my.other.p.75percentile', 'my.other.p.min', 'my.other.p.max',
+            'my.other.p.sum', 'my.other.p.count',
+            'my.p.avg', 'my.p.50percentile', 'my.p.99percentile', 'my.p.999percentile',
+            'p.min', 'p.max', 'p.sum', 'p.count',
+            'p.50percentile', 'p.99percentile', 'p.999percentile',
+        ]))
+        nt.assert_equal(metrics['p.min'], 1)
+        nt.assert_equal(metrics['p.max'], 2000)
+        nt.assert_equal(metrics['p.sum'], 2001000)
+        nt.assert_equal(metrics['p.count'], 2000)
+        nt.assert_equal(metrics['p.50percentile'], 1000)
+        nt.assert_equal(metrics['p.99percentile'], 1980)
+        nt.assert_equal(metrics['p.999percentile'], 1998)
+        nt.assert_equal(metrics['my.p.avg'], 1000.5)
+        nt.assert_equal(metrics['my.other.p.75percentile'], 1500)
+
+    def test_sketch_histogram(self):
+        stats = MetricsAggregator('myhost', histogram_sketch=True,
+            sketch_relative_accuracy=0.01)
+
+        values = [random.lognormvariate(0, 2) for _ in xrange(10000)]
+        values += [-v for v in values[:1000]] + [0] * 100
+        for v in values:
+            stats.submit_packets('my.p:%r|ms' % v)
+
+        values.sort()
+        length = len(values)
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(len(metrics), 5)
+
+        def assert_relative(estimate, exact):
+            assert abs(estimate - exact) <= 0.01 * abs(exact) + 1e-9, \
+                "%s %s" % (estimate, exact)
+
+        assert_relative(metrics['my.p.95percentile'], values[int(round(0.95 * length - 1))])
+        assert_relative(metrics['my.p.median'], values[int(round(length/2 - 1))])
+        nt.assert_equal(metrics['my.p.max'], values[-1])
+        nt.assert_almost_equal(metrics['my.p.avg'], sum(values) / length)
+        nt.assert_equal(metrics['my.p.count'], length)
+
+        # Ensure that histograms are reset.
+        assert not stats.flush()
+
+    def test_sketch_histogram_max_buckets(self):
+        from aggregator import SketchHistogram, api_formatter
+
+        h = SketchHistogram(api_formatter, 'my.p', None, 'myhost', None,
+            max_buckets=10)
+        for i in xrange(1, 1001):
+            h.sample(i, 1)
+        nt.assert_equal(len(h.buckets), 10)
+
+        metrics = dict((m['metric'], m['points'][0][1]) for m in h.flush(1, 1))
+        # The top of the distribution is still accurate.
+        assert abs(metrics['my.p.95percentile'] - 950) <= 0.01 * 950
+        nt.assert_equal(metrics['my.p.max'], 1000)
+
     def test_sampled_histogram(self):
         # Submit a sampled histogram.
         stats = MetricsAggregator('myhost')
@@ -328,6 +662,496 @@ class TestUnitDogStatsd(unittest.TestCase):
             else:
                 assert False, 'invalid : %s' % packet
 
+    def test_bad_packets_dont_abort_batch(self):
+        stats = MetricsAggregator('myhost')
+        packet = "\n".join([
+            'counter:1|c',
+            'missing.type:2',
+            'counter:1|c',
+            'gauge:1|g',
+        ])
+        try:
+            stats.submit_packets(packet)
+        except:
+            pass
+        else:
+            assert False, 'invalid batch should raise'
+
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal(2, len(metrics))
+        counter, gauge = metrics
+        nt.assert_equal(counter['points'][0][1], 2)
+        nt.assert_equal(gauge['points'][0][1], 1)
+
+    def test_parse_stats(self):
+        stats = MetricsAggregator('myhost')
+        packets = [
+            'counter:1|c',
+            'counter:1|c',
+            'gauge:1|g',
+            'missing.type:2',
+            'unknown.type:2|z',
+            'string.value:abc|c',
+            'counter:abc|c',
+            'bad.sample.rate:1|c|@abc',
+            'bad.sample.rate:1|c|@2',
+        ]
+        try:
+            stats.submit_packets("\n".join(packets))
+        except Exception:
+            pass
+        flushed = stats.flush_stats()
+        nt.assert_equal(flushed['metric_types'], {'c': 2, 'g': 1})
+        nt.assert_equal(flushed['parse_errors'], {
+            'unparseable': 1,
+            'metric_type': 1,
+            'value': 2,
+            'sample_rate': 2,
+        })
+        flushed = stats.flush_stats()
+        nt.assert_equal(flushed['metric_types'], {})
+        nt.assert_equal(flushed['parse_errors'], {})
+
+    def test_cardinality_limits(self):
+        stats = MetricsAggregator('myhost', max_contexts=15, max_contexts_per_name=5)
+        for i in xrange(10):
+            stats.submit_packets('request.count:1|c|#request_id:%s' % i)
+            stats.submit_packets('request.count:1|c|#request_id:%s' % i)
+        for i in xrange(10):
+            stats.submit_packets('other.%s:1|g' % i)
+
+        metrics = stats.flush()
+        counts = dict((tuple(m['tags'] or ()), m['points'][0][1])
+            for m in metrics if m['metric'] == 'request.count')
+        # 5 contexts, then the rest goes to the overflow context.
+        nt.assert_equal(len(counts), 6)
+        nt.assert_equal(counts[('cardinality_overflow:true',)], 10)
+        nt.assert_equal(counts[('request_id:0',)], 2)
+        # 6 request.count contexts, 9 others, then the global limit.
+        nt.assert_equal(len(stats.metrics), 15)
+        nt.assert_equal(sorted(m['metric'] for m in metrics if m['metric'].startswith('other.')),
+            ['other.%s' % i for i in xrange(9)])
+
+        flushed = stats.flush_stats()
+        # The second packet of each context goes straight to the overflow
+        # context through the context cache.
+        nt.assert_equal(flushed['cardinality_trips'], {'per_name': 5, 'global': 1})
+        nt.assert_equal(sorted(flushed['new_contexts'].items(), key=lambda (n, c): -c)[0],
+            ('request.count', 10))
+
+    def test_cardinality_limits_drop(self):
+        stats = DoubleBufferedAggregator('myhost', max_contexts_per_name=3,
+            cardinality_overflow='drop')
+        for interval in xrange(3):
+            for i in xrange(5):
+                stats.submit_packets('request.count:1|c|#request_id:%s.%s' % (interval, i))
+            metrics = [m for m in stats.flush() if m['points'][0][1]]
+            # Contexts kept from one interval to the next count toward the
+            # limit.
+            nt.assert_equal(len(metrics), 3 if interval == 0 else 0)
+        nt.assert_equal(stats.context_count(), 3)
+        nt.assert_equal(stats.flush_stats()['cardinality_trips'], {'per_name': 12})
+
+    def test_space_saving(self):
+        from aggregator import SpaceSaving
+        top = SpaceSaving(10)
+        random.seed(1)
+        keys = ['heavy'] * 500 + ['medium'] * 200 + ['light.%s' % i for i in xrange(300)]
+        random.shuffle(keys)
+        for key in keys:
+            top.add(key)
+        nt.assert_equal([k for k, _ in top.top()[:2]], ['heavy', 'medium'])
+        # Overestimated by at most n / k.
+        assert 500 <= dict(top.top())["heavy"] <= 500 + len(keys) / 10
+
+    def test_tag_pool(self):
+        from aggregator import TagPool
+        pool = TagPool()
+        tags = pool.get(['role:db', 'env:prod', 'role:db'])
+        nt.assert_equal(tags, ('env:prod', 'role:db'))
+        assert pool.get(('env:prod', 'role:db')) is tags
+        assert pool.get(['role:db', 'env:prod']) is tags
+
+        # Only the tag sets still in use survive a sweep.
+        pool.get(['unused'])
+        pool.sweep()
+        nt.assert_equal(sorted(set(pool.pool.values())), [tags])
+        del tags
+        pool.sweep()
+        nt.assert_equal(len(pool), 0)
+
+    def test_shared_tags(self):
+        stats = MetricsAggregator('myhost')
+        stats.submit_packets('a:1|c|#b,a\nb:1|g|#a,b,a')
+        stats.gauge('c', 1, tags=['a', 'b'])
+        contexts = [c for c in stats.metrics if c[1]]
+        nt.assert_equal(len(contexts), 3)
+        assert contexts[0][1] is contexts[1][1] is contexts[2][1]
+
+    def test_reporter_telemetry(self):
+        from dogstatsd import Reporter, Server
+
+        stats = DoubleBufferedAggregator('myhost')
+        server = Server(stats, '127.0.0.1', 0, so_rcvbuf=1024)
+        server.socket.bind(('127.0.0.1', 0))
+        reporter = Reporter(1, stats, 'http://localhost', server=server)
+
+        # Get the kernel to drop packets: nothing reads the socket.
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        reporter.send_telemetry()
+        for _ in xrange(100):
+            client.sendto('counter:1|c', server.socket.getsockname())
+        time.sleep(0.1)
+        client.close()
+
+        self.assertRaises(Exception, stats.submit_packets,
+            'counter:1|c\ncounter:1|c\nset:1|s\nbad')
+        stats.flush()
+        reporter.send_telemetry()
+        metrics = dict(((m['metric'], tuple(m['tags'] or ())), m['points'][0][1])
+            for m in stats.flush())
+        server.socket.close()
+
+        nt.assert_equal(metrics[('datadog.dogstatsd.metric.count', ('metric_type:c',))], 2)
+        nt.assert_equal(metrics[('datadog.dogstatsd.metric.count', ('metric_type:s',))], 1)
+        nt.assert_equal(metrics[('datadog.dogstatsd.parse_errors', ('reason:unparseable',))], 1)
+        # counter, set, and the contexts and memory of the first call
+        nt.assert_equal(metrics[('datadog.dogstatsd.contexts', ())], 4)
+        assert metrics[('datadog.dogstatsd.memory.rss', ())] > 0
+        assert metrics[('datadog.dogstatsd.udp.drops', ())] > 0
+        nt.assert_equal(reporter.parse_error_count, 1)
+
+    def test_drain_socket(self):
+        from dogstatsd import Server
+
+        stats = MetricsAggregator('myhost')
+        server = Server(stats, '127.0.0.1', 0, drain_socket=True)
+        server.socket.bind(('127.0.0.1', 0))
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in xrange(10):
+            client.sendto('counter:1|c', server.socket.getsockname())
+        client.sendto('gauge:1|g', server.socket.getsockname())
+        time.sleep(0.1)
+
+        stats.submit_packets(server.drain(server.buffer_size))
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal(2, len(metrics))
+        counter, gauge = metrics
+        nt.assert_equal(counter['points'][0][1], 10)
+        nt.assert_equal(gauge['points'][0][1], 1)
+
+        # Nothing left to read.
+        try:
+            server.drain(server.buffer_size)
+        except socket.error:
+            pass
+        else:
+            assert False, 'draining an empty socket should raise'
+
+        client.close()
+        server.socket.close()
+
+    def test_unix_socket(self):
+        import os
+        import shutil
+        import tempfile
+        from dogstatsd import Server
+
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'dogstatsd.sock')
+        stats = MetricsAggregator('myhost')
+        server = Server(stats, '127.0.0.1', 0, socket_path=path)
+        thread = threading.Thread(target=server.start)
+        thread.start()
+        try:
+            while not server.running:
+                time.sleep(0.01)
+            nt.assert_equal(os.stat(path).st_mode & 0777, 0622)
+
+            # Packets come in through both sockets.
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            for i in xrange(10):
+                client.sendto('counter:1|c', path)
+            client.close()
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.sendto('counter:1|c', server.socket.getsockname())
+            client.close()
+            for _ in xrange(100):
+                if stats.count == 11:
+                    break
+                time.sleep(0.01)
+            metrics = stats.flush()
+            nt.assert_equal(metrics[0]['points'][0][1], 11)
+        finally:
+            server.stop()
+            # Wake the server up.
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM).sendto('',
+                server.socket.getsockname())
+            thread.join()
+            server.socket.close()
+
+        # The socket file is removed on exit.
+        assert not os.path.exists(path)
+        shutil.rmtree(tmp_dir)
+
+    def test_merge_partials(self):
+        stats = MetricsAggregator('myhost')
+        workers = [MetricsAggregator('myhost') for _ in range(2)]
+        for i, worker in enumerate(workers):
+            worker.submit_packets('counter:%s|c' % (i + 1))
+            worker.submit_packets('gauge:%s|g' % (i + 1))
+            worker.submit_packets('set:%s|s' % i)
+            worker.submit_packets('set:common|s')
+            for j in xrange(10):
+                worker.submit_packets('hist:%s|h|#tag' % (i * 10 + j))
+
+        for worker in workers:
+            stats.merge(*worker.flush_partials())
+            assert not worker.metrics
+
+        nt.assert_equal(stats.count, 28)
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics['counter'], 3)
+        nt.assert_equal(metrics['gauge'], 2)
+        nt.assert_equal(metrics['set'], 3)
+        nt.assert_equal(metrics['hist.count'], 20)
+        nt.assert_equal(metrics['hist.max'], 19)
+
+        # Merged contexts stay around in the merging aggregator.
+        stats.merge(*workers[0].flush_partials())
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics, {'counter': 0})
+
+    def test_double_buffered_aggregator(self):
+        stats = DoubleBufferedAggregator('myhost')
+        stats.submit_packets('counter:1|c\ngauge:1|g\nhist:1|h')
+        stats.rate('rate', 10)
+        time.sleep(1)
+        stats.rate('rate', 12)
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics['counter'], 1)
+        nt.assert_equal(metrics['gauge'], 1)
+        nt.assert_equal(metrics['hist.count'], 1)
+        nt.assert_equal(metrics['rate'], 2)
+
+        # Counters keep reporting and rates keep their last sample across
+        # generations.
+        time.sleep(1)
+        stats.rate('rate', 15)
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics, {'counter': 0, 'rate': 3})
+        nt.assert_equal(stats.total_count, 3)
+
+    def test_double_buffered_aggregator_concurrent_flush(self):
+        # Nothing is lost when flushing while packets are being submitted.
+        stats = DoubleBufferedAggregator('myhost')
+        packet_count = 20000
+
+        def submit():
+            for i in xrange(packet_count):
+                stats.submit_packets('counter:1|c|#tag:%s' % (i % 10))
+
+        thread = threading.Thread(target=submit)
+        thread.start()
+        total = 0
+        while thread.isAlive():
+            total += sum(m['points'][0][1] for m in stats.flush())
+        thread.join()
+        total += sum(m['points'][0][1] for m in stats.flush())
+        nt.assert_equal(total, packet_count)
+        nt.assert_equal(stats.total_count, packet_count)
+
+    def test_submit_after_expiry(self):
+        stats = MetricsAggregator('myhost')
+        stats.submit_packets('my.counter:1|c')
+        stats.flush()
+
+        # Submit from "another thread" right after the flush expired the
+        # context it had cached.
+        stats.expiry_seconds = 0
+        time.sleep(0.01)
+        expire = stats._expire
+        def _expire(expiry_timestamp):
+            expired = expire(expiry_timestamp)
+            stats.submit_packets('my.counter:5|c')
+            return expired
+        stats._expire = _expire
+        metrics = stats.flush()
+
+        nt.assert_equal([m['points'][0][1] for m in metrics], [5])
+        nt.assert_equal(stats.context_count(), 1)
+
+    def test_concurrent_flush(self):
+        # A plain aggregator can be flushed by one thread while another
+        # submits to it, creating and expiring contexts all along. (Its
+        # counts are only exact with DoubleBufferedAggregator.)
+        stats = MetricsAggregator('myhost', expiry_seconds=0)
+        packet_count = 20000
+        errors = []
+
+        def submit():
+            try:
+                for i in xrange(packet_count):
+                    stats.submit_packets('counter.%s:1|c\nhist:%s|h|#tag:%s' % (
+                        i % 500, i, i % 50))
+            except Exception, e:
+                errors.append(e)
+
+        thread = threading.Thread(target=submit)
+        thread.start()
+        flushes = 0
+        while thread.isAlive():
+            stats.flush()
+            flushes += 1
+        thread.join()
+        stats.flush()
+        nt.assert_equal(errors, [])
+        assert flushes > 1
+
+    def test_multi_process_collect_late_reply(self):
+        import multiprocessing
+        import dogstatsd
+        from dogstatsd import MultiProcessServer
+
+        class FakeWorker(object):
+            pid = 1
+            def __init__(self):
+                self.conn, self.worker_conn = multiprocessing.Pipe()
+            def is_alive(self):
+                return True
+
+        def partials(value):
+            worker = MetricsAggregator('myhost')
+            worker.submit_packets('counter:%s|c' % value)
+            return worker.flush_partials() + (worker.flush_stats(),)
+
+        stats = MetricsAggregator('myhost')
+        server = MultiProcessServer(stats, 'localhost', 0, 1)
+        worker = FakeWorker()
+        server.workers = [worker]
+        timeout = dogstatsd.WORKER_COLLECT_TIMEOUT
+        dogstatsd.WORKER_COLLECT_TIMEOUT = 0.1
+        try:
+            # The worker misses the first collect...
+            server.collect()
+            nt.assert_equal(worker.worker_conn.recv(), ('collect', 1))
+            nt.assert_equal(stats.flush(), [])
+            worker.worker_conn.send((1,) + partials(1))
+
+            # ...and both replies are merged at the next one.
+            worker.worker_conn.send((2,) + partials(2))
+            server.collect()
+            nt.assert_equal(worker.worker_conn.recv(), ('collect', 2))
+            nt.assert_equal([m['points'][0][1] for m in stats.flush()], [3])
+            assert not worker.conn.poll()
+
+            # The next ones are back in step.
+            worker.worker_conn.send((3,) + partials(4))
+            server.collect()
+            nt.assert_equal([m['points'][0][1] for m in stats.flush()], [4])
+        finally:
+            dogstatsd.WORKER_COLLECT_TIMEOUT = timeout
+
+    def test_orphaned_worker_exits(self):
+        from dogstatsd import ServerWorker
+        worker = ServerWorker('myhost', 10, 'localhost', 0)
+        worker.start()
+        worker.conn.close()
+        worker.join(5)
+        alive = worker.is_alive()
+        if alive:
+            worker.terminate()
+        assert not alive
+
+    def test_sharded_aggregator(self):
+        import aggregator
+        from aggregator import ShardedAggregator
+
+        packets = []
+        for i in xrange(100):
+            packets.append('counter.%s:1|c|#b:%s,a' % (i % 7, i % 3))
+            packets.append('counter.%s:2|c|#a,b:%s' % (i % 7, i % 3))
+            packets.append('hist:%s|h|@0.5|#a' % i)
+            packets.append('set:%s|s' % (i % 13))
+        packets.append('bad_packet')
+
+        reference = MetricsAggregator('myhost')
+        stats = ShardedAggregator('myhost', shards=4)
+        try:
+            for s in (reference, stats):
+                self.assertRaises(Exception, s.submit_packets, '\n'.join(packets))
+                s.gauge('gauge', 1, tags=['b', 'a'])
+            nt.assert_equal(stats.context_count(), reference.context_count())
+            nt.assert_equal(stats.count, reference.count)
+            assert len([s for s in stats.shards if s.context_count()]) > 1
+
+            def values(metrics):
+                return sorted((m['metric'], m['tags'], m['points'][0][1]) for m in metrics)
+            nt.assert_equal(values(stats.flush()), values(reference.flush()))
+            nt.assert_equal(stats.flush_stats()['parse_errors'], {'unparseable': 1})
+
+            # Partial aggregates go to the shards of their contexts.
+            worker = MetricsAggregator('myhost')
+            worker.submit_packets('counter.1:5|c|#a,b:1')
+            stats.merge(*worker.flush_partials())
+            metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush()
+                if m['points'][0][1])
+            nt.assert_equal(metrics, {'counter.1': 5})
+            nt.assert_equal(stats.context_count(), reference.context_count())
+        finally:
+            stats.close()
+
+        # Large histograms can be rolled up by other processes.
+        min_samples = aggregator.PROCESS_POOL_MIN_SAMPLES
+        aggregator.PROCESS_POOL_MIN_SAMPLES = 50
+        stats = ShardedAggregator('myhost', shards=2, processes=2, double_buffer=True)
+        try:
+            for i in xrange(100):
+                stats.histogram('hist', i)
+                if i < 10:
+                    stats.histogram('small.hist', i)
+            metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+            nt.assert_equal(metrics['hist.max'], 99)
+            nt.assert_equal(metrics['hist.count'], 100)
+            nt.assert_equal(metrics['small.hist.max'], 9)
+            # The histograms were reset.
+            assert not stats.flush()
+        finally:
+            aggregator.PROCESS_POOL_MIN_SAMPLES = min_samples
+            stats.close()
+
+    def test_context_cache(self):
+        stats = MetricsAggregator('myhost', interval=10)
+        for i in xrange(10):
+            stats.submit_packets('counter:%s|c|@0.5|#tag2,tag1' % i)
+            stats.submit_packets('set:value%s|s' % (i % 3))
+        stats.submit_packets('counter:10|c|#tag1,tag2')
+
+        nt.assert_equal(stats.context_cache.misses, 3)
+        nt.assert_equal(stats.context_cache.hits, 18)
+
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal(len(metrics), 2)
+        counter, set_ = metrics
+        nt.assert_equal(counter['tags'], ('tag1', 'tag2'))
+        nt.assert_equal(counter['points'][0][1], (2 * 45 + 10) / 10.0)
+        nt.assert_equal(set_['points'][0][1], 3)
+
+        # Values are still validated on cache hits.
+        try:
+            stats.submit_packets('counter:abc|c|@0.5|#tag2,tag1')
+        except:
+            pass
+        else:
+            assert False, 'invalid value should raise'
+
+        # The cache can be disabled.
+        stats = MetricsAggregator('myhost', context_cache_size=0)
+        stats.submit_packets('counter:1|c')
+        stats.submit_packets('counter:1|c')
+        nt.assert_equal(stats.flush()[0]['points'][0][1], 2)
+
     def test_metrics_expiry(self):
         # Ensure metrics eventually expire and stop submitting.
         stats = MetricsAggregator('myhost', expiry_seconds=1)
@@ -350,6 +1174,74 @@ class TestUnitDogStatsd(unittest.TestCase):
         assert stats.flush()
 
 
+    def test_metrics_expiry_index(self):
+        # Only the contexts sampled since the last flush and the counters
+        # are flushed; idle ones expire without being scanned.
+        stats = MetricsAggregator('myhost', expiry_seconds=1)
+        stats.submit_packets('test.counter:1|c')
+        stats.submit_packets('test.gauge:1|g')
+        stats.submit_packets('test.histogram:1|h')
+        nt.assert_equal(len(stats.active), 3)
+        nt.assert_equal(len(stats.counters), 1)
+        stats.flush()
+        nt.assert_equal(len(stats.active), 0)
+
+        # Idle gauges and histograms don't report, counters report 0.
+        metrics = stats.flush()
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+            [('test.counter', 0)])
+
+        # Contexts that keep being sampled stay, the others expire.
+        time.sleep(0.6)
+        stats.submit_packets('test.gauge:2|g')
+        time.sleep(0.6)
+        metrics = stats.flush()
+        nt.assert_equal([m['metric'] for m in metrics], ['test.gauge'])
+        nt.assert_equal(len(stats.metrics), 1)
+        nt.assert_equal(len(stats.counters), 0)
+        nt.assert_equal(len(stats.expiry_heap), 1)
+
+    def test_bucketed_aggregator(self):
+        stats = BucketedMetricsAggregator('myhost', bucket_interval=10, lookback=600)
+        if time.time() % 10 > 8:
+            # Don't let the current bucket end while we test it.
+            time.sleep(2)
+        now = int(time.time())
+        start = now - now % 10
+        stats.gauge('gauge', 1, timestamp=start - 100)
+        stats.gauge('gauge', 2, timestamp=start - 95)
+        stats.gauge('gauge', 3, timestamp=start - 30)
+        stats.submit_metric('counter', 2, 'c', timestamp=start - 100)
+        stats.submit_metric('counter', 3, 'c', timestamp=start - 91)
+        stats.submit_metric('hist', 4, 'h', timestamp=start - 30)
+        # Too old
+        stats.gauge('gauge', 4, timestamp=start - 700)
+        # Not timestamped
+        stats.gauge('gauge', 5)
+
+        metrics = sorted((m['metric'], int(m['points'][0][0]), m['points'][0][1])
+            for m in stats.flush() if m['metric'] != 'hist.count')
+        current = [m for m in metrics if m[2] == 5 and m[0] == 'gauge']
+        nt.assert_equal(len(current), 1)
+        assert current[0][1] >= now
+        metrics.remove(current[0])
+        # Counted over 10s buckets, not the 1s flush interval.
+        nt.assert_equal(metrics, [
+            ('counter', start - 100, 0.5),
+            ('gauge', start - 100, 2),
+            ('gauge', start - 30, 3),
+            ('hist.95percentile', start - 30, 4),
+            ('hist.avg', start - 30, 4),
+            ('hist.max', start - 30, 4),
+            ('hist.median', start - 30, 4),
+        ])
+        nt.assert_equal(stats.buckets, {})
+
+        # The current bucket is only flushed once it's complete.
+        stats.gauge('gauge', 6, timestamp=start)
+        nt.assert_equal(len(stats.buckets), 1)
+        nt.assert_equal(stats.flush(), [])
+
     def test_diagnostic_stats(self):
         stats = MetricsAggregator('myhost')
         for i in xrange(10):
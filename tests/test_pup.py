@@ -0,0 +1,34 @@
+import zlib
+
+from tornado.testing import AsyncHTTPTestCase
+import nose.tools as nt
+
+from pup import pup
+from util import json
+
+
+class TestPup(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return pup.application
+
+    def setUp(self):
+        AsyncHTTPTestCase.setUp(self)
+        pup.metrics.clear()
+
+    def post_series(self, body, headers=None):
+        response = self.fetch('/api/v1/series', method='POST', body=body,
+            headers=headers or {})
+        nt.assert_equal(response.code, 200)
+
+    def test_series(self):
+        series = [{'metric': 'my_metric', 'points': [[1, 2]], 'tags': None}]
+        self.post_series(json.dumps({'series': series}))
+        nt.assert_equal(pup.metrics['my_metric']['points'], [[1, 2]])
+
+    def test_deflated_series(self):
+        # As posted by dogstatsd, and relayed by the forwarder.
+        series = [{'metric': 'my_metric', 'points': [[1, 2]], 'tags': None}]
+        self.post_series(zlib.compress(json.dumps({'series': series})),
+            {'Content-Type': 'application/json', 'Content-Encoding': 'deflate'})
+        nt.assert_equal(pup.metrics['my_metric']['points'], [[1, 2]])
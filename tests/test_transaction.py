@@ -1,9 +1,15 @@
 import unittest
 from datetime import timedelta, datetime
+import shutil
+import tempfile
 import time
+import zlib
+
+from util import json
 
 from transaction import Transaction, TransactionManager
-from ddagent import MAX_WAIT_FOR_REPLAY, MAX_QUEUE_SIZE, THROTTLING_DELAY
+from ddagent import Application, APIMetricTransaction, MetricTransaction, \
+    MAX_WAIT_FOR_REPLAY, MAX_QUEUE_SIZE, THROTTLING_DELAY
 
 class memTransaction(Transaction):
     def __init__(self, size, manager):
@@ -44,8 +50,8 @@ class TestTransaction(unittest.TestCase):
 
         # There should be exactly step transaction in the list, with
         # a flush count of 1
-        self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        self.assertEqual(len(trManager.get_transactions()), step)
+        for tr in trManager.get_transactions():
             self.assertEqual(tr._flush_count,1)
 
         # Try to add one more
@@ -53,14 +59,14 @@ class TestTransaction(unittest.TestCase):
         trManager.append(tr)
 
         # At this point, transaction one (the oldest) should have been removed from the list 
-        self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        self.assertEqual(len(trManager.get_transactions()), step)
+        for tr in trManager.get_transactions():
             self.assertNotEqual(tr._id,1)
 
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), step)
+        self.assertEqual(len(trManager.get_transactions()), step)
         # Check and allow transactions to be flushed
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             tr.is_flushable = True
             # Last transaction has been flushed only once
             if tr._id == step + 1:
@@ -69,9 +75,181 @@ class TestTransaction(unittest.TestCase):
                 self.assertEqual(tr._flush_count,2)
 
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), 0)
+        self.assertEqual(len(trManager.get_transactions()), 0)
 
         
+    def testEvictionOrder(self):
+        """Transactions replayed the latest are evicted first"""
+        trManager = TransactionManager(timedelta(seconds=90), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        oneTrSize = MAX_QUEUE_SIZE / 4
+        trs = [memTransaction(oneTrSize, trManager) for i in xrange(3)]
+        for tr in trs:
+            trManager.append(tr)
+
+        # The second one failed twice, the third once.
+        trManager.tr_error(trs[1])
+        trManager.tr_error(trs[1])
+        trManager.tr_error(trs[2])
+
+        trManager.append(memTransaction(oneTrSize, trManager))
+        trManager.append(memTransaction(oneTrSize, trManager))
+        self.assertEqual([tr.get_id() for tr in trManager.get_transactions()], [1, 3, 4, 5])
+        trManager.append(memTransaction(oneTrSize, trManager))
+        self.assertEqual([tr.get_id() for tr in trManager.get_transactions()], [1, 4, 5, 6])
+
+        # Evicted transactions completing don't throw the accounting off.
+        trManager.tr_success(trs[1])
+        trManager.tr_success(trs[0])
+        self.assertEqual(trManager._total_count, 3)
+        self.assertEqual(trManager._total_size, 3 * oneTrSize)
+
+    def testEvictionPolicies(self):
+        """The eviction policy picks the transactions to drop"""
+        def evicted(policy, sizes):
+            trManager = TransactionManager(timedelta(seconds=0), 100,
+                timedelta(seconds=0), eviction_policy=policy)
+            trs = []
+            for size in sizes:
+                tr = memTransaction(size, trManager)
+                trs.append(tr)
+                trManager.append(tr)
+            left = trManager.get_transactions()
+            return [tr.get_id() for tr in trs if tr not in left], trManager
+
+        sizes = [10, 40, 20, 30, 50]
+        self.assertEqual(evicted('oldest', sizes)[0], [1, 2])
+        self.assertEqual(evicted('largest', sizes)[0], [2, 4])
+        self.assertEqual(evicted(lambda tr: -tr.get_id(), sizes)[0], [3, 4])
+
+        class lowTransaction(memTransaction):
+            _priority = -1
+        trManager = TransactionManager(timedelta(seconds=0), 100,
+            timedelta(seconds=0), eviction_policy='priority')
+        trs = [memTransaction(30, trManager), lowTransaction(30, trManager),
+            lowTransaction(30, trManager), memTransaction(30, trManager)]
+        for tr in trs:
+            trManager.append(tr)
+        self.assertEqual(trManager.get_transactions(), [trs[0], trs[2], trs[3]])
+
+        # Evictions are counted
+        ids, trManager = evicted('oldest', sizes)
+        self.assertEqual(trManager._evicted_count, 2)
+        self.assertEqual(trManager._evicted_size, 50)
+        self.assertEqual(trManager._total_size, 100)
+
+    def testCoalescing(self):
+        """Transactions that can be sent together are, up to max_batch_size"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+            timedelta(seconds=0), max_batch_size=250)
+
+        batches = []
+        class batchTransaction(memTransaction):
+            _batchable = True
+
+            def can_coalesce(self, tr):
+                return isinstance(tr, batchTransaction)
+
+            def flush_batch(self, batch):
+                batches.append([self] + batch)
+                for tr in [self] + batch:
+                    self._trManager.tr_success(tr)
+                self._trManager.flush_next()
+
+        trs = []
+        for i in xrange(5):
+            trs.append(batchTransaction(100, trManager))
+            trs.append(memTransaction(100, trManager))
+        for tr in trs:
+            tr.is_flushable = True
+            trManager.append(tr)
+        time.sleep(0.01)
+        trManager.flush()
+
+        # The one left over (the oldest: the newest go first) is sent on its
+        # own, as are the others
+        self.assertEqual([len(b) for b in batches], [2, 2])
+        self.assertEqual(len(trManager.get_transactions()), 0)
+        self.assertEqual([tr._flush_count for tr in trs],
+            [1, 1, 0, 1, 0, 1, 0, 1, 0, 1])
+
+    def testCoalescingBacklog(self):
+        """Coalescing a big backlog doesn't look at each transaction more than
+        a couple of times"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+            timedelta(seconds=0), max_in_flight=40000, max_batch_size=1024*1024)
+
+        # No responses: everything is sent in one go
+        checks = [0]
+        class batchTransaction(memTransaction):
+            _batchable = True
+
+            def can_coalesce(self, tr):
+                checks[0] += 1
+                return isinstance(tr, batchTransaction)
+
+            def flush_batch(self, batch):
+                for tr in [self] + batch:
+                    tr._flush_count += 1
+
+        class loneTransaction(memTransaction):
+            def can_coalesce(self, tr):
+                checks[0] += 1
+                return False
+
+            def flush(self):
+                self._flush_count += 1
+
+        count = 20000
+        trs = []
+        for i in xrange(count):
+            trs.append(batchTransaction(100, trManager))
+            trs.append(loneTransaction(100, trManager))
+        for tr in trs:
+            trManager.append(tr)
+        time.sleep(0.01)
+        trManager.flush()
+
+        self.assertEqual([tr._flush_count for tr in trs], [1] * len(trs))
+        # Only the batchable ones are looked at, one more time per batch
+        self.assertTrue(checks[0] <= 2 * count, checks[0])
+
+    def testSeriesBatch(self):
+        """Series posted to the forwarder are merged into one payload"""
+        app = Application(17123, {}, watchdog=False)
+        trs = [
+            APIMetricTransaction(json.dumps({'series': [{'metric': 'a'}]}), {}),
+            APIMetricTransaction(zlib.compress(json.dumps({'series': [{'metric': 'b'}]})),
+                {'Content-Encoding': 'deflate'}),
+            APIMetricTransaction(json.dumps({'series': [{'metric': 'c'}, {'metric': 'd'}]}), {}),
+        ]
+        sent = {}
+        def send(data, headers, callback, endpoints):
+            for endpoint in endpoints:
+                sent[endpoint] = (data, headers, callback)
+        trs[0].send = send
+        endpoints = MetricTransaction._endpoints
+        MetricTransaction._endpoints = ['pup_url', 'dd_url']
+        try:
+            trs[0].flush_batch(trs[1:])
+        finally:
+            MetricTransaction._endpoints = endpoints
+
+        # Pup can only read plain json
+        data, headers, _ = sent['pup_url']
+        self.assertTrue('Content-Encoding' not in headers)
+        self.assertEqual([s['metric'] for s in json.loads(data)['series']],
+            ['a', 'b', 'c', 'd'])
+        data, headers, callback = sent['dd_url']
+        self.assertEqual(headers['Content-Encoding'], 'deflate')
+        self.assertEqual([s['metric'] for s in json.loads(zlib.decompress(data))['series']],
+            ['a', 'b', 'c', 'd'])
+
+        # The response is the one of every transaction of the batch
+        class response(object):
+            error = None
+        callback(response())
+        self.assertEqual(len(app._tr_manager.get_transactions()), 0)
+
     def testThrottling(self):
         """Test throttling while flushing"""
  
@@ -92,6 +270,96 @@ class TestTransaction(unittest.TestCase):
         self.assertTrue( (after-before) > 3 * THROTTLING_DELAY - timedelta(microseconds=100000), 
             "before = %s after = %s" % (before, after))
             
+    def testInFlightWindow(self):
+        """At most max_in_flight transactions wait for a response"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+            timedelta(seconds=0), max_in_flight=3)
+
+        # These don't get their response until we give it to them
+        sent = []
+        class asyncTransaction(memTransaction):
+            def flush(self):
+                sent.append(self)
+
+        for i in xrange(10):
+            trManager.append(asyncTransaction(100, trManager))
+        time.sleep(0.01)
+        trManager.flush()
+        self.assertEqual(len(sent), 3)
+
+        # Each response lets the next one go
+        trManager.tr_success(sent[0])
+        trManager.flush_next()
+        self.assertEqual(len(sent), 4)
+        while len(trManager.get_transactions()) > 0:
+            tr = sent.pop(0)
+            trManager.tr_success(tr)
+            trManager.flush_next()
+        self.assertEqual(trManager._trs_to_flush, None)
+        self.assertEqual(len(trManager._in_flight), 0)
+
+    def testByteRate(self):
+        """The byte rate rather than the transaction count drives throttling"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+            THROTTLING_DELAY, max_in_flight=2, max_bytes_per_second=100000)
+        trManager._flush_without_ioloop = True
+
+        # Small transactions aren't held back by THROTTLING_DELAY
+        for i in xrange(10):
+            tr = memTransaction(1000, trManager)
+            tr.is_flushable = True
+            trManager.append(tr)
+        time.sleep(0.01)
+        before = datetime.now()
+        trManager.flush()
+        self.assertTrue(datetime.now() - before < THROTTLING_DELAY)
+        self.assertEqual(len(trManager.get_transactions()), 0)
+
+        # Past the first second's worth of bytes, 2 transactions of half a
+        # second's worth take a second
+        for i in xrange(4):
+            tr = memTransaction(50000, trManager)
+            tr.is_flushable = True
+            trManager.append(tr)
+        time.sleep(0.01)
+        before = datetime.now()
+        trManager.flush()
+        after = datetime.now()
+        self.assertEqual(len(trManager.get_transactions()), 0)
+        self.assertTrue(after - before > timedelta(seconds=0.9),
+            "before = %s after = %s" % (before, after))
+
+    def testJournal(self):
+        """Transactions not sent before a restart are replayed"""
+        journal_dir = tempfile.mkdtemp()
+        try:
+            config = {'forwarder_journal_dir': journal_dir, 'forwarder_journal_max_size': 1000}
+            app = Application(17123, config, watchdog=False)
+            trs = [MetricTransaction('{"payload": %s}' % i, {'Content-Type': 'application/json'})
+                for i in xrange(3)]
+            trs.append(APIMetricTransaction('{"series": []}', {'Content-Encoding': 'deflate'}))
+
+            # Only the journal has the payloads
+            for tr in trs:
+                self.assertEqual(tr._data, None)
+            self.assertEqual(trs[1].get_payload()[0], '{"payload": 1}')
+
+            # Sent, and evicted to make room
+            app._tr_manager.tr_success(trs[0])
+            MetricTransaction('x' * 990, {})
+            self.assertEqual(len(app._tr_manager.get_transactions()), 1)
+            app._journal.close()
+
+            app = Application(17123, config, watchdog=False)
+            replayed = app._tr_manager.get_transactions()
+            self.assertEqual(len(replayed), 1)
+            self.assertEqual(replayed[0].get_payload(), ('x' * 990, {}))
+            app._tr_manager.tr_success(replayed[0])
+            self.assertEqual(len(app._journal), 0)
+            app._journal.close()
+        finally:
+            shutil.rmtree(journal_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,9 @@
 # stdlib
+from heapq import heapify, heappop, heappush
 import sys
 import time
 from datetime import datetime, timedelta
 import logging
-from operator import attrgetter
 
 # vendor
 import tornado.ioloop
@@ -18,16 +18,39 @@ def plural(count):
         return "s"
     return ""
 
+# To order the transactions by decreasing next flush time.
+EPOCH = datetime(1970, 1, 1)
+
+# Ways to pick the transactions to drop when the queue is full: functions of a
+# transaction returning its rank, the lowest ranks being dropped first.
+EVICTION_POLICIES = {
+    # The ones that would be flushed last
+    'next_flush': lambda tr: EPOCH - tr.get_next_flush(),
+    'oldest': lambda tr: tr.get_id(),
+    'largest': lambda tr: -tr.get_size(),
+    # The oldest of the lowest priority ones
+    'priority': lambda tr: (tr.get_priority(), tr.get_id()),
+}
+DEFAULT_EVICTION_POLICY = 'next_flush'
+
 class ImplementationError(Exception): pass
 
 class Transaction(object):
 
+    # Transactions of lower priorities are dropped first by the 'priority'
+    # eviction policy
+    _priority = 0
+
+    # Whether flush_batch is implemented, i.e. can_coalesce may be true
+    _batchable = False
+
     def __init__(self):
 
         self._id = None
         self._error_count = 0
         self._next_flush = datetime.now()        
         self._size = None
+        self._record = None # Id of the transaction in the journal, if any
 
     def get_id(self):
         return self._id
@@ -36,6 +59,12 @@ class Transaction(object):
         assert self._id is None
         self._id = new_id
 
+    def get_priority(self):
+        return self._priority
+
+    def get_record(self):
+        return self._record
+
     def inc_error_count(self):
         self._error_count = self._error_count + 1
 
@@ -67,34 +96,81 @@ class Transaction(object):
     def flush(self):
         raise ImplementationError("To be implemented in a subclass")
 
+    def can_coalesce(self, tr):
+        """ Whether `tr` can be sent in the same request as this transaction. """
+        return False
+
+    def flush_batch(self, batch):
+        """ Send this transaction and the ones of `batch` in one request. """
+        raise ImplementationError("To be implemented in a subclass")
+
 class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
        are all commited, without exceeding parameters (throttling, memory consumption) """
 
-    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay):
+    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay,
+            max_in_flight=None, max_bytes_per_second=None, journal=None,
+            eviction_policy=None, max_batch_size=None):
         self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
         self._MAX_QUEUE_SIZE = max_queue_size
         self._THROTTLING_DELAY = throttling_delay
+        # Number of transactions waiting for a response at the same time,
+        # whatever the endpoints they are sent to
+        self._MAX_IN_FLIGHT = max(int(max_in_flight or 1), 1)
+        # When set, throttle on the bytes sent rather than THROTTLING_DELAY
+        self._MAX_BYTES_PER_SECOND = int(max_bytes_per_second or 0)
+        # Bytes of the transactions sent in one request, when they can be
+        # coalesced (0 to send them one by one)
+        self._MAX_BATCH_SIZE = int(max_batch_size or 0)
+        # diskqueue.Journal the transactions' payloads are kept in, if any
+        self._journal = journal
+        # Name of one of EVICTION_POLICIES, or a function ranking transactions
+        if not callable(eviction_policy):
+            if eviction_policy and eviction_policy not in EVICTION_POLICIES:
+                log.warn("Unknown eviction policy %s, using %s" % (eviction_policy,
+                    DEFAULT_EVICTION_POLICY))
+                eviction_policy = None
+            eviction_policy = EVICTION_POLICIES[eviction_policy or DEFAULT_EVICTION_POLICY]
+        self._eviction_rank = eviction_policy
 
         self._flush_without_ioloop = False # useful for tests
 
-        self._transactions = [] #List of all non commited transactions
+        self._transactions = {} # Id -> transaction, for all non commited transactions
+        # Min-heaps of (next flush time, id, next flush time), to find the
+        # transactions due for a flush, and of (eviction rank, id, next flush
+        # time), to find the ones to evict first.
+        # A transaction gets new entries whenever its next flush time
+        # changes, and entries that don't match a transaction anymore are
+        # skipped.
+        self._flush_heap = []
+        self._eviction_heap = []
         self._total_count = 0 # Maintain size/count not to recompute it everytime
         self._total_size = 0 
         self._flush_count = 0
+        self._evicted_count = 0
+        self._evicted_size = 0
 
         # Global counter to assign a number to each transaction: we may have an issue
         #  if this overlaps
         self._counter = 0
 
         self._trs_to_flush = None # Current transactions being flushed
+        self._batchable_trs = [] # The ones of them that can be coalesced
+        self._sent = set() # Ids of the ones already sent, alone or in a batch
         self._last_flush = datetime.now() # Last flush (for throttling)
+        self._in_flight = set() # Ids of the transactions waiting for a response
+        self._flush_scheduled = False
+        self._allowance = self._MAX_BYTES_PER_SECOND # Bytes we may send right now
+        self._last_refill = datetime.now()
 
         # Track an initial status message.
         ForwarderStatus().persist()
 
+    def get_journal(self):
+        return self._journal
+
     def get_transactions(self):
-        return self._transactions
+        return [self._transactions[i] for i in sorted(self._transactions)]
 
     def print_queue_stats(self):
         log.debug("Queue size: at %s, %s transaction(s), %s KB" % 
@@ -117,18 +193,20 @@ class TransactionManager(object):
 
         if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
             log.warn("Queue is too big, removing old transactions...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    self._transactions.remove(tr2)
-                    self._total_count = self._total_count - 1
-                    self._total_size = self._total_size - tr2.get_size()
-                    log.warn("Removed transaction %s from queue" % tr2.get_id())
+            while self._eviction_heap and (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
+                tr2 = self._pop_valid(self._eviction_heap)
+                if tr2 is None:
+                    continue
+                self._remove(tr2)
+                self._evicted_count += 1
+                self._evicted_size += tr2.get_size()
+                log.warn("Removed transaction %s from queue" % tr2.get_id())
 
         # Done
-        self._transactions.append(tr)
+        self._transactions[tr.get_id()] = tr
         self._total_count = self._total_count + 1
         self._total_size = self._total_size + tr_size
+        self._push(tr)
 
         log.debug("Transaction %s added" % (tr.get_id()))
         self.print_queue_stats()
@@ -142,67 +220,190 @@ class TransactionManager(object):
         to_flush = []
         # Do we have something to do ?
         now = datetime.now()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
+        while self._flush_heap and self._flush_heap[0][0] < now:
+            tr = self._pop_valid(self._flush_heap)
+            if tr is not None:
                 to_flush.append(tr)
 
         count = len(to_flush)
         if count > 0:
             log.debug("Flushing %s transaction%s" % (count,plural(count)))
             self._trs_to_flush = to_flush
+            if self._MAX_BATCH_SIZE:
+                self._batchable_trs = [tr for tr in to_flush if tr._batchable]
             self.flush_next()
         self._flush_count += 1
 
         ForwarderStatus(
             queue_length=self._total_count,
             queue_size=self._total_size,
-            flush_count=self._flush_count).persist()
+            flush_count=self._flush_count,
+            evicted_count=self._evicted_count,
+            evicted_size=self._evicted_size).persist()
 
     def flush_next(self):
 
-        if len(self._trs_to_flush) > 0:
+        if self._trs_to_flush is None:
+            return
 
-            td = self._last_flush + self._THROTTLING_DELAY - datetime.now()
-            # Python 2.7 has this built in, python < 2.7 don't...
-            if hasattr(td,'total_seconds'):
-                delay = td.total_seconds()
-            else:
-                delay = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10.0**6
+        # Send transactions until the window is full or we have to wait
+        while self._trs_to_flush and len(self._in_flight) < self._MAX_IN_FLIGHT:
 
-            if delay <= 0:
-                tr = self._trs_to_flush.pop()
-                self._last_flush = datetime.now()
-                log.debug("Flushing transaction %d" % tr.get_id())
-                try:
-                    tr.flush()
-                except Exception,e :
-                    log.exception(e)
-                    self.tr_error(tr)
-                    self.flush_next()
-            else:
+            tr_id = self._trs_to_flush[-1].get_id()
+            if tr_id not in self._transactions or tr_id in self._sent:
+                # Evicted or sent in a batch since the flush started
+                self._trs_to_flush.pop()
+                continue
+
+            delay = self._get_delay(self._trs_to_flush[-1])
+            if delay > 0:
                 # Wait a little bit more
                 if  tornado.ioloop.IOLoop.instance().running():
-                    tornado.ioloop.IOLoop.instance().add_timeout(time.time() + delay,
-                        lambda: self.flush_next())
+                    if not self._flush_scheduled:
+                        self._flush_scheduled = True
+                        tornado.ioloop.IOLoop.instance().add_timeout(time.time() + delay,
+                            self._scheduled_flush_next)
+                    return
                 elif self._flush_without_ioloop:
-                    # Tornado is no started (ie, unittests), do it manually: BLOCKING                    
+                    # Tornado is no started (ie, unittests), do it manually: BLOCKING
                     time.sleep(delay)
-                    self.flush_next()
-        else:
+                    continue
+                return
+
+            tr = self._trs_to_flush.pop()
+            self._sent.add(tr.get_id())
+            self._consume(tr)
+            # Only the first transaction of a batch counts as in flight
+            self._in_flight.add(tr.get_id())
+            batch = self._coalesce(tr)
+            for tr2 in batch:
+                self._consume(tr2)
+            try:
+                if batch:
+                    log.debug("Flushing transaction %d with %d other%s" % (tr.get_id(),
+                        len(batch), plural(len(batch))))
+                    tr.flush_batch(batch)
+                else:
+                    log.debug("Flushing transaction %d" % tr.get_id())
+                    tr.flush()
+            except Exception,e :
+                log.exception(e)
+                for tr2 in [tr] + batch:
+                    self.tr_error(tr2)
+
+        # Done once the last transaction got its response
+        if self._trs_to_flush == [] and not self._in_flight:
             self._trs_to_flush = None
+            self._batchable_trs = []
+            self._sent.clear()
+
+    def _coalesce(self, tr):
+        """ Take out of the transactions to flush the next ones `tr` can send
+        along with itself, up to max_batch_size bytes in all. """
+        if not self._MAX_BATCH_SIZE or not tr._batchable:
+            return []
+        batch = []
+        size = tr.get_size()
+        # Next transactions to flush first. Each one is looked at until it's
+        # sent, and the ones sent are dropped, so a flush stays linear.
+        trs = self._batchable_trs
+        while trs and size < self._MAX_BATCH_SIZE:
+            tr2 = trs[-1]
+            tr2_id = tr2.get_id()
+            if tr2_id not in self._transactions or tr2_id in self._sent:
+                trs.pop()
+                continue
+            if not tr.can_coalesce(tr2) or size + tr2.get_size() > self._MAX_BATCH_SIZE:
+                break
+            trs.pop()
+            self._sent.add(tr2_id)
+            batch.append(tr2)
+            size += tr2.get_size()
+        return batch
+
+    def _scheduled_flush_next(self):
+        self._flush_scheduled = False
+        self.flush_next()
+
+    def _get_delay(self, tr):
+        """ Seconds to wait before sending `tr`: with a byte rate, until
+        enough bytes are allowed to be sent, otherwise until THROTTLING_DELAY
+        has passed since the last flush. """
+        now = datetime.now()
+        if self._MAX_BYTES_PER_SECOND:
+            self._refill(now)
+            # A transaction bigger than a second's worth of bytes only has
+            # to wait for a full allowance.
+            needed = min(tr.get_size(), self._MAX_BYTES_PER_SECOND)
+            if self._allowance >= needed:
+                return 0
+            return float(needed - self._allowance) / self._MAX_BYTES_PER_SECOND
+        td = self._last_flush + self._THROTTLING_DELAY - now
+        # Python 2.7 has this built in, python < 2.7 don't...
+        if hasattr(td,'total_seconds'):
+            return td.total_seconds()
+        return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10.0**6
+
+    def _refill(self, now):
+        td = now - self._last_refill
+        elapsed = td.days * 24 * 3600 + td.seconds + td.microseconds / 10.0**6
+        self._allowance = min(self._allowance + elapsed * self._MAX_BYTES_PER_SECOND,
+            self._MAX_BYTES_PER_SECOND)
+        self._last_refill = now
+
+    def _consume(self, tr):
+        self._last_flush = datetime.now()
+        if self._MAX_BYTES_PER_SECOND:
+            # Can go below zero for big transactions, the next ones will wait
+            self._allowance -= tr.get_size()
 
     def tr_error(self,tr):
+        self._in_flight.discard(tr.get_id())
         tr.inc_error_count()
         tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+        if tr.get_id() in self._transactions:
+            self._push(tr)
         log.warn("Transaction %d in error (%s error%s), it will be replayed after %s" %
           (tr.get_id(), tr.get_error_count(), plural(tr.get_error_count()), 
            tr.get_next_flush()))
 
     def tr_success(self,tr):
         log.debug("Transaction %d completed" % tr.get_id())
-        self._transactions.remove(tr)
+        self._in_flight.discard(tr.get_id())
+        if tr.get_id() in self._transactions:
+            self._remove(tr)
+        self.print_queue_stats()
+
+    def _push(self, tr):
+        next_flush = tr.get_next_flush()
+        heappush(self._flush_heap, (next_flush, tr.get_id(), next_flush))
+        heappush(self._eviction_heap, (self._eviction_rank(tr), tr.get_id(), next_flush))
+
+        # Drop the outdated entries once they outnumber the valid ones.
+        if len(self._eviction_heap) > 2 * len(self._transactions) + 100:
+            self._flush_heap = []
+            self._eviction_heap = []
+            for tr_id, tr2 in self._transactions.iteritems():
+                next_flush = tr2.get_next_flush()
+                self._flush_heap.append((next_flush, tr_id, next_flush))
+                self._eviction_heap.append((self._eviction_rank(tr2), tr_id, next_flush))
+            heapify(self._flush_heap)
+            heapify(self._eviction_heap)
+
+    def _pop_valid(self, heap):
+        """ Pop the first entry of `heap` and return its transaction, or
+        None if the entry is outdated. """
+        _, tr_id, next_flush = heappop(heap)
+        tr = self._transactions.get(tr_id)
+        if tr is None or tr.get_next_flush() is not next_flush:
+            return None
+        return tr
+
+    def _remove(self, tr):
+        del self._transactions[tr.get_id()]
         self._total_count = self._total_count - 1
         self._total_size = self._total_size - tr.get_size()
-        self.print_queue_stats()
+        if self._journal is not None and tr.get_record() is not None:
+            self._journal.ack(tr.get_record())
 
 